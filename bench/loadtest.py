@@ -0,0 +1,111 @@
+"""Load test for a running `beet webimport` server.
+
+Opens one keep-alive connection per client thread and hammers the given
+endpoints for a fixed duration, then reports requests per second and
+latency percentiles for each of them:
+
+    python bench/loadtest.py --url http://127.0.0.1:8337 \
+        --clients 32 --duration 30 --path /tasks --path /imports
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
+
+DEFAULT_PATHS = ['/tasks', '/imports', '/rules']
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of a sorted list of values.
+    """
+    if not values:
+        return 0.0
+    index = min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def client(url, paths, deadline, results, errors, lock):
+    """Issue requests round-robin over `paths` until `deadline`,
+    recording the latency of each one.
+    """
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    conn = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.time()
+        try:
+            conn.request('GET', url.path.rstrip('/') + path)
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError):
+            failures[path] += 1
+            conn.close()
+            conn = httplib.HTTPConnection(url.hostname, url.port or 80,
+                                          timeout=30)
+            continue
+        if response.status >= 500:
+            failures[path] += 1
+        latencies[path].append(time.time() - start)
+    conn.close()
+
+    with lock:
+        for path, values in latencies.items():
+            results[path].extend(values)
+        for path, count in failures.items():
+            errors[path] += count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8337')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--path', action='append', dest='paths')
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    paths = args.paths or DEFAULT_PATHS
+    results = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=client,
+                                args=(url, paths, deadline, results, errors,
+                                      lock))
+               for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{0:<24} {1:>10} {2:>8} {3:>10} {4:>10} {5:>10}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    total = 0
+    for path in paths:
+        values = sorted(results[path])
+        total += len(values)
+        print('{0:<24} {1:>10} {2:>8} {3:>10.1f} {4:>10.2f} {5:>10.2f}'
+              .format(path, len(values), errors[path],
+                      len(values) / args.duration,
+                      percentile(values, 50) * 1000,
+                      percentile(values, 99) * 1000))
+    print('total: {0:.1f} req/s over {1} clients'.format(
+        total / args.duration, args.clients))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""End-to-end throughput benchmark for the webimport plugin.
+
+Generates a synthetic inbox of albums made of tagged, silent MP3 files,
+stands in for the metadata sources with a local plugin that answers
+after a configurable latency, and drives `WebImportSession` through:
+
+* the auto path: every album matches its candidate exactly and is
+  applied without asking;
+* the web path: every album is parked (timid mode) and decided by
+  reviewer threads through GET /tasks and POST /tasks/decisions.
+
+It reports albums per minute, p50/p99 decision latency (from the end of
+the lookup to the choice) and peak RSS, and compares them with the
+baselines stored in bench/baselines.json:
+
+    python bench/throughput.py --albums 200 --latency 0.05
+    python bench/throughput.py --save-baselines
+
+Requires beets and mutagen, like the plugin itself.
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(HERE, 'baselines.json')
+
+# One MPEG-1 Layer III frame of silence: 128 kbps, 44.1 kHz, no padding.
+FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+FRAMES_PER_TRACK = 40
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of a sorted list of values.
+    """
+    if not values:
+        return 0.0
+    index = min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def make_inbox(root, albums, tracks):
+    """Write `albums` directories of `tracks` tagged MP3 files under
+    `root`, and return the metadata they were tagged with, by album.
+    """
+    from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK
+
+    truth = {}
+    for a in range(albums):
+        artist = u'Artist {0:05d}'.format(a)
+        album = u'Album {0:05d}'.format(a)
+        titles = [u'Track {0:05d}-{1:02d}'.format(a, t)
+                  for t in range(1, tracks + 1)]
+        truth[album] = (artist, titles)
+        path = os.path.join(root, '{0} - {1}'.format(artist, album))
+        os.makedirs(path)
+        for t, title in enumerate(titles, 1):
+            filename = os.path.join(path, '{0:02d} {1}.mp3'.format(t, title))
+            with open(filename, 'wb') as f:
+                f.write(FRAME * FRAMES_PER_TRACK)
+            tags = ID3()
+            tags.add(TIT2(encoding=3, text=title))
+            tags.add(TPE1(encoding=3, text=artist))
+            tags.add(TALB(encoding=3, text=album))
+            tags.add(TRCK(encoding=3, text=u'{0}/{1}'.format(t, tracks)))
+            tags.save(filename)
+    return truth
+
+
+def fake_source(truth, latency, latencies):
+    """Return a plugin class answering album lookups from `truth` after
+    sleeping `latency` seconds, and recording the time from lookup to
+    choice of every task in `latencies`.
+    """
+    from beets.autotag import hooks
+    from beets.plugins import BeetsPlugin
+
+    class FakeSource(BeetsPlugin):
+        def __init__(self):
+            super(FakeSource, self).__init__()
+            self.register_listener('import_task_choice', self.task_choice)
+
+        def candidates(self, items, artist, album, va_likely):
+            time.sleep(latency)
+            if album not in truth:
+                return []
+            artist, titles = truth[album]
+            tracks = [hooks.TrackInfo(title, u'fake-track-{0}-{1}'.format(
+                album, i), artist=artist, length=items[0].length,
+                index=i, medium=1, medium_index=i, medium_total=len(titles),
+                data_source=u'Fake')
+                for i, title in enumerate(titles, 1)]
+            return [hooks.AlbumInfo(album, u'fake-album-{0}'.format(album),
+                                    artist, u'fake-artist', tracks,
+                                    mediums=1, data_source=u'Fake')]
+
+        def item_candidates(self, item, artist, title):
+            time.sleep(latency)
+            return []
+
+        def task_choice(self, session, task):
+            looked_up = getattr(task, 'looked_up', None)
+            if looked_up is not None:
+                latencies.append(time.time() - looked_up)
+
+    return FakeSource
+
+
+def review(client, done, interval=0.02):
+    """Apply the first candidate of every parked task until `done`.
+    """
+    while not done.is_set():
+        tasks = json.loads(client.get('/tasks?limit=100').data)['tasks']
+        if not tasks:
+            time.sleep(interval)
+            continue
+        client.post('/tasks/decisions', data=json.dumps({
+            'decisions': [{'task': t['id'], 'action': 'apply', 'candidate': 0}
+                          for t in tasks],
+        }), content_type='application/json')
+
+
+def run(mode, args):
+    """Import a fresh synthetic inbox in `mode` ("auto" or "web") and
+    return the measurements.
+    """
+    workdir = tempfile.mkdtemp(prefix='webimport-bench-')
+    os.environ['BEETSDIR'] = workdir
+    try:
+        inbox = os.path.join(workdir, 'inbox')
+        truth = make_inbox(inbox, args.albums, args.tracks)
+
+        sys.path.insert(0, os.path.dirname(HERE))
+        import beets.autotag.mb
+        import beets.library
+        from beets import config, plugins
+        import webimport
+
+        # Keep MusicBrainz out of it: the fake source is the only one.
+        beets.autotag.mb.match_album = lambda *args, **kwargs: iter(())
+        beets.autotag.mb.match_track = lambda *args, **kwargs: iter(())
+        beets.autotag.mb.album_for_id = lambda *args, **kwargs: None
+        beets.autotag.mb.track_for_id = lambda *args, **kwargs: None
+
+        config['directory'] = os.path.join(workdir, 'music')
+        config['import'].set({
+            'copy': False, 'move': False, 'write': False, 'resume': False,
+            'incremental': False, 'quiet': False, 'log': None,
+            'timid': mode == 'web',
+        })
+        latencies = []
+        plugins._classes.clear()
+        plugins._instances.clear()
+        plugins._classes.update([webimport.WebImportPlugin,
+                                 fake_source(truth, args.latency, latencies)])
+        plugin = [p for p in plugins.find_plugins()
+                  if isinstance(p, webimport.WebImportPlugin)][0]
+        plugin.config['prefetch']['workers'] = args.lookups
+
+        lib = beets.library.Library(os.path.join(workdir, 'library.db'),
+                                    config['directory'].as_filename())
+        plugin.setup(lib)
+        app = webimport.app
+
+        done = threading.Event()
+        reviewers = []
+        if mode == 'web':
+            for _ in range(args.reviewers):
+                thread = threading.Thread(target=review,
+                                          args=(app.test_client(), done))
+                thread.daemon = True
+                thread.start()
+                reviewers.append(thread)
+
+        start = time.time()
+        job = app.config['jobs'].submit(lib, [inbox], None)
+        while job.status in (job.QUEUED, job.RUNNING):
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        done.set()
+        for thread in reviewers:
+            thread.join()
+        app.config['jobs'].shutdown(10)
+        if job.status != job.FINISHED:
+            raise RuntimeError('import job {0}: {1}'.format(job.status,
+                                                           job.error))
+
+        imported = len(list(lib.albums()))
+        latencies.sort()
+        return {
+            'albums': imported,
+            'seconds': elapsed,
+            'albums_per_min': imported / elapsed * 60,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_rss_mb':
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regressions(result, baseline, tolerance):
+    """Return descriptions of the measurements that are worse than the
+    baseline by more than `tolerance`.
+    """
+    out = []
+    if result['albums_per_min'] < baseline['albums_per_min'] * (1 - tolerance):
+        out.append('albums/min {0:.1f} < {1:.1f}'.format(
+            result['albums_per_min'], baseline['albums_per_min']))
+    for key in ('p99_ms', 'peak_rss_mb'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            out.append('{0} {1:.1f} > {2:.1f}'.format(key, result[key],
+                                                      baseline[key]))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['auto', 'web', 'both'],
+                        default='both')
+    parser.add_argument('--albums', type=int, default=100)
+    parser.add_argument('--tracks', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the fake metadata source takes')
+    parser.add_argument('--lookups', type=int, default=2,
+                        help='parallel lookup workers')
+    parser.add_argument('--reviewers', type=int, default=2)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--save-baselines', action='store_true')
+    args = parser.parse_args()
+
+    # Each run needs a fresh process: beets and the plugin keep global
+    # state.
+    modes = ['auto', 'web'] if args.mode == 'both' else [args.mode]
+    if len(modes) > 1:
+        import subprocess
+        status = 0
+        for mode in modes:
+            status |= subprocess.call([sys.executable] + sys.argv +
+                                      ['--mode', mode])
+        sys.exit(status)
+    mode = modes[0]
+
+    result = run(mode, args)
+    print('{0}: {1} albums in {2:.1f}s, {3:.1f} albums/min, decision '
+          'p50 {4:.1f} ms, p99 {5:.1f} ms, peak RSS {6:.1f} MB'.format(
+              mode, result['albums'], result['seconds'],
+              result['albums_per_min'], result['p50_ms'], result['p99_ms'],
+              result['peak_rss_mb']))
+
+    with open(BASELINES) as f:
+        baselines = json.load(f)
+    key = '{0}-{1}x{2}-{3}ms'.format(mode, args.albums, args.tracks,
+                                     int(args.latency * 1000))
+    if args.save_baselines:
+        baselines[key] = result
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+        print('saved baseline {0}'.format(key))
+    elif key not in baselines:
+        print('no baseline for {0}'.format(key))
+    else:
+        problems = regressions(result, baselines[key], args.tolerance)
+        for problem in problems:
+            print('REGRESSION {0}: {1}'.format(key, problem))
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Fixtures for the webimport tests: a temporary beets configuration and
+library, a synthetic inbox of tagged MP3 files and a local metadata
+source standing in for MusicBrainz, driven through the web application.
+
+Run from the repository root with `python -m pytest tests`. Requires
+beets and mutagen, like the plugin itself.
+"""
+from __future__ import division, absolute_import, print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import beets.autotag.mb  # noqa: E402
+import beets.library  # noqa: E402
+from beets import config, plugins  # noqa: E402
+from beets.autotag import hooks  # noqa: E402
+from beets.plugins import BeetsPlugin  # noqa: E402
+
+import webimport  # noqa: E402
+from throughput import make_inbox  # noqa: E402
+
+# Seconds to wait for the import pipeline before failing a test.
+TIMEOUT = 20
+
+
+class FakeSource(object):
+    """Answers lookups from the tags the inbox was written with, and
+    records them. Lookups wait while `gate` is cleared.
+    """
+    def __init__(self):
+        self.truth = {}
+        self.lookups = []
+        self.running = 0
+        self.max_running = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self._lock = threading.Lock()
+
+    def album_candidates(self, items, album):
+        with self._lock:
+            self.lookups.append(album)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            self.gate.wait(TIMEOUT)
+            if album not in self.truth:
+                return []
+            artist, titles = self.truth[album]
+            tracks = [hooks.TrackInfo(
+                title, u'fake-track-{0}-{1}'.format(album, i),
+                artist=artist, length=items[0].length, index=i, medium=1,
+                medium_index=i, medium_total=len(titles),
+                data_source=u'Fake') for i, title in enumerate(titles, 1)]
+            return [hooks.AlbumInfo(album, u'fake-album-{0}'.format(album),
+                                    artist, u'fake-artist', tracks,
+                                    mediums=1, data_source=u'Fake')]
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def plugin(self):
+        """Return a plugin class looking up albums from this source.
+        """
+        source = self
+
+        class FakeSourcePlugin(BeetsPlugin):
+            def candidates(self, items, artist, album, va_likely):
+                return source.album_candidates(items, album)
+
+            def item_candidates(self, item, artist, title):
+                return []
+
+        return FakeSourcePlugin
+
+
+class Harness(object):
+    """A beets library and a webimport application set up in a temporary
+    directory, with helpers to drive imports through the HTTP API.
+    """
+    def __init__(self, workdir, monkeypatch):
+        self.workdir = workdir
+        self.inbox = os.path.join(workdir, 'inbox')
+        self.source = FakeSource()
+        self.lib = None
+        monkeypatch.setenv('BEETSDIR', workdir)
+
+        # Keep MusicBrainz out of it: the fake source is the only one.
+        for name in ('match_album', 'match_track'):
+            monkeypatch.setattr(beets.autotag.mb, name,
+                                lambda *args, **kwargs: iter(()))
+        for name in ('album_for_id', 'track_for_id'):
+            monkeypatch.setattr(beets.autotag.mb, name,
+                                lambda *args, **kwargs: None)
+
+        config.clear()
+        config.read(user=False, defaults=True)
+        config['directory'] = os.path.join(workdir, 'music')
+        config['import'].set({
+            'copy': False, 'move': False, 'write': False, 'resume': False,
+            'incremental': False, 'quiet': False, 'log': None,
+            'timid': True,
+        })
+
+    def make_inbox(self, albums, tracks=2):
+        """Write the inbox and return the album names, in order.
+        """
+        self.source.truth.update(make_inbox(self.inbox, albums, tracks))
+        return sorted(self.source.truth)
+
+    def setup(self, **plugin_config):
+        """Load the plugins and create the application's services, with
+        the given settings of the webimport configuration.
+        """
+        webimport.WebImportPlugin.listeners = None
+        webimport.WebImportPlugin._raw_listeners = None
+        plugins._classes.clear()
+        plugins._instances.clear()
+        plugins._classes.update([webimport.WebImportPlugin,
+                                 self.source.plugin()])
+        self.plugin = [p for p in plugins.find_plugins()
+                       if isinstance(p, webimport.WebImportPlugin)][0]
+        for key, value in plugin_config.items():
+            self.plugin.config[key].set(value)
+
+        if self.lib is None:
+            self.lib = beets.library.Library(
+                os.path.join(self.workdir, 'library.db'),
+                config['directory'].as_filename())
+        self.plugin.setup(self.lib)
+        self.app = webimport.app
+        self.client = self.app.test_client()
+        return self
+
+    def close(self):
+        jobs = webimport.app.config.get('jobs')
+        if jobs is not None:
+            jobs.drain(0)
+        events = webimport.app.config.get('events')
+        if events is not None:
+            events.close()
+
+    # HTTP helpers.
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response.status_code, json.loads(response.data)
+
+    def post(self, url, data):
+        response = self.client.post(url, data=json.dumps(data),
+                                    content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def submit(self, **data):
+        data.setdefault('paths', [self.inbox])
+        status, job = self.post('/imports', data)
+        assert status == 202, job
+        return self.app.config['jobs'].get(job['id'])
+
+    def tasks(self, query=u''):
+        status, out = self.get(u'/tasks?limit=500' + query)
+        assert status == 200, out
+        return out['tasks']
+
+    def wait_parked(self, count, query=u''):
+        """Wait until at least `count` tasks are parked and return them.
+        """
+        return wait_for(lambda: len(self.tasks(query)) >= count and
+                        self.tasks(query))
+
+    def wait_job(self, job):
+        wait_for(lambda: job.status not in (job.QUEUED, job.RUNNING))
+        return job.status
+
+    def albums(self):
+        return sorted(album.album for album in self.lib.albums())
+
+
+def wait_for(predicate, timeout=TIMEOUT):
+    """Poll `predicate` until it returns a true value, and return it.
+    """
+    deadline = time.time() + timeout
+    while True:
+        value = predicate()
+        if value:
+            return value
+        if time.time() > deadline:
+            raise AssertionError(u'timed out waiting')
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def harness(tmpdir, monkeypatch):
+    harness = Harness(str(tmpdir), monkeypatch)
+    yield harness
+    harness.close()
@@ -0,0 +1,47 @@
+"""Pausing the reading and lookup of albums while reviewers are behind.
+"""
+from __future__ import division, absolute_import, print_function
+
+import time
+
+from conftest import wait_for
+
+
+def test_full_stores_pause_the_pipeline(harness):
+    names = harness.make_inbox(6)
+    harness.setup(max_parked=2, prefetch={'depth': 1, 'workers': 1})
+    job = harness.submit()
+    harness.wait_parked(2)
+    wait_for(lambda: harness.get(u'/tasks/queue')[1]['waiting'])
+    time.sleep(0.2)
+    # A lookup under way when the store filled up may still park.
+    assert len(harness.tasks()) <= 3
+    assert len(harness.source.lookups) <= 3
+
+    decided = set()
+    while len(decided) < len(names):
+        tasks = [t for t in harness.wait_parked(1) if t['id'] not in decided]
+        if not tasks:
+            time.sleep(0.02)
+            continue
+        assert len(tasks) <= 3
+        harness.post(u'/tasks/decisions', {'decisions': [
+            {'task': t['id'], 'action': u'apply'} for t in tasks]})
+        decided.update(t['id'] for t in tasks)
+    assert harness.wait_job(job) == job.FINISHED
+    assert harness.albums() == names
+    assert sum(job.to_dict()['paused'].values()) > 0
+
+
+def test_paused_jobs_can_be_aborted(harness):
+    harness.make_inbox(4)
+    harness.setup(max_parked=1, prefetch={'depth': 1, 'workers': 1})
+    job = harness.submit()
+    harness.wait_parked(1)
+    wait_for(lambda: harness.get(u'/tasks/queue')[1]['waiting'])
+
+    response = harness.client.delete(u'/imports/{0}'.format(job.id))
+    assert response.status_code == 200
+    assert harness.wait_job(job) == job.ABORTED
+    wait_for(lambda: harness.get(u'/tasks/queue')[1]['waiting'] == {})
+    assert harness.albums() == []
@@ -0,0 +1,124 @@
+"""Describing the candidates of parked tasks, one medium at a time.
+"""
+from __future__ import division, absolute_import, print_function
+
+import beets.library
+import pytest
+from beets import autotag
+from beets.autotag import hooks
+
+import webimport
+
+
+def two_disc_match():
+    """Return an AlbumMatch of two mediums of two tracks each, whose
+    last track is missing, and with an item matching no track.
+    """
+    tracks = [hooks.TrackInfo(u'Track {0}'.format(i), u'track-{0}'.format(i),
+                              index=i, medium=(i + 1) // 2,
+                              medium_index=2 - i % 2, length=60.0)
+              for i in range(1, 5)]
+    info = hooks.AlbumInfo(u'Album', u'album', u'Artist', u'artist', tracks,
+                           mediums=2)
+    items = [beets.library.Item(title=t.title, track=t.medium_index,
+                                disc=t.medium, length=60.0,
+                                path=u'/inbox/{0}.mp3'.format(t.index)
+                                .encode('utf-8'))
+             for t in tracks[:3]]
+    stray = beets.library.Item(title=u'Bonus', disc=7, path=b'/inbox/7.mp3')
+    mapping = dict(zip(items, tracks))
+    distance = autotag.match.distance(items + [stray], info, mapping)
+    return autotag.AlbumMatch(distance, info, mapping, [stray], tracks[3:])
+
+
+def test_albums_are_described_one_medium_at_a_time():
+    match = two_disc_match()
+    first = webimport.candidate_detail(match, False)
+    assert first['pages'] == [1, 2]
+    assert first['next'] == 2
+    assert (first['tracks_total'], first['extra_tracks_total'],
+            first['extra_items_total']) == (4, 1, 1)
+    page = first['page']
+    assert [t['track']['title'] for t in page['tracks']] == \
+        [u'Track 1', u'Track 2']
+    # Items with no medium of their own go on the first page.
+    assert [i['title'] for i in page['extra_items']] == [u'Bonus']
+    assert page['extra_tracks'] == []
+
+    index = webimport.MediumIndex(match)
+    second = webimport.candidate_detail(match, False, index, 2)
+    assert second['next'] is None
+    page = second['page']
+    assert [t['track']['title'] for t in page['tracks']] == [u'Track 3']
+    assert [t['title'] for t in page['extra_tracks']] == [u'Track 4']
+    assert page['extra_items'] == []
+    with pytest.raises(KeyError):
+        webimport.candidate_detail(match, False, index, 3)
+
+
+def test_candidate_pages_over_http(harness):
+    harness.make_inbox(1, tracks=3)
+    harness.setup()
+    harness.submit()
+    task = harness.wait_parked(1)[0]
+    url = u'/tasks/{0}/candidates/0'.format(task['id'])
+
+    status, out = harness.get(url)
+    assert status == 200
+    assert (out['pages'], out['next']) == ([1], None)
+    assert len(out['page']['tracks']) == 3
+    assert harness.get(url + u'?medium=1')[1] == out
+    assert harness.get(url + u'?medium=2')[0] == 404
+    assert harness.get(u'/tasks/{0}/candidates/1'.format(task['id']))[0] \
+        == 404
+
+
+class Task(object):
+    cur_artist = u'Artist'
+    cur_album = u'Albun'
+
+
+class Pending(object):
+    kind = webimport.PendingTask.ALBUM
+    task = Task()
+
+    def __init__(self, task_id, match):
+        self.id = task_id
+        self.matches = [match]
+        self.calls = 0
+
+    def match(self, index):
+        self.calls += 1
+        match = self.matches[index]
+        return match, webimport.MediumIndex(match)
+
+
+def test_diffs_are_computed_once():
+    cache = webimport.DiffCache(capacity=2)
+    first = Pending(u'first', two_disc_match())
+    second = Pending(u'second', two_disc_match())
+
+    diff = cache.get(first, 0)
+    assert diff['album'] == [[u'equal', u'Albu'], [u'delete', u'n'],
+                             [u'insert', u'm']]
+    assert diff['medium']['missing'] == []
+    assert cache.get(first, 0) is diff
+    assert cache.get(first, 0, 2)['medium']['missing'][0]['title'] == \
+        u'Track 4'
+    assert first.calls == 2
+    with pytest.raises(IndexError):
+        cache.get(first, 1)
+    with pytest.raises(KeyError):
+        cache.get(first, 0, 3)
+
+    # The least recently viewed diff goes first.
+    cache.get(first, 0)
+    cache.get(second, 0)
+    cache.get(first, 0)
+    assert first.calls == 4
+    cache.get(first, 0, 2)
+    assert first.calls == 5
+
+    cache.forget(first)
+    cache.get(first, 0)
+    assert first.calls == 6
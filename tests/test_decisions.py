@@ -0,0 +1,247 @@
+"""Parking tasks, deciding them over HTTP and leasing them to
+reviewers.
+"""
+from __future__ import division, absolute_import, print_function
+
+import random
+import time
+
+import webimport
+from conftest import wait_for
+
+
+def album_of(task):
+    return task['path'].rsplit(u' - ', 1)[1]
+
+
+def test_park_decide_apply(harness):
+    names = harness.make_inbox(2)
+    harness.setup()
+    job = harness.submit()
+
+    tasks = harness.wait_parked(2)
+    assert sorted(album_of(t) for t in tasks) == names
+    assert all(t['kind'] == u'album' and t['candidates'] == 1
+               for t in tasks)
+    assert all(t['job'] == job.id for t in tasks)
+
+    by_album = dict((album_of(t), t['id']) for t in tasks)
+    status, out = harness.post(
+        u'/tasks/{0}/decision'.format(by_album[names[0]]),
+        {'action': u'apply', 'candidate': 0})
+    assert status == 200, out
+    status, out = harness.post(
+        u'/tasks/{0}/decision'.format(by_album[names[1]]),
+        {'action': u'skip'})
+    assert status == 200, out
+
+    assert harness.wait_job(job) == job.FINISHED
+    assert harness.albums() == [names[0]]
+    assert harness.tasks() == []
+    album = list(harness.lib.albums())[0]
+    assert album.mb_albumid == u'fake-album-{0}'.format(names[0])
+
+
+def test_rejected_decisions_keep_the_task_parked(harness):
+    harness.make_inbox(1)
+    harness.setup()
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    url = u'/tasks/{0}/decision'.format(task['id'])
+
+    assert harness.post(url, {'candidate': 5})[0] == 400
+    assert harness.post(url, {'action': u'dance'})[0] == 400
+    assert harness.post(url, [u'apply'])[0] == 400
+    assert harness.post(u'/tasks/nope/decision', {})[0] == 404
+    assert [t['id'] for t in harness.tasks()] == [task['id']]
+
+    assert harness.post(url, {'action': u'asis'})[0] == 200
+    assert harness.wait_job(job) == job.FINISHED
+    assert len(harness.albums()) == 1
+
+
+def test_bulk_decisions(harness):
+    names = harness.make_inbox(4)
+    harness.setup()
+    job = harness.submit()
+    tasks = dict((album_of(t), t['id']) for t in harness.wait_parked(4))
+
+    status, out = harness.post(u'/tasks/decisions', {'decisions': [
+        {'task': tasks[names[0]], 'action': u'apply'},
+        {'task': tasks[names[1]], 'action': u'asis'},
+        {'task': tasks[names[2]], 'action': u'skip'},
+        {'task': u'nope', 'action': u'apply'},
+        {'task': 5},
+        {'action': u'apply'},
+        {'task': tasks[names[3]], 'action': u'apply', 'candidate': 3},
+        {'task': tasks[names[3]], 'action': u'apply', 'candidate': True},
+    ]})
+    assert status == 200, out
+    assert [r['status'] for r in out['results']] == [
+        u'resolved', u'resolved', u'resolved', u'error', u'error',
+        u'error', u'error', u'error',
+    ]
+    assert [t['id'] for t in harness.tasks()] == [tasks[names[3]]]
+
+    # Decisions are taken once.
+    status, out = harness.post(u'/tasks/decisions', {'decisions': [
+        {'task': tasks[names[0]], 'action': u'skip'},
+        {'task': tasks[names[3]], 'action': u'apply'},
+    ]})
+    assert [r['status'] for r in out['results']] == [u'error', u'resolved']
+
+    assert harness.post(u'/tasks/decisions', {'decisions': u'all'})[0] \
+        == 400
+    assert harness.wait_job(job) == job.FINISHED
+    assert harness.albums() == [names[0], names[1], names[3]]
+
+
+def test_leases(harness):
+    harness.make_inbox(3)
+    harness.setup()
+    job = harness.submit()
+    harness.wait_parked(3)
+
+    status, out = harness.post(u'/tasks/claim',
+                               {'reviewer': u'alice', 'count': 2})
+    assert status == 200, out
+    alice = [t['id'] for t in out['tasks']]
+    assert len(alice) == 2
+    assert all(t['reviewer'] == u'alice' for t in out['tasks'])
+
+    status, out = harness.post(u'/tasks/claim',
+                               {'reviewer': u'bob', 'count': 2})
+    bob = [t['id'] for t in out['tasks']]
+    assert len(bob) == 1 and bob[0] not in alice
+    assert harness.post(u'/tasks/claim', {'reviewer': u'bob',
+                                          'count': True})[0] == 400
+    assert harness.post(u'/tasks/claim', {'reviewer': u'bob',
+                                          'ttl': True})[0] == 400
+
+    # Leased tasks only take the decisions of their reviewer.
+    url = u'/tasks/{0}/decision'.format(alice[0])
+    assert harness.post(url, {'action': u'skip'})[0] == 409
+    assert harness.post(url, {'action': u'skip', 'reviewer': u'bob'})[0] \
+        == 409
+    assert harness.post(url, {'action': u'skip',
+                              'reviewer': u'alice'})[0] == 200
+
+    status, out = harness.post(u'/tasks/release', {'reviewer': u'alice'})
+    assert out == {'released': 1}
+    status, out = harness.post(u'/tasks/claim',
+                               {'reviewer': u'bob', 'count': 5})
+    assert sorted(t['id'] for t in out['tasks']) == sorted(bob + alice[1:])
+    assert harness.app.config['decisions'].leases == {
+        u'bob': set(bob + alice[1:])}
+
+    # Expired leases can be claimed by somebody else.
+    harness.post(u'/tasks/claim', {'reviewer': u'bob', 'count': 5,
+                                   'ttl': 0.05})
+    time.sleep(0.1)
+    status, out = harness.post(u'/tasks/claim',
+                               {'reviewer': u'carol', 'count': 5})
+    carol = [t['id'] for t in out['tasks']]
+    assert sorted(carol) == sorted(bob + alice[1:])
+
+    status, out = harness.post(u'/tasks/decisions', {
+        'reviewer': u'carol',
+        'decisions': [{'task': task_id, 'action': u'skip'}
+                      for task_id in carol],
+    })
+    assert [r['status'] for r in out['results']] == [u'resolved'] * 2
+    assert harness.wait_job(job) == job.FINISHED
+    wait_for(lambda: harness.app.config['decisions'].leases == {})
+
+
+class Pending(object):
+    """The attributes of a parked task that the task index reads.
+    """
+    def __init__(self, number, rng):
+        self.id = u'{0:04d}'.format(number)
+        self.kind = u'item' if number % 25 == 0 else u'album'
+        self.rec_name = u'medium'
+        self.data_source = u'Fake'
+        self.has_duplicates = number % 3 == 0
+        self.distance = None if number % 10 == 0 else rng.random()
+        self.created = rng.random()
+        self.path = u'/inbox/{0}'.format(self.id)
+
+
+def sort_key(sort):
+    if sort == u'distance':
+        return lambda p: (webimport.NO_DISTANCE if p.distance is None
+                          else p.distance, p.created, p.id)
+    return lambda p: (p.created, p.id)
+
+
+def expected(pendings, kind=None, has_duplicates=None, path=None,
+             min_distance=None, max_distance=None, sort=u'age',
+             descending=False):
+    matching = [p for p in pendings if
+                (kind is None or p.kind in kind) and
+                (has_duplicates is None or
+                 p.has_duplicates == has_duplicates) and
+                (path is None or p.path.startswith(path))]
+    if min_distance is not None:
+        matching = [p for p in matching if p.distance is not None and
+                    min_distance <= p.distance <= max_distance]
+    return [p.id for p in sorted(matching, key=sort_key(sort),
+                                 reverse=descending)]
+
+
+def page_through(index, **filters):
+    ids, after = [], None
+    while True:
+        page, after = index.query(after=after, limit=7, **filters)
+        ids += page
+        if after is None:
+            return ids
+
+
+def test_task_index_pages():
+    rng = random.Random(0)
+    pendings = [Pending(n, rng) for n in range(300)]
+    index = webimport.TaskIndex()
+    for pending in pendings:
+        index.add(pending)
+
+    # Filters leaving most tasks walk the range of the sort index, the
+    # others sort the few tasks they leave.
+    for filters in ({}, {'kind': [u'item']}, {'path': u'/inbox/01'},
+                    {'has_duplicates': True}, {'has_duplicates': False},
+                    {'kind': [u'album'], 'has_duplicates': False},
+                    {'min_distance': 0.2, 'max_distance': 0.6},
+                    {'kind': [u'item'], 'min_distance': 0.0,
+                     'max_distance': 0.5}):
+        for sort in (u'age', u'distance'):
+            for descending in (False, True):
+                assert page_through(index, sort=sort, descending=descending,
+                                    **filters) == \
+                    expected(pendings, sort=sort, descending=descending,
+                             **filters)
+
+    for pending in pendings[::2]:
+        index.remove(pending)
+    del pendings[::2]
+    assert sorted(index.keys) == [p.id for p in pendings]
+    assert page_through(index, kind=[u'item'], sort=u'distance') == \
+        expected(pendings, kind=[u'item'], sort=u'distance')
+
+
+def test_listing_pages_over_http(harness):
+    names = harness.make_inbox(5)
+    harness.setup()
+    harness.submit()
+    harness.wait_parked(5)
+
+    seen, cursor = [], u''
+    while cursor is not None:
+        status, out = harness.get(u'/tasks?limit=2&order=desc&cursor=' +
+                                  cursor)
+        assert status == 200 and len(out['tasks']) <= 2
+        seen += out['tasks']
+        cursor = out['next']
+    assert sorted(album_of(t) for t in seen) == names
+    created = [t['created'] for t in seen]
+    assert created == sorted(created, reverse=True)
+    assert harness.get(u'/tasks?cursor=garbage')[0] == 400
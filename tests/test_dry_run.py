@@ -0,0 +1,110 @@
+"""Streaming the plan of dry runs.
+"""
+from __future__ import division, absolute_import, print_function
+
+import json
+import logging
+import os
+
+from beets import config
+
+import webimport
+
+
+def lines(response):
+    return [json.loads(line) for line in response.data.splitlines()]
+
+
+def test_plan_resumes_after_disconnect(harness, monkeypatch):
+    monkeypatch.setattr(webimport, 'PLAN_BUFFER', 2)
+    harness.make_inbox(6)
+    harness.setup()
+    job = harness.submit(dry_run=True)
+    url = u'/imports/{0}/plan'.format(job.id)
+
+    response = harness.client.get(url, buffered=False)
+    stream = iter(response.response)
+    first = [json.loads(next(stream)) for _ in range(3)]
+    assert harness.client.get(url).status_code == 409
+    response.close()
+    assert not job.streaming
+
+    rest = lines(harness.client.get(url + u'?offset=3'))
+    assert job.status == job.FINISHED
+    assert len(first + rest) == 6
+    assert len(set(entry['paths'][0] for entry in first + rest)) == 6
+    assert harness.albums() == []
+
+    # The last entries streamed stay buffered, until the plan expires.
+    assert lines(harness.client.get(url + u'?offset=5')) == rest[-1:]
+    assert harness.client.get(url + u'?offset=0').status_code == 410
+    assert harness.client.get(url + u'?offset=7').status_code == 400
+    job.expire()
+    assert harness.client.get(url + u'?offset=6').status_code == 410
+
+
+def test_unread_dry_runs_are_aborted(harness, monkeypatch):
+    monkeypatch.setattr(webimport, 'PLAN_BUFFER', 1)
+    harness.make_inbox(3)
+    harness.setup(dry_run={'idle_timeout': 0.1})
+    job = harness.submit(dry_run=True)
+    assert harness.wait_job(job) == job.ABORTED
+    assert job.planned == 1
+
+
+def test_plan_lists_the_duplicates_removed(harness):
+    config['import']['copy'] = True
+    config['import']['duplicate_action'] = u'remove'
+    harness.make_inbox(1)
+    harness.setup()
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+    assert harness.wait_job(job) == job.FINISHED
+    album = list(harness.lib.albums())[0]
+    paths = sorted(item.path.decode('utf-8') for item in album.items())
+
+    job = harness.submit(dry_run=True)
+    plan = lines(harness.client.get(u'/imports/{0}/plan'.format(job.id)))
+    assert harness.wait_job(job) == job.FINISHED
+    assert [entry['action'] for entry in plan] == [u'apply']
+    assert plan[0]['duplicates'] == [
+        {'id': album.id, 'action': u'remove', 'paths': paths}]
+    assert [a.id for a in harness.lib.albums()] == [album.id]
+
+
+class LogRecords(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_plan_destinations(harness, monkeypatch):
+    log = logging.getLogger('beets')
+    records = LogRecords()
+    monkeypatch.setattr(log, 'handlers', log.handlers + [records])
+    # The level of the beets logger is per thread, and this one may
+    # already have its own.
+    monkeypatch.setattr(log, 'default_level', logging.INFO)
+    monkeypatch.setattr(log, 'level', logging.INFO)
+    config['import']['copy'] = True
+    harness.make_inbox(1, tracks=2)
+    harness.setup()
+    job = harness.submit(dry_run=True)
+    plan = lines(harness.client.get(u'/imports/{0}/plan'.format(job.id)))
+    assert harness.wait_job(job) == job.FINISHED
+
+    music = config['directory'].as_filename().decode('utf-8')
+    items = plan[0]['items']
+    assert plan[0]['operation'] == u'copy'
+    assert [os.path.basename(i['source']) for i in items] == \
+        [os.path.basename(i['destination']) for i in items]
+    assert all(i['destination'].startswith(music) for i in items)
+    assert not any(os.path.exists(i['destination']) for i in items)
+    # The plan goes to the client only.
+    assert records.messages
+    assert not any(music in message for message in records.messages)
@@ -0,0 +1,80 @@
+"""Putting imported files in place.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+import threading
+import time
+
+from beets import config
+from beets.util import FilesystemError
+
+import webimport
+
+
+def test_failed_moves_keep_the_library_in_line(harness, monkeypatch):
+    config['import']['move'] = True
+    harness.make_inbox(1, tracks=3)
+    harness.setup(file_ops={'workers': 3})
+    music = config['directory'].as_filename()
+
+    place = webimport.FileScheduler._place
+
+    def fail_second_track(self, mode, source, dest, device, write):
+        if os.path.basename(source).startswith(b'02 '):
+            raise FilesystemError(u'disk full', mode, (source, dest))
+        return place(self, mode, source, dest, device, write)
+
+    monkeypatch.setattr(webimport.FileScheduler, '_place',
+                        fail_second_track)
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+    assert harness.wait_job(job) == job.FAILED
+    assert u'disk full' in job.error
+
+    items = dict((item.track, item) for item in harness.lib.items())
+    assert sorted(items) == [1, 2, 3]
+    for track, item in items.items():
+        item.load()
+        assert os.path.exists(item.path)
+        assert item.path.startswith(harness.inbox.encode('utf-8')) == \
+            (track == 2)
+        assert item.path.startswith(music) == (track != 2)
+
+
+def test_operations_are_bounded_per_device(tmpdir, monkeypatch):
+    source, dest = tmpdir.mkdir('inbox'), tmpdir.mkdir('music')
+    ops = []
+    for i in range(6):
+        source.join('{0}.mp3'.format(i)).write('x' * (i + 1))
+        ops.append(webimport.FileOp(str(source.join('{0}.mp3'.format(i))),
+                                    str(dest.join('{0}.mp3'.format(i))),
+                                    u'copy'))
+    ops.append(webimport.FileOp(ops[0].source, ops[0].source, u'copy'))
+
+    lock = threading.Lock()
+    running = [0, 0]
+    place = webimport.FileScheduler._place
+
+    def slow_place(self, *args):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return place(self, *args)
+
+    monkeypatch.setattr(webimport.FileScheduler, '_place', slow_place)
+    scheduler = webimport.FileScheduler(4, 2, reflink=False, hardlink=True)
+    results = scheduler.run(ops)
+    # Both directories are on the same device.
+    assert running[1] == 2
+    assert results == [(u'hardlink', i + 1) for i in range(6)] + [(None, 0)]
+    assert all(os.path.samefile(op.source, op.dest) for op in ops)
+    # Copies whose tags get written are not linked to their sources.
+    os.remove(ops[0].dest)
+    assert scheduler.run(ops[:1], write=True) == [(u'copy', 1)]
+    assert not os.path.samefile(ops[0].source, ops[0].dest)
@@ -0,0 +1,67 @@
+"""The persistent cache of the items read from media files.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+
+import beets.library
+
+import webimport
+
+
+def first_track(harness):
+    directory = os.path.join(harness.inbox, sorted(os.listdir(
+        harness.inbox))[0])
+    return os.path.join(directory, sorted(os.listdir(directory))[0]) \
+        .encode('utf-8')
+
+
+def test_items_round_trip(harness, tmpdir):
+    harness.make_inbox(1)
+    path = first_track(harness)
+    cache = webimport.ItemCache(str(tmpdir.join('items.db')), 1 << 20)
+    assert cache.get(path) is None
+
+    read = beets.library.Item.from_path(path)
+    read.mood = u'calm'
+    cache.put(path, read)
+    item = cache.get(path)
+    assert item is not read
+    # Unset fields come back as their null value.
+    assert all(item[key] == value for key, value in read.items()
+               if value is not None)
+    assert item.mood == u'calm' and item._db is None
+
+    # Rebuilt items are added to the library like freshly read ones.
+    lib = beets.library.Library(':memory:')
+    lib.add(item)
+    stored = lib.get_item(item.id)
+    assert (stored.title, stored.path, stored.mood) == \
+        (read.title, path, u'calm')
+    assert stored.added > 0
+
+    # Changed files are read again.
+    os.utime(path, (0, 0))
+    assert cache.get(path) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stale'],
+            stats['entries']) == (1, 1, 1, 0)
+
+
+def test_least_recently_used_items_are_evicted(harness, tmpdir):
+    harness.make_inbox(3, tracks=1)
+    paths = [os.path.join(root, name).encode('utf-8')
+             for root, _, names in sorted(os.walk(harness.inbox))
+             for name in names]
+    item = beets.library.Item.from_path(paths[0])
+    cache = webimport.ItemCache(str(tmpdir.join('items.db')), 1 << 20)
+    cache.put(paths[0], item)
+    size = cache.stats()['size']
+
+    cache = webimport.ItemCache(cache.path, size * 2)
+    cache.put(paths[1], item)
+    cache.get(paths[0])
+    cache.put(paths[2], item)
+    assert cache.get(paths[1]) is None
+    assert cache.get(paths[0]) is not None
+    assert cache.stats()['entries'] == 2
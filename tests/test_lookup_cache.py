@@ -0,0 +1,119 @@
+"""The persistent cache of metadata lookups.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+import threading
+import time
+
+import pytest
+
+import webimport
+
+
+def open_cache(tmpdir, ttl=3600, max_size=1 << 20):
+    return webimport.LookupCache(str(tmpdir.join('lookups.db')), ttl,
+                                 max_size)
+
+
+def test_lookups_are_cached_across_restarts(tmpdir):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'answer': 42}
+
+    cache = open_cache(tmpdir)
+    assert cache.lookup(u'key', compute) == {'answer': 42}
+    assert cache.lookup(u'key', compute) == {'answer': 42}
+    assert len(calls) == 1
+
+    cache = open_cache(tmpdir)
+    assert cache.lookup(u'key', compute) == {'answer': 42}
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 0, 1)
+
+
+def test_entries_expire(tmpdir):
+    cache = open_cache(tmpdir, ttl=0.05)
+    cache.put(u'key', u'value')
+    assert cache.get(u'key') == u'value'
+    time.sleep(0.1)
+    assert cache.get(u'key') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+    value = u'x' * 1000
+    cache = open_cache(tmpdir, max_size=2500)
+    cache.put(u'a', value)
+    time.sleep(0.01)
+    cache.put(u'b', value)
+    time.sleep(0.01)
+    cache.get(u'a')
+    time.sleep(0.01)
+    cache.put(u'c', value)
+
+    assert cache.get(u'b') is None
+    assert cache.get(u'a') == value
+    assert cache.get(u'c') == value
+    assert cache.stats()['size'] <= 2500
+
+
+def test_identical_lookups_are_coalesced(tmpdir):
+    cache = open_cache(tmpdir)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return u'value'
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.lookup(u'key', compute)))
+        for _ in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.stats()['coalesced'] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [u'value'] * 3
+    assert len(calls) == 1
+
+
+def test_failed_lookups_are_not_cached(tmpdir):
+    cache = open_cache(tmpdir)
+
+    def fail():
+        raise ValueError(u'source down')
+
+    with pytest.raises(ValueError):
+        cache.lookup(u'key', fail)
+    assert cache.lookup(u'key', lambda: u'value') == u'value'
+
+
+def test_reimports_are_served_from_the_cache(harness):
+    harness.make_inbox(2)
+    harness.setup()
+    for _ in range(2):
+        job = harness.submit()
+        tasks = harness.wait_parked(2)
+        assert all(t['candidates'] == 1 for t in tasks)
+        harness.post(u'/tasks/decisions', {'decisions': [
+            {'task': t['id'], 'action': u'skip'} for t in tasks]})
+        assert harness.wait_job(job) == job.FINISHED
+
+    assert len(harness.source.lookups) == 2
+    stats = harness.app.config['lookup_cache'].stats()
+    assert (stats['hits'], stats['entries']) == (2, 2)
+    assert os.path.exists(os.path.join(harness.workdir,
+                                       'webimport_lookups.db'))
@@ -0,0 +1,64 @@
+"""The metrics of the import pipeline served at /metrics.
+"""
+from __future__ import division, absolute_import, print_function
+
+from beets import config
+
+
+def samples(harness):
+    response = harness.client.get(u'/metrics')
+    assert response.status_code == 200
+    out = {}
+    for line in response.data.decode('utf-8').splitlines():
+        if line and not line.startswith(u'#'):
+            name, value = line.rsplit(u' ', 1)
+            out[name] = float(value)
+    return out
+
+
+def import_once(harness):
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+    assert harness.wait_job(job) == job.FINISHED
+
+
+def test_pipeline_metrics(harness):
+    config['import']['copy'] = True
+    config['import']['duplicate_action'] = u'skip'
+    harness.make_inbox(1, tracks=2)
+    harness.setup()
+    import_once(harness)
+    import_once(harness)
+
+    metrics = samples(harness)
+    assert metrics[u'webimport_jobs{status="finished"}'] == 2
+    # The second lookup is served from the cache, and not timed.
+    assert metrics[u'webimport_lookup_seconds_count{data_source="Fake"}'] \
+        == 1
+    assert metrics[u'webimport_lookup_cache_total{result="hit"}'] == 1
+    assert metrics[u'webimport_decision_seconds_count{mode="human"}'] == 2
+    # Duplicates are counted whatever resolves them.
+    assert metrics[u'webimport_duplicates_total{action="skip"}'] == 1
+    assert metrics[u'webimport_files_placed_total{method="copy"}'] == 2
+    assert metrics[u'webimport_stage_tasks_total{stage="manipulate"}'] > 0
+    assert metrics[u'webimport_phase_seconds_total'
+                   u'{phase="choose",clock="wall"}'] > 0
+
+
+def test_rule_sweeps_are_labelled(harness):
+    harness.make_inbox(2)
+    harness.setup()
+    job = harness.submit()
+    harness.wait_parked(2)
+    response = harness.client.put(
+        u'/rules', data=u'[{"max_distance": 0.5, "action": "apply"}]',
+        content_type='application/json')
+    assert response.status_code == 200
+    assert harness.wait_job(job) == job.FINISHED
+    assert len(harness.albums()) == 2
+
+    metrics = samples(harness)
+    assert metrics[u'webimport_decision_seconds_count{mode="rule"}'] == 2
+    assert u'webimport_decision_seconds_count{mode="human"}' not in metrics
@@ -0,0 +1,84 @@
+"""Looking up the next tasks while earlier ones wait for a decision.
+"""
+from __future__ import division, absolute_import, print_function
+
+import threading
+import time
+
+import pytest
+
+import webimport
+from conftest import wait_for
+
+
+class Session(object):
+    aborted = False
+
+    def check_abort(self):
+        if self.aborted:
+            raise webimport.importer.ImportAbort()
+
+
+class Task(object):
+    def __init__(self, candidates=()):
+        self.candidates = list(candidates)
+
+
+def test_window_holds_depth_tasks():
+    window = webimport.PrefetchWindow(2, 1 << 20)
+    session = Session()
+    first, second = Task(), Task()
+    window.acquire(session)
+    window.charge(first)
+    window.acquire(session)
+    window.charge(second)
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (window.acquire(session),
+                                              acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+    window.release(first)
+    assert acquired.wait(5)
+    thread.join()
+
+    # Tasks are only released once.
+    window.release(first)
+    assert window.stats()['tasks'] == 2
+
+
+def test_window_stops_abandoned_lookups():
+    window = webimport.PrefetchWindow(1, 1 << 20)
+    session = Session()
+    window.acquire(session)
+    window.abandon()
+    window.acquire(session)
+
+    session.aborted = True
+    with pytest.raises(webimport.importer.ImportAbort):
+        window.acquire(session)
+
+
+def test_lookups_run_ahead_up_to_depth(harness):
+    names = harness.make_inbox(6)
+    harness.setup(prefetch={'depth': 2, 'workers': 4})
+    harness.source.gate.clear()
+    job = harness.submit()
+
+    wait_for(lambda: len(harness.source.lookups) == 2)
+    time.sleep(0.2)
+    assert len(harness.source.lookups) == 2
+    assert job.to_dict()['prefetch']['tasks'] == 2
+
+    # Parked tasks give their slot back: every album gets looked up
+    # before any is decided.
+    harness.source.gate.set()
+    tasks = harness.wait_parked(6)
+    assert sorted(harness.source.lookups) == names
+    assert harness.source.max_running == 2
+    assert job.to_dict()['prefetch']['tasks'] == 0
+
+    harness.post(u'/tasks/decisions', {'decisions': [
+        {'task': t['id'], 'action': u'apply'} for t in tasks]})
+    assert harness.wait_job(job) == job.FINISHED
+    assert harness.albums() == names
@@ -0,0 +1,62 @@
+"""Sampling the stacks of the server's threads at /debug/profile.
+"""
+from __future__ import division, absolute_import, print_function
+
+import pstats
+import threading
+import time
+
+import pytest
+
+import webimport
+
+
+def spin(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def spinning():
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,))
+    thread.start()
+    yield
+    stop.set()
+    thread.join()
+
+
+def test_folded_stacks(harness, spinning):
+    harness.setup()
+    response = harness.client.get(
+        u'/debug/profile?seconds=0.2&interval=0.01&format=folded')
+    assert response.status_code == 200
+    assert u'.folded' in response.headers['Content-Disposition']
+    lines = response.data.decode('utf-8').splitlines()
+    spins = [line for line in lines
+             if line.split(u' ')[0].endswith(u'test_profile.py:spin')]
+    assert len(spins) == 1
+    assert int(spins[0].rsplit(u' ', 1)[1]) > 1
+
+
+def test_pstats(harness, spinning, tmpdir):
+    harness.setup()
+    response = harness.client.get(u'/debug/profile?seconds=0.2')
+    assert response.status_code == 200
+    path = tmpdir.join('profile.prof')
+    path.write(response.data, mode='wb')
+
+    stats = pstats.Stats(str(path)).stats
+    (calls, _, _, cumulative, callers), = [
+        stat for func, stat in stats.items() if func[2] == 'spin']
+    assert calls > 1 and cumulative > 0
+    assert [func[2] for func in callers] == ['run']
+
+
+def test_bad_requests(harness):
+    harness.setup()
+    assert harness.get(u'/debug/profile?seconds=0')[0] == 400
+    assert harness.get(u'/debug/profile?seconds=1000')[0] == 400
+    assert harness.get(u'/debug/profile?format=svg')[0] == 400
+    with webimport._profile_lock:
+        assert harness.get(u'/debug/profile?seconds=0.1')[0] == 409
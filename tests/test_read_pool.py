@@ -0,0 +1,46 @@
+"""Reading the library through a pool of read-only connections.
+"""
+from __future__ import division, absolute_import, print_function
+
+import sqlite3
+
+import pytest
+
+import webimport
+
+
+def test_connections_are_read_only_and_bounded(harness):
+    harness.setup()
+    pool = webimport.ReadPool(harness.lib.path, size=2, timeout=0.05)
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM albums').fetchone()[0] == 0
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO albums (album) VALUES ('x')")
+
+        with pool.connection() as other:
+            assert other is not conn
+            with pytest.raises(webimport.PoolTimeout):
+                with pool.connection():
+                    pass
+    # Connections go back to the pool.
+    with pool.connection() as again:
+        assert again in (conn, other)
+
+    stats = pool.stats()
+    assert (stats['created'], stats['in_use'], stats['acquisitions'],
+            stats['timeouts']) == (2, 0, 3, 1)
+
+
+def test_library_listings_read_through_the_pool(harness):
+    names = harness.make_inbox(2)
+    harness.setup()
+    job = harness.submit()
+    tasks = harness.wait_parked(2)
+    harness.post(u'/tasks/decisions', {'decisions': [
+        {'task': t['id'], 'action': u'apply'} for t in tasks]})
+    assert harness.wait_job(job) == job.FINISHED
+
+    status, out = harness.get(u'/library/albums?q=' + names[1])
+    assert [a['album'] for a in out['albums']] == names[1:]
+    status, out = harness.get(u'/library/pool')
+    assert out['acquisitions'] >= 1 and out['in_use'] == 0
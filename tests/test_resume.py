@@ -0,0 +1,114 @@
+"""Resuming the jobs a server was stopped in the middle of.
+"""
+from __future__ import division, absolute_import, print_function
+
+import json
+import os
+
+from beets import config
+
+import webimport
+from conftest import wait_for
+from test_decisions import album_of
+
+
+def records(path, record_type):
+    with open(path) as f:
+        return [r for r in map(json.loads, f) if r['type'] == record_type]
+
+
+def test_resume_skips_done_tasks(harness):
+    names = harness.make_inbox(3)
+    path = os.path.join(harness.workdir, 'checkpoints.jsonl')
+    checkpoints = {'enabled': True, 'path': path}
+    # Without the lookup cache, every lookup reaches the source.
+    harness.setup(checkpoints=checkpoints, lookup_cache={'max_size': 0})
+    job = harness.submit()
+    tasks = dict((album_of(t), t['id']) for t in harness.wait_parked(3))
+
+    harness.post(u'/tasks/{0}/decision'.format(tasks[names[0]]),
+                 {'action': u'apply'})
+    wait_for(lambda: records(path, u'done'))
+    # Stop the server with the other tasks still parked.
+    harness.app.config['jobs'].drain(0)
+    assert job.status == job.ABORTED
+    assert harness.albums() == [names[0]]
+    assert records(path, u'end') == []
+
+    harness.setup(checkpoints=checkpoints, lookup_cache={'max_size': 0})
+    resumed = harness.app.config['jobs'].resume(harness.lib)
+    assert [j.id for j in resumed] == [job.id]
+    tasks = harness.wait_parked(2)
+    assert sorted(album_of(t) for t in tasks) == names[1:]
+    assert sorted(harness.source.lookups) == sorted(names + names[1:])
+
+    harness.post(u'/tasks/decisions', {'decisions': [
+        {'task': t['id'], 'action': u'apply'} for t in tasks]})
+    assert harness.wait_job(resumed[0]) == job.FINISHED
+    assert harness.albums() == names
+    # The end of the job is logged once its status is set.
+    wait_for(lambda: records(path, u'end'))
+    assert webimport.CheckpointStore(path).jobs == {}
+
+
+def test_finished_jobs_are_not_resumed(harness):
+    harness.make_inbox(1)
+    path = os.path.join(harness.workdir, 'checkpoints.jsonl')
+    checkpoints = {'enabled': True, 'path': path}
+    harness.setup(checkpoints=checkpoints)
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'skip'})
+    assert harness.wait_job(job) == job.FINISHED
+    wait_for(lambda: records(path, u'end'))
+
+    harness.setup(checkpoints=checkpoints)
+    assert harness.app.config['jobs'].resume(harness.lib) == []
+
+
+class Job(object):
+    id = u'job'
+
+
+def test_syncs_are_grouped(tmpdir):
+    store = webimport.CheckpointStore(str(tmpdir.join('checkpoints.jsonl')),
+                                      sync_interval=3600, sync_records=3)
+    store.record(u'job', Job(), query=None, watch=False, paths=[])
+    assert store.syncs == 1
+    for key in u'ab':
+        store.record(u'done', Job(), key=key)
+    assert store.syncs == 1
+    store.record(u'done', Job(), key=u'c')
+    assert store.syncs == 2
+    store.sync()
+    assert store.syncs == 2
+
+    # Unsynced records are still written.
+    store.record(u'done', Job(), key=u'd')
+    store = webimport.CheckpointStore(store.path)
+    assert store.jobs[u'job'].done == set(u'abcd')
+
+
+def test_resumed_paths_keep_their_bytes(harness):
+    names = harness.make_inbox(1)
+    inbox = harness.inbox.encode('utf-8') + b'-\xff'
+    os.rename(harness.inbox, inbox)
+    # Telling hidden files apart needs UTF-8 paths.
+    config['ignore_hidden'] = False
+    path = os.path.join(harness.workdir, 'checkpoints.jsonl')
+    checkpoints = {'enabled': True, 'path': path}
+    harness.setup(checkpoints=checkpoints)
+    job = webimport.ImportJob(harness.lib, [inbox], None)
+    harness.app.config['checkpoints'].record(
+        u'job', job, query=None, watch=False,
+        paths=[webimport.dump_path(inbox)])
+
+    harness.setup(checkpoints=checkpoints)
+    resumed = harness.app.config['jobs'].resume(harness.lib)
+    assert resumed[0].paths == [inbox]
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+    assert harness.wait_job(resumed[0]) == job.FINISHED
+    assert harness.albums() == names
@@ -0,0 +1,58 @@
+"""Deciding parked tasks with auto-decision rules.
+"""
+from __future__ import division, absolute_import, print_function
+
+import pytest
+from beets import importer, ui
+
+import webimport
+from webimport import PendingTask
+
+
+class Pending(object):
+    def __init__(self, kind, distance=None, penalties=(), tracks=10,
+                 formats=(u'mp3',), data_source=u'musicbrainz'):
+        self.kind = kind
+        self.facts = None if kind == PendingTask.DUPLICATE else \
+            webimport.TaskFacts(
+                rec=u'medium', distance=distance, penalties=set(penalties),
+                data_source=data_source, media=u'cd', country=u'us',
+                tracks=tracks, formats=set(formats))
+
+
+def test_first_rule_met_decides():
+    policy = webimport.Policy([
+        {'action': u'ask', 'penalties': [u'Tracks']},
+        {'action': u'apply', 'max_distance': 0.1,
+         'data_source': u'MusicBrainz'},
+        {'action': u'asis', 'min_distance': 0.5, 'format': [u'MP3']},
+        {'action': u'skip', 'max_tracks': 1},
+    ])
+    close = Pending(PendingTask.ALBUM, 0.05)
+    far = Pending(PendingTask.ALBUM, 0.8)
+    lossless = Pending(PendingTask.ALBUM, 0.8, formats=[u'flac'])
+    missing = Pending(PendingTask.ALBUM, 0.05, penalties=[u'tracks'])
+    single = Pending(PendingTask.ITEM, None, tracks=1, formats=[u'flac'])
+    unmatched = Pending(PendingTask.ALBUM, None)
+    duplicate = Pending(PendingTask.DUPLICATE)
+
+    decided = policy.decide_all([close, far, lossless, missing, single,
+                                 unmatched, duplicate])
+    # "ask" rules leave their tasks to reviewers, and no rule applies a
+    # task without candidates.
+    assert decided == [
+        (close, importer.action.APPLY),
+        (far, importer.action.ASIS),
+        (single, importer.action.SKIP),
+        (unmatched, importer.action.ASIS),
+    ]
+
+
+@pytest.mark.parametrize('spec', [
+    {'action': u'dance'},
+    {'action': u'apply', 'loudness': 3},
+    {'action': u'apply', 'max_distance': u'close'},
+])
+def test_invalid_rules_are_rejected(spec):
+    with pytest.raises(ui.UserError):
+        webimport.Policy([spec])
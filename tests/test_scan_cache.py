@@ -0,0 +1,60 @@
+"""Leaving the albums imported before out of later scans of an inbox.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+
+from beets import config
+
+
+def import_all(harness, count):
+    job = harness.submit()
+    if count:
+        tasks = harness.wait_parked(count)
+        harness.post(u'/tasks/decisions', {'decisions': [
+            {'task': t['id'], 'action': u'apply'} for t in tasks]})
+    assert harness.wait_job(job) == job.FINISHED
+    return job.to_dict()['unchanged']
+
+
+def unchanged_events(harness):
+    return [e.data['paths'] for e in harness.app.config['events'].since(0)
+            if e.type == u'unchanged']
+
+
+def test_unchanged_albums_are_skipped_and_reported(harness):
+    config['import']['copy'] = True
+    config['import']['duplicate_action'] = u'keep'
+    names = harness.make_inbox(2)
+    harness.setup(scan_cache={'enabled': True}, lookup_cache={'max_size': 0})
+    assert import_all(harness, 2) == 0
+    assert import_all(harness, 0) == 2
+    assert len(harness.source.lookups) == 2
+    dirs = sorted(os.listdir(harness.inbox))
+    assert sorted(os.path.basename(paths[0])
+                  for paths in unchanged_events(harness)) == dirs
+
+    # A changed album is imported again, and stamped again.
+    with open(os.path.join(harness.inbox, dirs[0], 'cover.jpg'), 'w') as f:
+        f.write('cover')
+    assert import_all(harness, 1) == 1
+    assert sorted(harness.source.lookups) == sorted(names + names[:1])
+    assert import_all(harness, 0) == 2
+
+
+def test_library_reimports_bypass_the_cache(harness):
+    config['import']['copy'] = True
+    harness.make_inbox(1)
+    harness.setup(scan_cache={'enabled': True})
+    import_all(harness, 1)
+
+    job = harness.submit(paths=[config['directory'].as_filename()])
+    harness.wait_parked(1)
+    assert job.to_dict()['unchanged'] == 0
+    assert unchanged_events(harness) == []
+
+
+def test_the_cache_is_off_by_default(harness):
+    harness.make_inbox(1)
+    harness.setup()
+    assert harness.app.config['scan_cache'] is None
@@ -0,0 +1,74 @@
+"""Spilling the items and candidates of parked tasks to disk.
+"""
+from __future__ import division, absolute_import, print_function
+
+import beets.library
+import pytest
+from beets import autotag
+from beets.autotag import hooks
+
+import webimport
+
+
+def album_match(items):
+    tracks = [hooks.TrackInfo(item.title, u'track-{0}'.format(i), index=i)
+              for i, item in enumerate(items, 1)]
+    info = hooks.AlbumInfo(u'Album', u'album', u'Artist', u'artist', tracks)
+    return autotag.AlbumMatch(0.1, info, dict(zip(items[1:], tracks[1:])),
+                              items[:1], [])
+
+
+def test_store_rehydrates_items_and_candidates(tmpdir):
+    lib = beets.library.Library(':memory:')
+    stored = beets.library.Item(title=u'stored', path=b'/music/a.mp3')
+    lib.add(stored)
+    stored.title = u'retagged'
+    new = beets.library.Item(title=u'new', path=b'/inbox/b.mp3')
+    new.foo = u'flexible'
+    store = webimport.CandidateStore(str(tmpdir.join('spill.db')), 1)
+    store.put(u'task', [stored, new], [album_match([stored, new])])
+
+    items, candidates, mediums = store.get(u'task', lib)
+    assert [(i.id, i.title, i.path) for i in items] == \
+        [(1, u'retagged', b'/music/a.mp3'), (None, u'new', b'/inbox/b.mp3')]
+    # Library items stay attached and only store what changed.
+    assert items[0]._db is lib and items[0]._dirty == set(['title'])
+    assert items[1]._db is None and items[1].foo == u'flexible'
+    match = candidates[0]
+    assert match.extra_items == items[:1]
+    assert list(match.mapping) == items[1:]
+    assert match.info.tracks[1].title == u'new'
+    assert mediums == {}
+
+    # The last task read stays loaded.
+    assert store.get(u'task', lib)[0] is items
+    store.put(u'other', [new], [])
+    store.get(u'other', lib)
+    assert store.get(u'task', lib)[0] is not items
+    assert store.stats()['reads'] == 3
+
+    store.delete(u'task')
+    with pytest.raises(KeyError):
+        store.get(u'task', lib)
+
+
+def test_parked_tasks_hold_no_items(harness):
+    names = harness.make_inbox(1, tracks=3)
+    harness.setup()
+    job = harness.submit()
+    task = harness.wait_parked(1)[0]
+    pending = harness.app.config['decisions'].get(task['id'])
+    assert pending.spilled
+    assert (pending.task.items, pending.task.candidates) == ([], [])
+
+    status, out = harness.get(u'/tasks/{0}'.format(task['id']))
+    assert (out['album'], out['items']) == (names[0], 3)
+    status, out = harness.get(
+        u'/tasks/{0}/candidates/0/diff'.format(task['id']))
+    assert status == 200 and len(out['medium']['tracks']) == 3
+
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+    assert harness.wait_job(job) == job.FINISHED
+    assert harness.albums() == names
+    assert len(harness.lib.items()) == 3
@@ -0,0 +1,55 @@
+"""Reading the tags of media files on a pool of threads.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+import threading
+import time
+
+import webimport
+
+
+class Reader(object):
+    """Stands in for `read_item`, recording how many reads overlap.
+    """
+    def __init__(self):
+        self.running = self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self._lock:
+            self.running -= 1
+        if path.endswith(b'.txt'):
+            return None
+        return os.path.basename(path)
+
+
+def test_reads_are_bounded_per_device(tmpdir):
+    paths = []
+    for name in (u'a', u'b'):
+        directory = tmpdir.mkdir(name)
+        paths += [str(directory.join(u'{0}.mp3'.format(i))) for i in range(4)]
+    paths.append(str(tmpdir.join(u'a', u'notes.txt')))
+
+    reader = Reader()
+    tags = webimport.TagReader(workers=4, per_device=2)
+    items = tags.read(reader, paths)
+    # Unreadable files are left out, and the order is kept.
+    assert items == [os.path.basename(p) for p in paths[:-1]]
+    # Both directories are on the same device.
+    assert reader.max_running == 2
+    stats = tags.stats()
+    assert (stats['files'], stats['workers']) == (9, 4)
+    assert stats['files_per_second'] > 0
+
+
+def test_a_single_worker_reads_in_the_calling_thread(tmpdir):
+    reader = Reader()
+    tags = webimport.TagReader(workers=1, per_device=2)
+    paths = [str(tmpdir.join(u'{0}.mp3'.format(i))) for i in range(3)]
+    assert tags.read(reader, paths) == [u'0.mp3', u'1.mp3', u'2.mp3']
+    assert reader.max_running == 1
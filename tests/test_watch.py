@@ -0,0 +1,49 @@
+"""Watching inboxes for albums that settle in them.
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+
+from beets import config, importer
+
+import webimport
+from conftest import wait_for
+from test_resume import records
+
+
+def test_albums_are_ready_once_settled(harness):
+    harness.make_inbox(2)
+    watcher = webimport.InboxWatcher(10)
+    inbox = harness.inbox.encode('utf-8')
+    assert watcher.poll([inbox], now=0) == []
+    assert watcher.poll([inbox], now=9) == []
+    ready = watcher.poll([inbox], now=10)
+    assert len(ready) == 2
+    assert all(toppath == inbox for toppath, _, _, _ in ready)
+    # Albums are handed out once per stamp.
+    assert watcher.poll([inbox], now=20) == []
+
+    # A changed album settles again.
+    dirs = ready[0][1]
+    with open(os.path.join(dirs[0], b'cover.jpg'), 'w') as f:
+        f.write('cover')
+    assert watcher.poll([inbox], now=20) == []
+    assert [r[1] for r in watcher.poll([inbox], now=30)] == [dirs]
+    assert watcher.stats() == {'polls': 6, 'found': 3, 'settling': 0}
+
+
+def test_watch_jobs_drop_the_progress_of_done_batches(harness):
+    config['import']['resume'] = True
+    harness.make_inbox(1)
+    path = os.path.join(harness.workdir, 'checkpoints.jsonl')
+    harness.setup(watch={'interval': 0.1, 'settle': 0},
+                  checkpoints={'enabled': True, 'path': path})
+    job = harness.app.config['jobs'].watch(harness.lib, [harness.inbox])
+    task = harness.wait_parked(1)[0]
+    harness.post(u'/tasks/{0}/decision'.format(task['id']),
+                 {'action': u'apply'})
+
+    # The progress of the album is saved before it is checkpointed.
+    wait_for(lambda: records(path, u'done'))
+    wait_for(lambda: importer.progress_read() == {})
+    assert job.status == job.RUNNING
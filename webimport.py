@@ -2,24 +2,77 @@
 
 from __future__ import division, absolute_import, print_function
 
+import base64
+import bisect
+import difflib
+import errno
+import fnmatch
+import hashlib
+import itertools
+import json
+import marshal
 import os
-from collections import namedtuple, Counter
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import namedtuple, defaultdict, Counter, OrderedDict, deque
+from contextlib import contextmanager
 from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from beets import ui
-from beets.ui import print_, input_, decargs, show_path_changes
+from beets.ui import decargs
 import beets.library
 from beets import autotag
 from beets.autotag import hooks
 from beets.autotag import Recommendation
 from beets import plugins
 from beets.util import syspath, normpath, displayable_path
+from beets.util import bytestring_path, ancestry
+from beets.util import mkdirall, prune_dirs, samefile, unique_path
+from beets.util import FilesystemError, hidden
+from beets.util import pipeline
 from beets import config
 from beets import importer
 from beets import logging
 from beets.plugins import BeetsPlugin
 
-from flask import Flask
+from flask import Flask, g, request, jsonify, Response
 
 
 # Plugin hook.
@@ -31,12 +84,86 @@ class WebImportPlugin(BeetsPlugin):
             'host': u'127.0.0.1',
             'port': 8337,
             'cors': '',
+            'server': {
+                'mode': u'development',
+                'threads': 32,
+                'keepalive': True,
+                'timeout': 30,
+                'shutdown_timeout': 300,
+            },
+            'workers': 2,
+            'max_parked': 1000,
+            'lease_ttl': 300,
+            'spill': {
+                'enabled': True,
+                'path': u'',
+                'loaded': 64,
+            },
+            'event_buffer': 10000,
+            'lookup_cache': {
+                'path': u'',
+                'ttl': 7 * 24 * 3600,
+                'max_size': 64 * 1024 * 1024,
+            },
+            'prefetch': {
+                'depth': 16,
+                'workers': 2,
+                'max_memory': 256 * 1024 * 1024,
+            },
+            'rules': [],
+            'diff_cache': 256,
+            'read_pool': {
+                'size': 4,
+                'timeout': 5.0,
+                'wal': False,
+            },
+            'scan_cache': {
+                'enabled': False,
+                'path': u'',
+            },
+            'watch': {
+                'interval': 30,
+                'settle': 60,
+            },
+            'dry_run': {
+                'idle_timeout': 300,
+                'ttl': 3600,
+            },
+            'tag_reading': {
+                'workers': 8,
+                'per_device': 4,
+            },
+            'item_cache': {
+                'path': u'',
+                'max_size': 128 * 1024 * 1024,
+            },
+            'file_ops': {
+                'workers': 4,
+                'per_device': 2,
+                'reflink': True,
+                'hardlink': False,
+                'fsync': True,
+            },
+            'checkpoints': {
+                'enabled': True,
+                'path': u'',
+                'sync_interval': 1.0,
+                'sync_records': 100,
+            },
         })
+        self.register_listener('import_task_created',
+                               self.import_task_created)
+        self.register_listener('import_task_start', self.import_task_start)
+        self.register_listener('import_task_choice', self.import_task_choice)
+        self.register_listener('import_task_apply', self.import_task_apply)
 
     def commands(self):
         cmd = ui.Subcommand('webimport', help=u'start a Web interface to manage imports')
         cmd.parser.add_option(u'-d', u'--debug', action='store_true',
                               default=False, help=u'debug mode')
+        cmd.parser.add_option(u'-w', u'--watch', action='append',
+                              default=[], metavar='DIR',
+                              help=u'import the albums that appear in DIR')
 
         def func(lib, opts, args):
             args = ui.decargs(args)
@@ -45,7 +172,15 @@ class WebImportPlugin(BeetsPlugin):
             if args:
                 self.config['port'] = int(args.pop(0))
 
-            app.config['lib'] = lib
+            self.setup(lib)
+            # Pick up the jobs left unfinished by the last run, then
+            # watch the inboxes given on the command line.
+            resumed = app.config['jobs'].resume(lib)
+            watched = set(progress_key([p]) for job in resumed
+                          if job.watch for p in job.paths)
+            paths = [p for p in opts.watch if progress_key([p]) not in watched]
+            if paths:
+                app.config['jobs'].watch(lib, paths)
             # Enable CORS if required.
             if self.config['cors']:
                 self._log.info(u'Enabling CORS with origin: {0}',
@@ -57,12 +192,176 @@ class WebImportPlugin(BeetsPlugin):
                 }
                 CORS(app)
             # Start the web application.
-            app.run(host=self.config['host'].get(unicode),
-                    port=self.config['port'].get(int),
-                    debug=opts.debug, threaded=True)
+            mode = self.config['server']['mode'].as_choice(
+                [u'development', u'production'])
+            if mode == u'production' and not opts.debug:
+                self.serve(self.config['host'].get(unicode),
+                           self.config['port'].get(int))
+            else:
+                app.run(host=self.config['host'].get(unicode),
+                        port=self.config['port'].get(int),
+                        debug=opts.debug, threaded=True)
         cmd.func = func
         return [cmd]
 
+    def setup(self, lib):
+        """Create the services the web application and the import
+        sessions share, for a library.
+        """
+        app.config['lib'] = lib
+        app.config['jobs'] = JobManager(self.config['workers'].get(int))
+        app.config['decisions'] = DecisionStore(
+            self.config['max_parked'].get(int), self.candidate_store(),
+            self.config['lease_ttl'].as_number())
+        app.config['events'] = EventBus(
+            self.config['event_buffer'].get(int))
+        app.config['metrics'] = ImportMetrics()
+        app.config['lookup_cache'] = self.lookup_cache()
+        app.config['scan_cache'] = self.scan_cache()
+        app.config['item_cache'] = self.item_cache()
+        app.config['checkpoints'] = self.checkpoints()
+        reader_config = self.config['tag_reading']
+        app.config['tag_reader'] = TagReader(
+            reader_config['workers'].get(int),
+            reader_config['per_device'].get(int),
+        )
+        file_config = self.config['file_ops']
+        app.config['file_ops'] = FileScheduler(
+            file_config['workers'].get(int),
+            file_config['per_device'].get(int),
+            file_config['reflink'].get(bool),
+            file_config['hardlink'].get(bool),
+            file_config['fsync'].get(bool),
+        )
+        app.config['policy'] = Policy(self.config['rules'].get(list))
+        app.config['diffs'] = DiffCache(self.config['diff_cache'].get(int))
+        pool_config = self.config['read_pool']
+        app.config['read_pool'] = ReadPool(
+            lib.path, pool_config['size'].get(int),
+            pool_config['timeout'].as_number(),
+            pool_config['wal'].get(bool),
+        )
+
+    def serve(self, host, port):
+        """Serve the application with a production WSGI server until
+        SIGINT or SIGTERM, then drain the import jobs and stop.
+        """
+        try:
+            from cheroot import wsgi
+        except ImportError:
+            raise ui.UserError(u'the production server mode requires '
+                               u'the cheroot package')
+        server_config = self.config['server']
+        server = wsgi.Server(
+            (host, port), app,
+            numthreads=server_config['threads'].get(int),
+            timeout=server_config['timeout'].get(int),
+        )
+        if not server_config['keepalive'].get(bool):
+            # HTTP/1.0 closes the connection after every response.
+            server.protocol = 'HTTP/1.0'
+
+        thread = threading.Thread(target=server.start,
+                                  name='webimport-server')
+        thread.daemon = True
+        thread.start()
+        self._log.info(u'serving on {0}:{1}', host, port)
+
+        stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        while not stopping.is_set() and thread.is_alive():
+            stopping.wait(1.0)
+
+        # Keep answering requests while the running imports finish, so
+        # that reviewers can still decide their pending tasks.
+        self._log.info(u'shutting down: draining import jobs')
+        app.config['jobs'].drain(server_config['shutdown_timeout'].get(int))
+        # Event streams would keep their worker threads until they time
+        # out.
+        app.config['events'].close()
+        server.stop()
+
+    def lookup_cache(self):
+        """Open the configured lookup cache, or return None if it is
+        disabled.
+        """
+        cache_config = self.config['lookup_cache']
+        max_size = cache_config['max_size'].get(int)
+        if not max_size:
+            return None
+        path = cache_config['path'].get(unicode) or \
+            os.path.join(config.config_dir(), u'webimport_lookups.db')
+        return LookupCache(syspath(normpath(path)),
+                           cache_config['ttl'].get(int), max_size)
+
+    def scan_cache(self):
+        """Open the configured scan cache, or return None if it is
+        disabled.
+        """
+        cache_config = self.config['scan_cache']
+        if not cache_config['enabled'].get(bool):
+            return None
+        path = cache_config['path'].get(unicode) or \
+            os.path.join(config.config_dir(), u'webimport_scans.db')
+        return ScanCache(syspath(normpath(path)))
+
+    def candidate_store(self):
+        """Open the configured store for the candidates of parked tasks,
+        or return None to keep them in memory.
+        """
+        spill_config = self.config['spill']
+        if not spill_config['enabled'].get(bool):
+            return None
+        path = spill_config['path'].get(unicode) or \
+            os.path.join(config.config_dir(), u'webimport_parked.db')
+        return CandidateStore(syspath(normpath(path)),
+                              spill_config['loaded'].get(int))
+
+    def item_cache(self):
+        """Open the configured item cache, or return None if it is
+        disabled.
+        """
+        cache_config = self.config['item_cache']
+        max_size = cache_config['max_size'].get(int)
+        if not max_size:
+            return None
+        path = cache_config['path'].get(unicode) or \
+            os.path.join(config.config_dir(), u'webimport_items.db')
+        return ItemCache(syspath(normpath(path)), max_size)
+
+    def checkpoints(self):
+        """Open the configured checkpoint log, or return None if it is
+        disabled.
+        """
+        ckpt_config = self.config['checkpoints']
+        if not ckpt_config['enabled'].get(bool):
+            return None
+        path = ckpt_config['path'].get(unicode) or \
+            os.path.join(config.config_dir(), u'webimport_checkpoints.jsonl')
+        return CheckpointStore(syspath(normpath(path)),
+                               ckpt_config['sync_interval'].as_number(),
+                               ckpt_config['sync_records'].get(int))
+
+    def import_task_created(self, session, task):
+        if isinstance(session, WebImportSession):
+            session.emit(u'task-discovered', task)
+
+    def import_task_start(self, session, task):
+        # Lookups are the slow part of a session: give aborted jobs a
+        # chance to stop before every one of them.
+        if isinstance(session, WebImportSession):
+            session.check_abort()
+
+    def import_task_choice(self, session, task):
+        if isinstance(session, WebImportSession):
+            session.task_chosen(task)
+
+    def import_task_apply(self, session, task):
+        if isinstance(session, WebImportSession):
+            session.emit(u'applied', task, candidate=candidate_summary(
+                task.match, not task.is_album))
+
 
 app = Flask(__name__)
 
@@ -105,250 +404,17 @@ def disambig_string(info):
         return u', '.join(disambig)
 
 
-def dist_string(dist):
-    """Formats a distance (a float) as a colorized similarity percentage
-    string.
-    """
-    out = u'%.1f%%' % ((1 - dist) * 100)
-    if dist <= config['match']['strong_rec_thresh'].as_number():
-        out = ui.colorize('text_success', out)
-    elif dist <= config['match']['medium_rec_thresh'].as_number():
-        out = ui.colorize('text_warning', out)
-    else:
-        out = ui.colorize('text_error', out)
-    return out
-
-
-def penalty_string(distance, limit=None):
-    """Returns a colorized string that indicates all the penalties
-    applied to a distance object.
+def penalty_keys(distance):
+    """Return the readable names of the penalties applied to a distance
+    object.
     """
-    penalties = []
+    keys = []
     for key in distance.keys():
         key = key.replace('album_', '')
         key = key.replace('track_', '')
         key = key.replace('_', ' ')
-        penalties.append(key)
-    if penalties:
-        if limit and len(penalties) > limit:
-            penalties = penalties[:limit] + ['...']
-        return ui.colorize('text_warning', u'(%s)' % ', '.join(penalties))
-
-
-def show_change(cur_artist, cur_album, match):
-    """Print out a representation of the changes that will be made if an
-    album's tags are changed according to `match`, which must be an AlbumMatch
-    object.
-    """
-    def show_album(artist, album):
-        if artist:
-            album_description = u'    %s - %s' % (artist, album)
-        elif album:
-            album_description = u'    %s' % album
-        else:
-            album_description = u'    (unknown album)'
-        print_(album_description)
-
-    def format_index(track_info):
-        """Return a string representing the track index of the given
-        TrackInfo or Item object.
-        """
-        if isinstance(track_info, hooks.TrackInfo):
-            index = track_info.index
-            medium_index = track_info.medium_index
-            medium = track_info.medium
-            mediums = match.info.mediums
-        else:
-            index = medium_index = track_info.track
-            medium = track_info.disc
-            mediums = track_info.disctotal
-        if config['per_disc_numbering']:
-            if mediums > 1:
-                return u'{0}-{1}'.format(medium, medium_index)
-            else:
-                return unicode(medium_index)
-        else:
-            return unicode(index)
-
-    # Identify the album in question.
-    if cur_artist != match.info.artist or \
-            (cur_album != match.info.album and
-                     match.info.album != VARIOUS_ARTISTS):
-        artist_l, artist_r = cur_artist or '', match.info.artist
-        album_l,  album_r = cur_album or '', match.info.album
-        if artist_r == VARIOUS_ARTISTS:
-            # Hide artists for VA releases.
-            artist_l, artist_r = u'', u''
-
-        artist_l, artist_r = ui.colordiff(artist_l, artist_r)
-        album_l, album_r = ui.colordiff(album_l, album_r)
-
-        print_(u"Correcting tags from:")
-        show_album(artist_l, album_l)
-        print_(u"To:")
-        show_album(artist_r, album_r)
-    else:
-        print_(u"Tagging:\n    {0.artist} - {0.album}".format(match.info))
-
-    # Data URL.
-    if match.info.data_url:
-        print_(u'URL:\n    %s' % match.info.data_url)
-
-    # Info line.
-    info = []
-    # Similarity.
-    info.append(u'(Similarity: %s)' % dist_string(match.distance))
-    # Penalties.
-    penalties = penalty_string(match.distance)
-    if penalties:
-        info.append(penalties)
-    # Disambiguation.
-    disambig = disambig_string(match.info)
-    if disambig:
-        info.append(ui.colorize('text_highlight_minor', u'(%s)' % disambig))
-    print_(' '.join(info))
-
-    # Tracks.
-    pairs = list(match.mapping.items())
-    pairs.sort(key=lambda item_and_track_info: item_and_track_info[1].index)
-
-    # Build up LHS and RHS for track difference display. The `lines` list
-    # contains ``(lhs, rhs, width)`` tuples where `width` is the length (in
-    # characters) of the uncolorized LHS.
-    lines = []
-    medium = disctitle = None
-    for item, track_info in pairs:
-
-        # Medium number and title.
-        if medium != track_info.medium or disctitle != track_info.disctitle:
-            media = match.info.media or 'Media'
-            if match.info.mediums > 1 and track_info.disctitle:
-                lhs = u'%s %s: %s' % (media, track_info.medium,
-                                      track_info.disctitle)
-            elif match.info.mediums > 1:
-                lhs = u'%s %s' % (media, track_info.medium)
-            elif track_info.disctitle:
-                lhs = u'%s: %s' % (media, track_info.disctitle)
-            else:
-                lhs = None
-            if lhs:
-                lines.append((lhs, u'', 0))
-            medium, disctitle = track_info.medium, track_info.disctitle
-
-        # Titles.
-        new_title = track_info.title
-        if not item.title.strip():
-            # If there's no title, we use the filename.
-            cur_title = displayable_path(os.path.basename(item.path))
-            lhs, rhs = cur_title, new_title
-        else:
-            cur_title = item.title.strip()
-            lhs, rhs = ui.colordiff(cur_title, new_title)
-        lhs_width = len(cur_title)
-
-        # Track number change.
-        cur_track, new_track = format_index(item), format_index(track_info)
-        if cur_track != new_track:
-            if item.track in (track_info.index, track_info.medium_index):
-                color = 'text_highlight_minor'
-            else:
-                color = 'text_highlight'
-            templ = ui.colorize(color, u' (#{0})')
-            lhs += templ.format(cur_track)
-            rhs += templ.format(new_track)
-            lhs_width += len(cur_track) + 4
-
-        # Length change.
-        if item.length and track_info.length and \
-                        abs(item.length - track_info.length) > \
-                        config['ui']['length_diff_thresh'].as_number():
-            cur_length = ui.human_seconds_short(item.length)
-            new_length = ui.human_seconds_short(track_info.length)
-            templ = ui.colorize('text_highlight', u' ({0})')
-            lhs += templ.format(cur_length)
-            rhs += templ.format(new_length)
-            lhs_width += len(cur_length) + 3
-
-        # Penalties.
-        penalties = penalty_string(match.distance.tracks[track_info])
-        if penalties:
-            rhs += ' %s' % penalties
-
-        if lhs != rhs:
-            lines.append((u' * %s' % lhs, rhs, lhs_width))
-        elif config['import']['detail']:
-            lines.append((u' * %s' % lhs, '', lhs_width))
-
-    # Print each track in two columns, or across two lines.
-    col_width = (ui.term_width() - len(''.join([' * ', ' -> ']))) // 2
-    if lines:
-        max_width = max(w for _, _, w in lines)
-        for lhs, rhs, lhs_width in lines:
-            if not rhs:
-                print_(lhs)
-            elif max_width > col_width:
-                print_(u'%s ->\n   %s' % (lhs, rhs))
-            else:
-                pad = max_width - lhs_width
-                print_(u'%s%s -> %s' % (lhs, ' ' * pad, rhs))
-
-    # Missing and unmatched tracks.
-    if match.extra_tracks:
-        print_(u'Missing tracks ({0}/{1} - {2:.1%}):'.format(
-            len(match.extra_tracks),
-            len(match.info.tracks),
-            len(match.extra_tracks) / len(match.info.tracks)
-        ))
-    for track_info in match.extra_tracks:
-        line = u' ! %s (#%s)' % (track_info.title, format_index(track_info))
-        if track_info.length:
-            line += u' (%s)' % ui.human_seconds_short(track_info.length)
-        print_(ui.colorize('text_warning', line))
-    if match.extra_items:
-        print_(u'Unmatched tracks ({0}):'.format(len(match.extra_items)))
-    for item in match.extra_items:
-        line = u' ! %s (#%s)' % (item.title, format_index(item))
-        if item.length:
-            line += u' (%s)' % ui.human_seconds_short(item.length)
-        print_(ui.colorize('text_warning', line))
-
-
-def show_item_change(item, match):
-    """Print out the change that would occur by tagging `item` with the
-    metadata from `match`, a TrackMatch object.
-    """
-    cur_artist, new_artist = item.artist, match.info.artist
-    cur_title, new_title = item.title, match.info.title
-
-    if cur_artist != new_artist or cur_title != new_title:
-        cur_artist, new_artist = ui.colordiff(cur_artist, new_artist)
-        cur_title, new_title = ui.colordiff(cur_title, new_title)
-
-        print_(u"Correcting track tags from:")
-        print_(u"    %s - %s" % (cur_artist, cur_title))
-        print_(u"To:")
-        print_(u"    %s - %s" % (new_artist, new_title))
-
-    else:
-        print_(u"Tagging track: %s - %s" % (cur_artist, cur_title))
-
-    # Data URL.
-    if match.info.data_url:
-        print_(u'URL:\n    %s' % match.info.data_url)
-
-    # Info line.
-    info = []
-    # Similarity.
-    info.append(u'(Similarity: %s)' % dist_string(match.distance))
-    # Penalties.
-    penalties = penalty_string(match.distance)
-    if penalties:
-        info.append(penalties)
-    # Disambiguation.
-    disambig = disambig_string(match.info)
-    if disambig:
-        info.append(ui.colorize('text_highlight_minor', u'(%s)' % disambig))
-    print_(' '.join(info))
+        keys.append(key)
+    return keys
 
 
 def summarize_items(items, singleton):
@@ -388,13 +454,19 @@ def summarize_items(items, singleton):
     return u', '.join(summary_parts)
 
 
-def _summary_judgment(rec):
+def _summary_judgment(rec, candidates=(), items=()):
     """Determines whether a decision should be made without even asking
-    the user. This occurs in quiet mode and when an action is chosen for
-    NONE recommendations. Return an action or None if the user should be
-    queried. May also print to the console if a summary judgment is
-    made.
+    the user. This occurs when one of the auto-decision rules applies to
+    the task, in quiet mode and when an action is chosen for NONE
+    recommendations. Return an action or None if the user should be
+    queried.
     """
+    policy = app.config.get('policy')
+    rule = policy.decide(task_facts(candidates, rec, items)) \
+        if policy else None
+    if rule is not None:
+        return rule.action
+
     if config['import']['quiet']:
         if rec == Recommendation.strong:
             return importer.action.APPLY
@@ -414,27 +486,18 @@ def _summary_judgment(rec):
     else:
         return None
 
-    if action == importer.action.SKIP:
-        print_(u'Skipping.')
-    elif action == importer.action.ASIS:
-        print_(u'Importing as-is.')
     return action
 
 
-def choose_candidate(candidates, singleton, rec, cur_artist=None,
-                     cur_album=None, item=None, itemcount=None,
-                     extra_choices=[]):
-    """Given a sorted list of candidates, ask the user for a selection
-    of which candidate to use. Applies to both full albums and
-    singletons  (tracks). Candidates are either AlbumMatch or TrackMatch
-    objects depending on `singleton`. for albums, `cur_artist`,
-    `cur_album`, and `itemcount` must be provided. For singletons,
-    `item` must be provided.
+def choose_candidate(candidates, singleton, decision, extra_choices=[]):
+    """Given a sorted list of candidates and the `Decision` posted for
+    the task, return the choice it stands for. Applies to both full
+    albums and singletons (tracks). Candidates are either AlbumMatch or
+    TrackMatch objects depending on `singleton`.
 
     `extra_choices` is a list of `PromptChoice`s, containg the choices
     appended by the plugins after receiving the `before_choose_candidate`
-    event. If not empty, the choices are appended to the prompt presented
-    to the user.
+    event.
 
     Returns one of the following:
     * the result of the choice, which may be SKIP, ASIS, TRACKS, or MANUAL
@@ -442,448 +505,3713 @@ def choose_candidate(candidates, singleton, rec, cur_artist=None,
     * the short letter of a `PromptChoice` (if the user selected one of
     the `extra_choices`).
     """
-    # Sanity check.
-    if singleton:
-        assert item is not None
-    else:
-        assert cur_artist is not None
-        assert cur_album is not None
-
-    # Build helper variables for extra choices.
-    extra_opts = tuple(c.long for c in extra_choices)
     extra_actions = tuple(c.short for c in extra_choices)
 
-    # Zero candidates.
-    if not candidates:
-        if singleton:
-            print_(u"No matching recordings found.")
-            opts = (u'Use as-is', u'Skip', u'Enter search', u'enter Id',
-                    u'aBort')
-        else:
-            print_(u"No matching release found for {0} tracks."
-                   .format(itemcount))
-            print_(u'For help, see: '
-                   u'http://beets.readthedocs.org/en/latest/faq.html#nomatch')
-            opts = (u'Use as-is', u'as Tracks', u'Group albums', u'Skip',
-                    u'Enter search', u'enter Id', u'aBort')
-        sel = ui.input_options(opts + extra_opts)
-        if sel == u'u':
-            return importer.action.ASIS
-        elif sel == u't':
-            assert not singleton
-            return importer.action.TRACKS
-        elif sel == u'e':
-            return importer.action.MANUAL
-        elif sel == u's':
-            return importer.action.SKIP
-        elif sel == u'b':
-            raise importer.ImportAbort()
-        elif sel == u'i':
-            return importer.action.MANUAL_ID
-        elif sel == u'g':
-            return importer.action.ALBUMS
-        elif sel in extra_actions:
-            return sel
-        else:
-            assert False
+    sel = decision.sel
+    if sel == u's':
+        return importer.action.SKIP
+    elif sel == u'u':
+        return importer.action.ASIS
+    elif sel == u'e':
+        return importer.action.MANUAL
+    elif sel == u't':
+        assert not singleton
+        return importer.action.TRACKS
+    elif sel == u'b':
+        raise importer.ImportAbort()
+    elif sel == u'i':
+        return importer.action.MANUAL_ID
+    elif sel == u'g':
+        return importer.action.ALBUMS
+    elif sel in extra_actions:
+        return sel
+    else:  # Numerical selection.
+        return candidates[sel - 1]
 
-    # Is the change good enough?
-    bypass_candidates = False
-    if rec != Recommendation.none:
-        match = candidates[0]
-        bypass_candidates = True
-
-    while True:
-        # Display and choose from candidates.
-        require = rec <= Recommendation.low
-
-        if not bypass_candidates:
-            # Display list of candidates.
-            print_(u'Finding tags for {0} "{1} - {2}".'.format(
-                u'track' if singleton else u'album',
-                item.artist if singleton else cur_artist,
-                item.title if singleton else cur_album,
-            ))
 
-            print_(u'Candidates:')
-            for i, match in enumerate(candidates):
-                # Index, metadata, and distance.
-                line = [
-                    u'{0}.'.format(i + 1),
-                    u'{0} - {1}'.format(
-                        match.info.artist,
-                        match.info.title if singleton else match.info.album,
-                    ),
-                    u'({0})'.format(dist_string(match.distance)),
-                ]
-
-                # Penalties.
-                penalties = penalty_string(match.distance, 3)
-                if penalties:
-                    line.append(penalties)
-
-                # Disambiguation
-                disambig = disambig_string(match.info)
-                if disambig:
-                    line.append(ui.colorize('text_highlight_minor',
-                                            u'(%s)' % disambig))
-
-                print_(u' '.join(line))
-
-            # Ask the user for a choice.
-            if singleton:
-                opts = (u'Skip', u'Use as-is', u'Enter search', u'enter Id',
-                        u'aBort')
-            else:
-                opts = (u'Skip', u'Use as-is', u'as Tracks', u'Group albums',
-                        u'Enter search', u'enter Id', u'aBort')
-            sel = ui.input_options(opts + extra_opts,
-                                   numrange=(1, len(candidates)))
-            if sel == u's':
-                return importer.action.SKIP
-            elif sel == u'u':
-                return importer.action.ASIS
-            elif sel == u'm':
-                pass
-            elif sel == u'e':
-                return importer.action.MANUAL
-            elif sel == u't':
-                assert not singleton
-                return importer.action.TRACKS
-            elif sel == u'b':
-                raise importer.ImportAbort()
-            elif sel == u'i':
-                return importer.action.MANUAL_ID
-            elif sel == u'g':
-                return importer.action.ALBUMS
-            elif sel in extra_actions:
-                return sel
-            else:  # Numerical selection.
-                match = candidates[sel - 1]
-                if sel != 1:
-                    # When choosing anything but the first match,
-                    # disable the default action.
-                    require = True
-        bypass_candidates = False
-
-        # Show what we're about to do.
-        if singleton:
-            show_item_change(item, match)
-        else:
-            show_change(cur_artist, cur_album, match)
+def manual_search(decision):
+    """Return the artist and album (for full albums) or artist and track
+    name (for singletons) posted with a manual search decision.
+    """
+    return decision.args['artist'].strip(), decision.args['name'].strip()
 
-        # Exact match => tag automatically if we're not in timid mode.
-        if rec == Recommendation.strong and not config['import']['timid']:
-            return match
 
-        # Ask for confirmation.
-        if singleton:
-            opts = (u'Apply', u'More candidates', u'Skip', u'Use as-is',
-                    u'Enter search', u'enter Id', u'aBort')
-        else:
-            opts = (u'Apply', u'More candidates', u'Skip', u'Use as-is',
-                    u'as Tracks', u'Group albums', u'Enter search',
-                    u'enter Id', u'aBort')
-        default = config['import']['default_action'].as_choice({
-            u'apply': u'a',
-            u'skip': u's',
-            u'asis': u'u',
-            u'none': None,
-        })
-        if default is None:
-            require = True
-        sel = ui.input_options(opts + extra_opts, require=require,
-                               default=default)
-        if sel == u'a':
-            return match
-        elif sel == u'g':
-            return importer.action.ALBUMS
-        elif sel == u's':
-            return importer.action.SKIP
-        elif sel == u'u':
-            return importer.action.ASIS
-        elif sel == u't':
-            assert not singleton
-            return importer.action.TRACKS
-        elif sel == u'e':
-            return importer.action.MANUAL
-        elif sel == u'b':
-            raise importer.ImportAbort()
-        elif sel == u'i':
-            return importer.action.MANUAL_ID
-        elif sel in extra_actions:
-            return sel
+def manual_id(decision):
+    """Return the ID, either for an album ("release") or a track
+    ("recording"), posted with a manual ID decision.
+    """
+    return decision.args['id'].strip()
+
 
+# JSON serialization of matches.
 
-def manual_search(singleton):
-    """Input either an artist and album (for full albums) or artist and
-    track name (for singletons) for manual search.
+def serialize_distance(distance):
+    """Return a JSON-serializable description of a Distance object: the
+    overall distance and the distance contributed by each penalty.
     """
-    artist = input_(u'Artist:')
-    name = input_(u'Track:' if singleton else u'Album:')
-    return artist.strip(), name.strip()
+    return {
+        'distance': float(distance),
+        'penalties': dict((key, dist) for key, dist in distance.items()),
+    }
 
 
-def manual_id(singleton):
-    """Input an ID, either for an album ("release") or a track ("recording").
+def candidate_summary(match, singleton):
+    """Return a short JSON-serializable description of an AlbumMatch or
+    a TrackMatch, for listing the candidates of a task.
     """
-    prompt = u'Enter {0} ID:'.format(u'recording' if singleton else u'release')
-    return input_(prompt).strip()
+    return {
+        'artist': match.info.artist,
+        'title': match.info.title if singleton else match.info.album,
+        'distance': float(match.distance),
+        'penalties': penalty_keys(match.distance),
+        'disambig': disambig_string(match.info),
+        'data_source': match.info.data_source,
+        'data_url': match.info.data_url,
+    }
 
 
+def serialize_item(item):
+    return {
+        'path': displayable_path(item.path),
+        'artist': item.artist,
+        'title': item.title,
+        'track': item.track,
+        'disc': item.disc,
+        'length': item.length,
+    }
 
-class WebImportSession(importer.ImportSession):
-    """An import session that runs in a terminal.
-     """
-    def choose_match(self, task):
-        """Given an initial autotagging of items, go through an interactive
-        dance with the user to ask for a choice of metadata. Returns an
-        AlbumMatch object, ASIS, or SKIP.
-        """
-        # Show what we're tagging.
-        print_()
-        print_(displayable_path(task.paths, u'\n') +
-               u' ({0} items)'.format(len(task.items)))
 
-        # Take immediate action if appropriate.
-        action = _summary_judgment(task.rec)
-        if action == importer.action.APPLY:
-            match = task.candidates[0]
-            show_change(task.cur_artist, task.cur_album, match)
-            return match
-        elif action is not None:
-            return action
+def serialize_track_info(track_info):
+    return {
+        'artist': track_info.artist,
+        'title': track_info.title,
+        'index': track_info.index,
+        'medium': track_info.medium,
+        'medium_index': track_info.medium_index,
+        'disctitle': track_info.disctitle,
+        'length': track_info.length,
+        'track_id': track_info.track_id,
+    }
 
-        # Loop until we have a choice.
-        candidates, rec = task.candidates, task.rec
-        while True:
-            # Gather extra choices from plugins.
-            extra_choices = self._get_plugin_choices(task)
-            extra_ops = {c.short: c.callback for c in extra_choices}
 
-            # Ask for a choice from the user.
-            choice = choose_candidate(
-                candidates, False, rec, task.cur_artist, task.cur_album,
-                itemcount=len(task.items), extra_choices=extra_choices
+class MediumIndex(object):
+    """The tracks, missing tracks and unmatched items of an AlbumMatch
+    grouped by medium, so that a candidate can be described one medium
+    at a time.
+    """
+    def __init__(self, match):
+        self.pairs = {}
+        self.extra_tracks = {}
+        self.extra_items = {}
+        pairs = sorted(match.mapping.items(), key=lambda p: p[1].index)
+        for item, track_info in pairs:
+            self.pairs.setdefault(track_info.medium, []).append(
+                (item, track_info)
             )
+        for track_info in match.extra_tracks:
+            self.extra_tracks.setdefault(track_info.medium, []).append(
+                track_info
+            )
+        for item in match.extra_items:
+            self.extra_items.setdefault(item.disc, []).append(item)
+        self.mediums = sorted(set(self.pairs) | set(self.extra_tracks),
+                              key=lambda m: (m is None, m))
 
-            # Choose which tags to use.
-            if choice in (importer.action.SKIP, importer.action.ASIS,
-                          importer.action.TRACKS, importer.action.ALBUMS):
-                # Pass selection to main control flow.
-                return choice
-            elif choice is importer.action.MANUAL:
-                # Try again with manual search terms.
-                search_artist, search_album = manual_search(False)
-                _, _, candidates, rec = autotag.tag_album(
-                    task.items, search_artist, search_album
-                )
-            elif choice is importer.action.MANUAL_ID:
-                # Try a manually-entered ID.
-                search_id = manual_id(False)
-                if search_id:
-                    _, _, candidates, rec = autotag.tag_album(
-                        task.items, search_ids=search_id.split()
-                    )
-            elif choice in list(extra_ops.keys()):
-                # Allow extra ops to automatically set the post-choice.
-                post_choice = extra_ops[choice](self, task)
-                if isinstance(post_choice, importer.action):
-                    # MANUAL and MANUAL_ID have no effect, even if returned.
-                    return post_choice
-            else:
-                # We have a candidate! Finish tagging. Here, choice is an
-                # AlbumMatch object.
-                assert isinstance(choice, autotag.AlbumMatch)
-                return choice
-
-    def choose_item(self, task):
-        """Ask the user for a choice about tagging a single item. Returns
-        either an action constant or a TrackMatch object.
+    def medium(self, match, medium):
+        """Return the JSON-serializable description of one medium.
         """
-        print_()
-        print_(task.item.path)
-        candidates, rec = task.candidates, task.rec
+        tracks = []
+        for item, track_info in self.pairs.get(medium, ()):
+            tracks.append({
+                'item': serialize_item(item),
+                'track': serialize_track_info(track_info),
+                'distance': serialize_distance(
+                    match.distance.tracks[track_info]
+                ),
+            })
+        extra_items = self.extra_items.get(medium, [])
+        if medium == self.mediums[0]:
+            # Unmatched items with no usable disc number go on the first
+            # page.
+            extra_items = extra_items + [
+                item for disc, items in self.extra_items.items()
+                if disc not in self.mediums for item in items
+            ]
+        return {
+            'medium': medium,
+            'tracks': tracks,
+            'extra_tracks': [serialize_track_info(t)
+                             for t in self.extra_tracks.get(medium, ())],
+            'extra_items': [serialize_item(i) for i in extra_items],
+        }
 
-        # Take immediate action if appropriate.
-        action = _summary_judgment(task.rec)
-        if action == importer.action.APPLY:
-            match = candidates[0]
-            show_item_change(task.item, match)
-            return match
-        elif action is not None:
-            return action
 
-        while True:
-            extra_choices = self._get_plugin_choices(task)
-            extra_ops = {c.short: c.callback for c in extra_choices}
+def candidate_detail(match, singleton, index=None, medium=None):
+    """Return the full JSON-serializable description of a candidate. For
+    albums, only the tracks of one medium are included: `medium`, or the
+    first one by default. `index` is the candidate's `MediumIndex`, built
+    if not given.
+    """
+    out = candidate_summary(match, singleton)
+    out['distance'] = serialize_distance(match.distance)
+    if singleton:
+        out['track'] = serialize_track_info(match.info)
+        return out
 
-            # Ask for a choice.
-            choice = choose_candidate(candidates, True, rec, item=task.item,
-                                      extra_choices=extra_choices)
+    info = match.info
+    out.update({
+        'album_id': info.album_id,
+        'year': info.year,
+        'label': info.label,
+        'country': info.country,
+        'media': info.media,
+        'mediums': info.mediums,
+        'tracks_total': len(info.tracks),
+        'extra_tracks_total': len(match.extra_tracks),
+        'extra_items_total': len(match.extra_items),
+    })
+    if index is None:
+        index = MediumIndex(match)
+    out['pages'] = index.mediums
+    if not index.mediums:
+        return out
+    if medium is None:
+        medium = index.mediums[0]
+    elif medium not in index.mediums:
+        raise KeyError(medium)
+    out['page'] = index.medium(match, medium)
+    position = index.mediums.index(medium)
+    out['next'] = index.mediums[position + 1] \
+        if position + 1 < len(index.mediums) else None
+    return out
 
-            if choice in (importer.action.SKIP, importer.action.ASIS):
-                return choice
-            elif choice == importer.action.TRACKS:
-                assert False  # TRACKS is only legal for albums.
-            elif choice == importer.action.MANUAL:
-                # Continue in the loop with a new set of candidates.
-                search_artist, search_title = manual_search(True)
-                candidates, rec = autotag.tag_item(task.item, search_artist,
-                                                   search_title)
-            elif choice == importer.action.MANUAL_ID:
-                # Ask for a track ID.
-                search_id = manual_id(True)
-                if search_id:
-                    candidates, rec = autotag.tag_item(
-                        task.item, search_ids=search_id.split())
-            elif choice in extra_ops.keys():
-                # Allow extra ops to automatically set the post-choice.
-                post_choice = extra_ops[choice](self, task)
-                if isinstance(post_choice, importer.action):
-                    # MANUAL and MANUAL_ID have no effect, even if returned.
-                    return post_choice
-            else:
-                # Chose a candidate.
-                assert isinstance(choice, autotag.TrackMatch)
-                return choice
 
-    def resolve_duplicate(self, task, found_duplicates):
-        """Decide what to do when a new album or item seems similar to one
-        that's already in the library.
-        """
-        log.warn(u"This {0} is already in the library!",
-                 (u"album" if task.is_album else u"item"))
+# Tag diffs.
 
-        if config['import']['quiet']:
-            # In quiet mode, don't prompt -- just skip.
-            log.info(u'Skipping.')
-            sel = u's'
-        else:
-            # Print some detail about the existing and new items so the
-            # user can make an informed decision.
-            for duplicate in found_duplicates:
-                print_(u"Old: " + summarize_items(
-                    list(duplicate.items()) if task.is_album else [duplicate],
-                    not task.is_album,
-                ))
+def diff_spans(a, b):
+    """Return a list of `[op, text]` spans describing the changes from
+    string `a` to string `b`, where `op` is "equal", "delete" or
+    "insert". This is the structured counterpart of `ui.colordiff`.
+    """
+    a, b = a or u'', b or u''
+    if a == b:
+        return [[u'equal', a]] if a else []
 
-            print_(u"New: " + summarize_items(
-                task.imported_items(),
-                not task.is_album,
-            ))
+    spans = []
+    matcher = difflib.SequenceMatcher(lambda x: False, a, b)
+    for op, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+        if op == 'equal':
+            spans.append([u'equal', a[a_start:a_end]])
+        if op in ('delete', 'replace'):
+            spans.append([u'delete', a[a_start:a_end]])
+        if op in ('insert', 'replace'):
+            spans.append([u'insert', b[b_start:b_end]])
+    return spans
 
-            sel = ui.input_options(
-                (u'Skip new', u'Keep both', u'Remove old')
-            )
 
-        if sel == u's':
-            # Skip new.
-            task.set_choice(importer.action.SKIP)
-        elif sel == u'k':
-            # Keep both. Do nothing; leave the choice intact.
-            pass
-        elif sel == u'r':
-            # Remove old.
-            task.should_remove_duplicates = True
+def format_index(track_info, mediums=None):
+    """Return a string representing the track index of the given
+    TrackInfo or Item object. `mediums` is the number of mediums of the
+    release a TrackInfo belongs to.
+    """
+    if isinstance(track_info, hooks.TrackInfo):
+        index = track_info.index
+        medium_index = track_info.medium_index
+        medium = track_info.medium
+    else:
+        index = medium_index = track_info.track
+        medium = track_info.disc
+        mediums = track_info.disctotal
+    if config['per_disc_numbering']:
+        if mediums > 1:
+            return u'{0}-{1}'.format(medium, medium_index)
         else:
-            assert False
+            return unicode(medium_index)
+    else:
+        return unicode(index)
 
-    def should_resume(self, path):
-        return ui.input_yn(u"Import of the directory:\n{0}\n"
-                           u"was interrupted. Resume (Y/n)?"
-                           .format(displayable_path(path)))
 
-    def _get_plugin_choices(self, task):
-        """Get the extra choices appended to the plugins to the ui prompt.
+def track_diff(item, track_info, match):
+    """Describe the changes made to `item` by tagging it with
+    `track_info` from the AlbumMatch `match`.
+    """
+    out = {'item': displayable_path(item.path)}
+    changed = False
 
-        The `before_choose_candidate` event is sent to the plugins, with
-        session and task as its parameters. Plugins are responsible for
-        checking the right conditions and returning a list of `PromptChoice`s,
-        which is flattened and checked for conflicts.
+    # Titles.
+    new_title = track_info.title
+    if not item.title.strip():
+        # If there's no title, we use the filename.
+        cur_title = displayable_path(os.path.basename(item.path))
+        out['title'] = [[u'delete', cur_title], [u'insert', new_title]]
+        changed = True
+    else:
+        out['title'] = diff_spans(item.title.strip(), new_title)
+        changed = changed or item.title.strip() != new_title
 
-        If two or more choices have the same short letter, a warning is
-        emitted and all but one choices are discarded, giving preference
-        to the default importer choices.
+    # Track number change.
+    cur_track = format_index(item)
+    new_track = format_index(track_info, match.info.mediums)
+    if cur_track != new_track:
+        out['index'] = {
+            'from': cur_track,
+            'to': new_track,
+            'minor': item.track in (track_info.index,
+                                    track_info.medium_index),
+        }
+        changed = True
 
-        Returns a list of `PromptChoice`s.
-        """
-        # Send the before_choose_candidate event and flatten list.
-        extra_choices = list(chain(*plugins.send('before_choose_candidate',
-                                                 session=self, task=task)))
-        # Take into account default options, for duplicate checking.
-        all_choices = [PromptChoice(u'a', u'Apply', None),
-                       PromptChoice(u's', u'Skip', None),
-                       PromptChoice(u'u', u'Use as-is', None),
-                       PromptChoice(u't', u'as Tracks', None),
-                       PromptChoice(u'g', u'Group albums', None),
-                       PromptChoice(u'e', u'Enter search', None),
-                       PromptChoice(u'i', u'enter Id', None),
-                       PromptChoice(u'b', u'aBort', None)] + \
-                      extra_choices
+    # Length change.
+    if item.length and track_info.length and \
+            abs(item.length - track_info.length) > \
+            config['ui']['length_diff_thresh'].as_number():
+        out['length'] = {'from': item.length, 'to': track_info.length}
+        changed = True
 
-        short_letters = [c.short for c in all_choices]
-        if len(short_letters) != len(set(short_letters)):
-            # Duplicate short letter has been found.
-            duplicates = [i for i, count in Counter(short_letters).items()
-                          if count > 1]
-            for short in duplicates:
-                # Keep the first of the choices, removing the rest.
-                dup_choices = [c for c in all_choices if c.short == short]
-                for c in dup_choices[1:]:
-                    log.warn(u"Prompt choice '{0}' removed due to conflict "
-                             u"with '{1}' (short letter: '{2}')",
-                             c.long, dup_choices[0].long, c.short)
-                    extra_choices.remove(c)
-        return extra_choices
+    # Penalties.
+    out['penalties'] = penalty_keys(match.distance.tracks[track_info])
+    out['changed'] = changed or bool(out['penalties'])
+    return out
 
-def import_files(lib, paths, query):
-    """Import the files in the given list of paths or matching the
-    query.
+
+def album_diff(cur_artist, cur_album, match, index, medium):
+    """Describe the changes made by tagging an album with the AlbumMatch
+    `match`, restricted to the tracks of one `medium` of its
+    `MediumIndex` `index`.
     """
-    # Check the user-specified directories.
-    for path in paths:
-        if not os.path.exists(syspath(normpath(path))):
-            raise ui.UserError(u'no such file or directory: {0}'.format(
-                displayable_path(path)))
+    info = match.info
+    artist_l, artist_r = cur_artist or u'', info.artist
+    album_l, album_r = cur_album or u'', info.album
+    if artist_r == VARIOUS_ARTISTS:
+        # Hide artists for VA releases.
+        artist_l, artist_r = u'', u''
+    out = {
+        'changed': cur_artist != info.artist or
+        (cur_album != info.album and info.album != VARIOUS_ARTISTS),
+        'artist': diff_spans(artist_l, artist_r),
+        'album': diff_spans(album_l, album_r),
+        'pages': index.mediums,
+    }
+    if not index.mediums:
+        return out
+    if medium is None:
+        medium = index.mediums[0]
+    elif medium not in index.mediums:
+        raise KeyError(medium)
 
-    # Check parameter consistency.
-    if config['import']['quiet'] and config['import']['timid']:
-        raise ui.UserError(u"can't be both quiet and timid")
+    pairs = index.pairs.get(medium, ())
+    disctitle = pairs[0][1].disctitle if pairs else None
+    out['medium'] = {
+        'medium': medium,
+        'media': info.media or u'Media',
+        'disctitle': disctitle,
+        'tracks': [track_diff(item, track_info, match)
+                   for item, track_info in pairs],
+        'missing': [{'title': t.title,
+                     'index': format_index(t, info.mediums),
+                     'length': t.length}
+                    for t in index.extra_tracks.get(medium, ())],
+        'unmatched': [{'title': i.title, 'index': format_index(i),
+                       'length': i.length}
+                      for i in index.extra_items.get(medium, ())],
+    }
+    return out
 
-    # Open the log.
-    if config['import']['log'].get() is not None:
-        logpath = syspath(config['import']['log'].as_filename())
-        try:
-            loghandler = logging.FileHandler(logpath)
-        except IOError:
-            raise ui.UserError(u"could not open log file for writing: "
-                               u"{0}".format(displayable_path(logpath)))
-    else:
-        loghandler = None
 
-    # Never ask for input in quiet mode.
-    if config['import']['resume'].get() == 'ask' and \
-            config['import']['quiet']:
-        config['import']['resume'] = False
+def item_diff(item, match):
+    """Describe the changes made by tagging `item` with the TrackMatch
+    `match`.
+    """
+    return {
+        'changed': item.artist != match.info.artist or
+        item.title != match.info.title,
+        'artist': diff_spans(item.artist, match.info.artist),
+        'title': diff_spans(item.title, match.info.title),
+    }
 
-    session = WebImportSession(lib, loghandler, paths, query)
-    session.run()
 
-    # Emit event.
-    plugins.send('import', lib=lib, paths=paths)
+class DiffCache(object):
+    """Memoizes the diffs of the most recently viewed candidates, keyed
+    by pending task, candidate and medium, so flipping between the
+    candidates of a task only computes each diff once.
+    """
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._diffs = OrderedDict()
+        self._lock = threading.Lock()
 
+    def get(self, pending, index, medium=None):
+        """Return the diff for a candidate of a pending task. Raise
+        `IndexError` or `KeyError` for an unknown candidate or medium.
+        """
+        key = (pending.id, index, medium)
+        with self._lock:
+            diff = self._diffs.pop(key, None)
+            if diff is not None:
+                self._diffs[key] = diff
+                return diff
 
-def import_func(lib, opts, args):
-    config['import'].set_args(opts)
+        match, mediums = pending.match(index)
+        if pending.kind == PendingTask.ITEM:
+            diff = item_diff(pending.rehydrate()[0][0], match)
+        else:
+            diff = album_diff(pending.task.cur_artist, pending.task.cur_album,
+                              match, mediums, medium)
 
-    # Special case: --copy flag suppresses import_move (which would
-    # otherwise take precedence).
-    if opts.copy:
-        config['import']['move'] = False
+        with self._lock:
+            self._diffs[key] = diff
+            while len(self._diffs) > self.capacity:
+                self._diffs.popitem(last=False)
+        return diff
 
-    if opts.library:
-        query = decargs(args)
+    def forget(self, pending):
+        """Drop the diffs of a task that is no longer pending.
+        """
+        with self._lock:
+            for key in [k for k in self._diffs if k[0] == pending.id]:
+                del self._diffs[key]
+
+
+# Auto-decision rules.
+
+# The facts about a task that rules are evaluated against. They describe
+# the best candidate and the items being imported.
+TaskFacts = namedtuple('TaskFacts', ['rec', 'distance', 'penalties',
+                                     'data_source', 'media', 'country',
+                                     'tracks', 'formats'])
+
+
+def task_facts(candidates, rec, items):
+    """Gather the `TaskFacts` for a task from its candidates,
+    recommendation and items.
+    """
+    if candidates:
+        best = candidates[0]
+        distance = float(best.distance)
+        penalties = set(penalty_keys(best.distance))
+        info = best.info
+    else:
+        distance, penalties, info = None, set(), None
+    return TaskFacts(
+        rec=rec.name if rec is not None else None,
+        distance=distance,
+        penalties=penalties,
+        data_source=_lower(getattr(info, 'data_source', None)),
+        media=_lower(getattr(info, 'media', None)),
+        country=_lower(getattr(info, 'country', None)),
+        tracks=len(items),
+        formats=set(_lower(item.format) for item in items),
+    )
+
+
+def _lower(value):
+    return value.lower() if value else value
+
+
+def _lowered_set(value):
+    if isinstance(value, basestring):
+        value = [value]
+    return set(_lower(v) for v in value)
+
+
+# Rule conditions: each takes the configured value and returns a test
+# that takes `TaskFacts`.
+RULE_CONDITIONS = {
+    'rec': lambda v: (
+        lambda f, v=_lowered_set(v): _lower(f.rec) in v
+    ),
+    'max_distance': lambda v: (
+        lambda f, v=float(v): f.distance is not None and f.distance <= v
+    ),
+    'min_distance': lambda v: (
+        lambda f, v=float(v): f.distance is None or f.distance >= v
+    ),
+    'penalties': lambda v: (
+        lambda f, v=_lowered_set(v): bool(f.penalties & v)
+    ),
+    'without_penalties': lambda v: (
+        lambda f, v=_lowered_set(v): not f.penalties & v
+    ),
+    'data_source': lambda v: (
+        lambda f, v=_lowered_set(v): f.data_source in v
+    ),
+    'media': lambda v: (
+        lambda f, v=_lowered_set(v): f.media in v
+    ),
+    'country': lambda v: (
+        lambda f, v=_lowered_set(v): f.country in v
+    ),
+    'min_tracks': lambda v: (
+        lambda f, v=int(v): f.tracks >= v
+    ),
+    'max_tracks': lambda v: (
+        lambda f, v=int(v): f.tracks <= v
+    ),
+    'format': lambda v: (
+        lambda f, v=_lowered_set(v): bool(f.formats) and f.formats <= v
+    ),
+}
+
+RULE_ACTIONS = {
+    u'apply': importer.action.APPLY,
+    u'asis': importer.action.ASIS,
+    u'skip': importer.action.SKIP,
+    u'ask': None,
+}
+
+
+class Rule(object):
+    """An auto-decision rule: an action taken for the tasks that meet
+    all of its conditions.
+    """
+    def __init__(self, spec):
+        """Compile a rule from its configuration, a dict with an
+        `action` and any number of conditions. Raise a `UserError` if it
+        is invalid.
+        """
+        spec = dict(spec)
+        action = spec.pop('action', None)
+        if action not in RULE_ACTIONS:
+            raise ui.UserError(u'invalid rule action: {0}'.format(action))
+        self.name = action
+        self.action = RULE_ACTIONS[action]
+        self.tests = []
+        for key, value in spec.items():
+            if key not in RULE_CONDITIONS:
+                raise ui.UserError(u'invalid rule condition: {0}'.format(key))
+            try:
+                self.tests.append(RULE_CONDITIONS[key](value))
+            except (TypeError, ValueError):
+                raise ui.UserError(u'invalid value for rule condition {0}: '
+                                   u'{1}'.format(key, value))
+        self.spec = dict(spec, action=action)
+
+    def matches(self, facts):
+        # A rule can only apply a match if there is one.
+        if self.action == importer.action.APPLY and facts.distance is None:
+            return False
+        return all(test(facts) for test in self.tests)
+
+
+class Policy(object):
+    """An ordered list of rules. The first rule a task meets decides
+    what happens to it.
+    """
+    def __init__(self, specs):
+        self.rules = [Rule(spec) for spec in specs]
+
+    def decide(self, facts):
+        """Return the first rule met by `facts`, or None.
+        """
+        for rule in self.rules:
+            if rule.matches(facts):
+                return rule
+
+    def decide_all(self, pendings):
+        """Evaluate the rules for a batch of pending album and item
+        tasks. Return a list of `(pending, action)` pairs for the tasks
+        that a rule takes a decision for.
+        """
+        decided = []
+        for pending in pendings:
+            if pending.kind == PendingTask.DUPLICATE:
+                continue
+            rule = self.decide(pending.facts)
+            if rule is not None and rule.action is not None:
+                decided.append((pending, rule.action))
+        return decided
+
+    def to_list(self):
+        return [rule.spec for rule in self.rules]
+
+
+# Pending decisions.
+
+# A choice made through the web: `sel` is what `ui.input_options` used to
+# return (a short letter or a 1-based candidate number) and `args` holds
+# the extra input some choices need (search terms, IDs).
+Decision = namedtuple('Decision', ['sel', 'args'])
+
+DECISION_ACTIONS = {
+    u'skip': u's',
+    u'asis': u'u',
+    u'tracks': u't',
+    u'albums': u'g',
+    u'search': u'e',
+    u'id': u'i',
+    u'abort': u'b',
+}
+DUPLICATE_ACTIONS = {
+    u'skip': u's',
+    u'keep': u'k',
+    u'remove': u'r',
+}
+
+
+class DecisionError(Exception):
+    """A posted decision cannot be applied to its task.
+    """
+
+
+class DecisionConflict(DecisionError):
+    """A decision was posted for a task leased to another reviewer.
+    """
+
+
+class TaskParked(Exception):
+    """Raised in the user query stage when a task is parked to wait for
+    a decision: the task leaves the pipeline, and comes back to it once
+    decided.
+    """
+
+
+class PendingTask(object):
+    """An import task taken out of its session's pipeline until a
+    decision is posted for it through the web interface.
+
+    Given a `CandidateStore`, the items and candidates are spilled to it
+    and only what listings, filters and rules need stays in memory;
+    `rehydrate` reads them back.
+    """
+    __slots__ = ('id', 'session', 'task', 'kind', 'rec', 'extra_choices',
+                 'duplicates', 'created', 'decision', 'decided_by',
+                 'candidate_count', 'facts', 'rec_name', 'distance',
+                 'data_source', 'path',
+                 'has_duplicates', 'reviewer', 'lease_expires',
+                 '_heading', '_summaries', '_candidates', '_mediums',
+                 '_store')
+
+    ALBUM = u'album'
+    ITEM = u'item'
+    DUPLICATE = u'duplicate'
+
+    def __init__(self, session, task, kind, candidates=(), rec=None,
+                 extra_choices=(), duplicates=(), has_duplicates=None,
+                 store=None):
+        self.id = uuid.uuid4().hex
+        self.session = session
+        self.task = task
+        self.kind = kind
+        self.rec = rec
+        self.extra_choices = extra_choices
+        self.duplicates = duplicates
+        self.created = time.time()
+        self.decision = self.decided_by = None
+        self.reviewer = self.lease_expires = None
+        self.candidate_count = len(candidates)
+        self.facts = None if kind == self.DUPLICATE else \
+            task_facts(candidates, rec, task.items)
+        if kind == self.ITEM:
+            self._heading = {'artist': task.item.artist,
+                             'title': task.item.title}
+        elif kind == self.ALBUM:
+            self._heading = {'artist': task.cur_artist,
+                             'album': task.cur_album,
+                             'items': len(task.items)}
+        else:
+            self._heading = None
+        self._summaries = None
+        self._mediums = {}
+        if candidates and store is not None:
+            store.put(self.id, task.items, candidates)
+            self._candidates = None
+            self._store = store
+        else:
+            self._candidates = candidates
+            self._store = None
+
+        # Indexed attributes.
+        self.rec_name = rec.name if rec is not None else None
+        if candidates:
+            self.distance = float(candidates[0].distance)
+            self.data_source = candidates[0].info.data_source
+        else:
+            self.distance = None
+            self.data_source = None
+        self.path = displayable_path(task.paths[0]) if task.paths else u''
+        if kind == self.DUPLICATE:
+            has_duplicates = True
+        self.has_duplicates = has_duplicates
+
+    def parse_decision(self, data):
+        """Validate the JSON object posted as a decision for this task and
+        return the corresponding `Decision`. Raise a `DecisionError` if
+        it does not apply.
+        """
+        action = data.get('action')
+        if self.kind == self.DUPLICATE:
+            if action not in DUPLICATE_ACTIONS:
+                raise DecisionError(u'unknown action: {0}'.format(action))
+            return Decision(DUPLICATE_ACTIONS[action], {})
+
+        if action in (None, u'apply'):
+            index = data.get('candidate', 0)
+            if isinstance(index, bool) or not isinstance(index, int) or \
+                    not 0 <= index < self.candidate_count:
+                raise DecisionError(u'no such candidate: {0}'.format(index))
+            return Decision(index + 1, {})
+
+        if action in DECISION_ACTIONS:
+            sel = DECISION_ACTIONS[action]
+        elif action in [c.short for c in self.extra_choices]:
+            sel = action
+        else:
+            raise DecisionError(u'unknown action: {0}'.format(action))
+
+        args = {}
+        if sel in (u't', u'g') and self.kind == self.ITEM:
+            raise DecisionError(u'{0} is only legal for albums'.format(action))
+        elif sel == u'e':
+            for key in ('artist', 'name'):
+                if not isinstance(data.get(key), basestring):
+                    raise DecisionError(u'missing search {0}'.format(key))
+                args[key] = data[key]
+        elif sel == u'i':
+            if not isinstance(data.get('id'), basestring):
+                raise DecisionError(u'missing id')
+            args['id'] = data['id']
+        return Decision(sel, args)
+
+    def resolve(self, decision, decided_by=u'human'):
+        """Record the decision and send the task back to its session.
+        """
+        self.decision = decision
+        self.decided_by = decided_by
+        self.session.decided(self)
+
+    @property
+    def spilled(self):
+        return self._store is not None
+
+    def leased_to(self, now=None):
+        """Return the reviewer holding an unexpired lease on the task, or
+        None.
+        """
+        if self.reviewer is None:
+            return None
+        if self.lease_expires <= (time.time() if now is None else now):
+            return None
+        return self.reviewer
+
+    def rehydrate(self):
+        """Return the items and candidates of the task, read back from
+        the candidate store if they were spilled, and the dict caching
+        the medium indexes of the candidates.
+        """
+        if self._store is None:
+            return self.task.items, self._candidates, self._mediums
+        return self._store.get(self.id, self.session.lib)
+
+    def match(self, index):
+        """Return a candidate and, for albums, its `MediumIndex`, built
+        on first use. Raise `IndexError` for an unknown candidate.
+        """
+        if not 0 <= index < self.candidate_count:
+            raise IndexError(index)
+        _, candidates, mediums = self.rehydrate()
+        match = candidates[index]
+        if self.kind == self.ITEM:
+            return match, None
+        if index not in mediums:
+            mediums[index] = MediumIndex(match)
+        return match, mediums[index]
+
+    def candidate_summaries(self):
+        """Return the summaries of the candidates, built on first use.
+        Those of spilled candidates are built every time instead: the
+        candidate store keeps the recently read candidates in memory
+        already.
+        """
+        if self._summaries is not None:
+            return self._summaries
+        summaries = [candidate_summary(match, self.kind == self.ITEM)
+                     for match in self.rehydrate()[1]]
+        if not self.spilled:
+            self._summaries = summaries
+        return summaries
+
+    def candidate_detail(self, index, medium=None):
+        """Return the description of one candidate, paginated by medium.
+        Raise `IndexError` or `KeyError` for an unknown candidate or
+        medium.
+        """
+        match, mediums = self.match(index)
+        if self.kind == self.ITEM:
+            return candidate_detail(match, True)
+        return candidate_detail(match, False, mediums, medium)
+
+    def summary(self):
+        """Return the short description of the task used in listings.
+        """
+        out = {
+            'id': self.id,
+            'job': self.session.job.id if self.session.job else None,
+            'kind': self.kind,
+            'path': self.path,
+            'created': self.created,
+            'rec': self.rec_name,
+            'distance': self.distance,
+            'data_source': self.data_source,
+            'candidates': self.candidate_count,
+            'has_duplicates': self.has_duplicates,
+        }
+        out.update(self._lease())
+        return out
+
+    def _lease(self):
+        reviewer = self.leased_to()
+        return {
+            'reviewer': reviewer,
+            'lease_expires': self.lease_expires if reviewer else None,
+        }
+
+    def to_dict(self):
+        out = {
+            'id': self.id,
+            'job': self.session.job.id if self.session.job else None,
+            'kind': self.kind,
+            'paths': [displayable_path(p) for p in self.task.paths],
+            'created': self.created,
+        }
+        out.update(self._lease())
+        if self.kind == self.DUPLICATE:
+            singleton = not self.task.is_album
+            out['new'] = summarize_items(self.task.imported_items(),
+                                         singleton)
+            out['old'] = [summarize_items(
+                list(d.items()) if self.task.is_album else [d], singleton
+            ) for d in self.duplicates]
+            return out
+
+        # The items may be spilled.
+        out.update(self._heading)
+        out['rec'] = self.rec.name if self.rec is not None else None
+        out['candidates'] = self.candidate_summaries()
+        out['choices'] = [{'short': c.short, 'long': c.long}
+                          for c in self.extra_choices]
+        return out
+
+
+# Sort key used for tasks without candidates: after every real distance.
+NO_DISTANCE = 2.0
+
+# Listings sort the tasks that pass their filters instead of walking the
+# range of a sort index once the range is this many times larger.
+SELECTIVE_FILTER = 8
+
+
+class TaskIndex(object):
+    """Secondary indexes over the pending tasks, kept up to date as
+    tasks are parked and resolved, so that filtered and sorted listings
+    don't need to scan every task.
+    """
+    def __init__(self):
+        self.by_kind = defaultdict(set)
+        self.by_rec = defaultdict(set)
+        self.by_source = defaultdict(set)
+        self.with_duplicates = set()
+        # The sort keys of every task, by ID.
+        self.keys = {}
+        # Sorted lists of (key..., id) tuples.
+        self.by_distance = []
+        self.by_age = []
+        self.by_path = []
+
+    @staticmethod
+    def _keys(pending):
+        distance = pending.distance
+        if distance is None:
+            distance = NO_DISTANCE
+        return {
+            'distance': (distance, pending.created, pending.id),
+            'age': (pending.created, pending.id),
+            'path': (pending.path, pending.id),
+        }
+
+    def add(self, pending):
+        self.by_kind[pending.kind].add(pending.id)
+        self.by_rec[pending.rec_name].add(pending.id)
+        self.by_source[_lower(pending.data_source)].add(pending.id)
+        if pending.has_duplicates:
+            self.with_duplicates.add(pending.id)
+        keys = self.keys[pending.id] = self._keys(pending)
+        bisect.insort(self.by_distance, keys['distance'])
+        bisect.insort(self.by_age, keys['age'])
+        bisect.insort(self.by_path, keys['path'])
+
+    def remove(self, pending):
+        for index, key in ((self.by_kind, pending.kind),
+                           (self.by_rec, pending.rec_name),
+                           (self.by_source, _lower(pending.data_source))):
+            index[key].discard(pending.id)
+            if not index[key]:
+                del index[key]
+        self.with_duplicates.discard(pending.id)
+        keys = self.keys.pop(pending.id, None) or self._keys(pending)
+        for name in ('distance', 'age', 'path'):
+            entries = getattr(self, 'by_' + name)
+            i = bisect.bisect_left(entries, keys[name])
+            if i < len(entries) and entries[i] == keys[name]:
+                del entries[i]
+
+    @staticmethod
+    def _bounds(entries, low, high, after=None, descending=False):
+        """Return the range of positions of `entries` between `low` and
+        `high`, and past `after` in the given direction.
+        """
+        start = bisect.bisect_left(entries, low) if low else 0
+        end = bisect.bisect_right(entries, high) if high else len(entries)
+        if after is not None:
+            if descending:
+                end = min(end, bisect.bisect_left(entries, after))
+            else:
+                start = max(start, bisect.bisect_right(entries, after))
+        return start, end
+
+    @classmethod
+    def _range(cls, entries, low, high):
+        start, end = cls._bounds(entries, low, high)
+        return entries[start:end]
+
+    def _prefix(self, prefix):
+        start = bisect.bisect_left(self.by_path, (prefix,))
+        ids = set()
+        for path, task_id in itertools.islice(self.by_path, start, None):
+            if not path.startswith(prefix):
+                break
+            ids.add(task_id)
+        return ids
+
+    def query(self, kind=None, rec=None, data_source=None,
+              has_duplicates=None, path=None, min_distance=None,
+              max_distance=None, sort=u'age', descending=False,
+              after=None, limit=50):
+        """Return up to `limit` task IDs matching the filters, in the
+        order given by `sort` ("age" or "distance"), and the sort key of
+        the last one, to be passed as `after` for the next page. `rec`,
+        `kind` and `data_source` are collections of accepted values.
+        Tasks without candidates only match when no distance bound is
+        given.
+
+        The range of the sort index is walked, skipping the tasks left
+        out by the other filters, unless those leave so few tasks that
+        sorting them is cheaper.
+        """
+        # Narrow down with the set indexes, smallest first.
+        sets = []
+        for index, values in ((self.by_kind, kind), (self.by_rec, rec),
+                              (self.by_source, data_source)):
+            if values is not None:
+                sets.append(set().union(*[index.get(v, ()) for v in values]))
+        if path:
+            sets.append(self._prefix(path))
+        if has_duplicates:
+            sets.append(self.with_duplicates)
+
+        low = high = None
+        if min_distance is not None or max_distance is not None:
+            # Tasks without candidates have no distance: they are left
+            # out of any distance range.
+            low = (min_distance,) if min_distance is not None else None
+            high = (max_distance, float('inf')) \
+                if max_distance is not None and max_distance < NO_DISTANCE \
+                else (NO_DISTANCE,)
+        if sort == u'distance':
+            name = 'distance'
+            entries = self.by_distance
+        else:
+            name = 'age'
+            entries = self.by_age
+            if low or high:
+                # Filter on the distance range through its index.
+                sets.append(set(e[-1] for e in self._range(
+                    self.by_distance, low, high)))
+                low = high = None
+
+        sets.sort(key=len)
+        allowed = set.intersection(*sets) if sets else None
+        excluded = self.with_duplicates if has_duplicates is False \
+            else None
+        if allowed is not None and excluded is not None:
+            allowed -= excluded
+            excluded = None
+
+        start, end = self._bounds(entries, low, high, after, descending)
+        if allowed is not None and \
+                len(allowed) * SELECTIVE_FILTER < end - start:
+            entries = sorted(self.keys[task_id][name] for task_id in allowed)
+            allowed = None
+            start, end = self._bounds(entries, low, high, after, descending)
+        positions = range(end - 1, start - 1, -1) if descending \
+            else range(start, end)
+
+        ids, last = [], None
+        for i in positions:
+            entry = entries[i]
+            task_id = entry[-1]
+            if allowed is not None and task_id not in allowed:
+                continue
+            if excluded is not None and task_id in excluded:
+                continue
+            ids.append(task_id)
+            last = entry
+            if len(ids) >= limit:
+                break
+        else:
+            last = None
+        return ids, last
+
+
+class DecisionStore(object):
+    """Holds the import tasks that are waiting for a human decision,
+    across all running sessions.
+
+    When `capacity` is set, the stages feeding the store wait while it
+    holds that many tasks, so that sessions stop reading and looking up
+    albums faster than reviewers decide them. Lookups already under way
+    still park their task, so the store can go over capacity by up to
+    the number of lookup workers.
+
+    The candidates of the parked tasks are spilled to `spill`, a
+    `CandidateStore`, if given.
+
+    Reviewers working in parallel claim tasks, which are then leased to
+    them for `lease_ttl` seconds by default: nobody else can claim or
+    decide a task while its lease runs.
+    """
+    def __init__(self, capacity=0, spill=None, lease_ttl=300):
+        self.tasks = OrderedDict()
+        self.index = TaskIndex()
+        self.capacity = capacity
+        self.spill = spill
+        self.lease_ttl = lease_ttl
+        self.leases = {}
+        self.waiting = Counter()
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+
+    def park(self, session, task, kind, **kwargs):
+        pending = PendingTask(session, task, kind, store=self.spill,
+                              **kwargs)
+        with self._lock:
+            self.tasks[pending.id] = pending
+            self.index.add(pending)
+        return pending
+
+    def get(self, task_id):
+        with self._lock:
+            return self.tasks.get(task_id)
+
+    def all(self):
+        with self._lock:
+            return list(self.tasks.values())
+
+    def discard(self, pending):
+        with self._lock:
+            if self.tasks.pop(pending.id, None) is not None:
+                self._forget(pending)
+        if pending.spilled:
+            self.spill.delete(pending.id)
+
+    def wait_for_room(self, session, stage):
+        """Block the calling pipeline stage while the store is full.
+        Return the number of seconds spent waiting. Raise `ImportAbort`
+        if the session's job is cancelled in the meantime.
+        """
+        if not self.capacity:
+            return 0.0
+        with self._room:
+            if len(self.tasks) < self.capacity:
+                return 0.0
+            start = time.time()
+            self.waiting[stage] += 1
+            try:
+                while len(self.tasks) >= self.capacity:
+                    self._room.wait(1.0)
+                    session.check_abort()
+            finally:
+                self.waiting[stage] -= 1
+            return time.time() - start
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'parked': len(self.tasks),
+                'capacity': self.capacity,
+                'waiting': dict((stage, count) for stage, count
+                                in self.waiting.items() if count),
+                'spill': self.spill.stats() if self.spill else None,
+                'leases': dict(
+                    (reviewer, sum(1 for task_id in ids
+                                   if self.tasks[task_id].leased_to(now)))
+                    for reviewer, ids in self.leases.items()
+                ),
+            }
+
+    def query(self, **filters):
+        """Return the parked tasks matching the filters of
+        `TaskIndex.query` and the cursor of the next page, if any.
+        """
+        with self._lock:
+            ids, last = self.index.query(**filters)
+            return [self.tasks[task_id] for task_id in ids], last
+
+    def claim(self, reviewer, count, ttl=None, **filters):
+        """Lease parked tasks to `reviewer` for `ttl` seconds, and return
+        them. The leases the reviewer still holds are renewed first,
+        then tasks matching the filters of `TaskIndex.query` that nobody
+        holds a lease on are added, up to `count` tasks in all.
+        """
+        now = time.time()
+        expires = now + (self.lease_ttl if ttl is None else ttl)
+        with self._lock:
+            held = [self.tasks[task_id]
+                    for task_id in self.leases.get(reviewer, ())]
+            claimed = sorted([p for p in held if p.leased_to(now)],
+                             key=lambda p: p.created)[:count]
+
+            after = None
+            while len(claimed) < count:
+                ids, after = self.index.query(after=after, limit=count,
+                                              **filters)
+                for task_id in ids:
+                    pending = self.tasks[task_id]
+                    if pending.leased_to(now) is None:
+                        claimed.append(pending)
+                        if len(claimed) >= count:
+                            break
+                if after is None:
+                    break
+
+            # Expired leases and those beyond `count` are given back.
+            for pending in held:
+                self._lease(pending, None, None)
+            for pending in claimed:
+                self._lease(pending, reviewer, expires)
+        return claimed
+
+    def release(self, reviewer, task_ids=None):
+        """Give back the leases of `reviewer` on the given tasks, or on
+        all of them. Return the number of leases given back.
+        """
+        with self._lock:
+            ids = self.leases.get(reviewer, set())
+            if task_ids is not None:
+                ids = ids & set(task_ids)
+            released = [self.tasks[task_id] for task_id in ids]
+            for pending in released:
+                self._lease(pending, None, None)
+        return len(released)
+
+    def _lease(self, pending, reviewer, expires):
+        held = self.leases.get(pending.reviewer)
+        if held is not None:
+            held.discard(pending.id)
+            if not held:
+                del self.leases[pending.reviewer]
+        pending.reviewer, pending.lease_expires = reviewer, expires
+        if reviewer is not None:
+            self.leases.setdefault(reviewer, set()).add(pending.id)
+
+    def _forget(self, pending):
+        self.index.remove(pending)
+        self._lease(pending, None, None)
+        self._room.notify_all()
+
+    def resolve(self, task_id, data):
+        """Apply a posted decision to a parked task and send it back to
+        its session's pipeline. Raise a `DecisionError` if there is no
+        such task or the decision does not apply.
+        """
+        result = self.resolve_many([(task_id, data)])[0]
+        if isinstance(result, DecisionError):
+            raise result
+        return result
+
+    def _take(self, task_id, data):
+        pending = self.tasks.get(task_id)
+        if pending is None:
+            raise DecisionError(u'no such task: {0}'.format(task_id))
+        reviewer = pending.leased_to()
+        if reviewer is not None and reviewer != data.get('reviewer'):
+            raise DecisionConflict(u'task {0} is claimed by {1}'.format(
+                task_id, reviewer))
+        decision = pending.parse_decision(data)
+        del self.tasks[task_id]
+        self._forget(pending)
+        return pending, decision
+
+    def resolve_many(self, decisions, decided_by=u'human'):
+        """Apply a batch of `(task_id, data)` decisions in one pass.
+        Return, in the same order, the resolved `PendingTask` or the
+        `DecisionError` explaining why that decision was rejected. A
+        decision for a task leased to a reviewer must name it as its
+        `reviewer`. `decided_by` tells who made the decisions, for the
+        metrics.
+        """
+        results = []
+        resolved = []
+        with self._lock:
+            for task_id, data in decisions:
+                try:
+                    pending, decision = self._take(task_id, data)
+                except DecisionError as exc:
+                    results.append(exc)
+                else:
+                    results.append(pending)
+                    resolved.append((pending, decision))
+        for pending, decision in resolved:
+            pending.resolve(decision, decided_by)
+        return results
+
+
+class CandidateStore(object):
+    """Keeps the items and candidates of parked tasks in a SQLite
+    database while they wait for a decision, and reads them back when a
+    reviewer looks at them or the decision is made. Those of the `loaded`
+    most recently read tasks stay in memory.
+    """
+    def __init__(self, path, loaded=64):
+        self.path = path
+        self.loaded = loaded
+        self.reads = self.hits = 0
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Parked tasks don't outlive the process: nothing here needs to
+        # survive a crash.
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE IF NOT EXISTS candidates ('
+                         'id TEXT PRIMARY KEY, value BLOB)')
+        self._db.execute('DELETE FROM candidates')
+        self._db.commit()
+
+    def put(self, task_id, items, candidates):
+        """Store the items of a task and its candidates, whose references
+        to `items` are saved as positions.
+        """
+        blob = pickle.dumps((dump_items(items),
+                             dump_candidates(items, candidates)),
+                            pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO candidates '
+                             'VALUES (?, ?)', (task_id, sqlite3.Binary(blob)))
+            self._db.commit()
+
+    def get(self, task_id, db):
+        """Return the items of a task, with those already in the library
+        attached to `db`, its candidates and the dict caching their
+        medium indexes. Raise `KeyError` if they are not stored.
+        """
+        with self._lock:
+            loaded = self._loaded.pop(task_id, None)
+            if loaded is not None:
+                self.hits += 1
+                self._loaded[task_id] = loaded
+                return loaded
+            row = self._db.execute('SELECT value FROM candidates '
+                                   'WHERE id = ?', (task_id,)).fetchone()
+            self.reads += 1
+        if row is None:
+            raise KeyError(task_id)
+
+        items, candidates = pickle.loads(bytes(row[0]))
+        items = load_items(items, db)
+        loaded = (items, load_candidates(items, candidates), {})
+        with self._lock:
+            self._loaded[task_id] = loaded
+            while len(self._loaded) > self.loaded:
+                self._loaded.popitem(last=False)
+        return loaded
+
+    def delete(self, task_id):
+        with self._lock:
+            self._loaded.pop(task_id, None)
+            self._db.execute('DELETE FROM candidates WHERE id = ?',
+                             (task_id,))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) '
+                'FROM candidates').fetchone()
+            return {
+                'tasks': count,
+                'bytes': size,
+                'loaded': len(self._loaded),
+                'reads': self.reads,
+                'hits': self.hits,
+            }
+
+
+# Import events.
+
+Event = namedtuple('Event', ['id', 'type', 'time', 'data'])
+
+EVENT_TYPES = (
+    u'job-status',
+    u'task-discovered',
+    u'candidates-ready',
+    u'task-parked',
+    u'tasks-claimed',
+    u'tasks-released',
+    u'auto-applied',
+    u'skipped',
+    u'unchanged',
+    u'asis',
+    u'duplicate-found',
+    u'applied',
+)
+
+
+class EventBus(object):
+    """Keeps the most recent import events in a bounded buffer. Events
+    are numbered so that clients can resume from the last one they saw.
+
+    The IDs sent to clients are the numbers prefixed with the epoch of
+    the process, since numbering starts over after a restart.
+    """
+    def __init__(self, capacity=10000):
+        self._events = deque(maxlen=capacity)
+        self._next_id = 1
+        self._cond = threading.Condition()
+        self.epoch = u'{0:x}'.format(int(time.time() * 1000))
+        self.closed = False
+
+    def event_id(self, event):
+        return u'{0}-{1}'.format(self.epoch, event.id)
+
+    def parse_cursor(self, cursor):
+        """Return the number of the last event a client saw from the ID
+        it sent back, or 0 for all the buffered events if it was
+        numbered by another process. Raise `ValueError` if the ID is
+        malformed.
+        """
+        epoch, _, number = cursor.rpartition(u'-')
+        number = int(number)
+        if epoch != self.epoch:
+            return 0
+        return number
+
+    def publish(self, event_type, **data):
+        assert event_type in EVENT_TYPES
+        with self._cond:
+            event = Event(self._next_id, event_type, time.time(), data)
+            self._next_id += 1
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def since(self, cursor):
+        """Return the buffered events that come after the event numbered
+        `cursor`.
+        """
+        with self._cond:
+            if not self._events:
+                return []
+            start = max(cursor - self._events[0].id + 1, 0)
+            return [self._events[i] for i in range(start, len(self._events))]
+
+    def wait(self, cursor, timeout):
+        """Like `since`, but block for up to `timeout` seconds if there
+        are no new events yet. Return None once the bus is closed.
+        """
+        with self._cond:
+            if self._next_id - 1 <= cursor and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed:
+                return None
+        return self.since(cursor)
+
+    def close(self):
+        """Wake up the clients waiting for events, and have them stop.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+# Autotag lookup cache.
+
+# The item fields that influence a metadata lookup. Cached lookups are
+# only reused for items that agree on all of them.
+LOOKUP_ITEM_FIELDS = ('path', 'artist', 'album', 'albumartist', 'title',
+                      'track', 'tracktotal', 'disc', 'disctotal', 'length',
+                      'comp', 'mb_trackid', 'mb_albumid', 'mb_artistid',
+                      'mb_albumartistid')
+
+
+def items_digest(items):
+    """Return a digest of the tags of `items` that matter for lookups.
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(repr([item.get(f) for f in LOOKUP_ITEM_FIELDS])
+                      .encode('utf-8'))
+    return digest.hexdigest()
+
+
+def item_from_fields(fields, db=None):
+    """Rebuild an `Item` from the dict of its fields, attached to `db`.
+    """
+    # Skip the per-field checks of `Item(**fields)`: they cost as much as
+    # reading the tags again.
+    fixed, flex = {}, {}
+    for key, value in fields.items():
+        if key in beets.library.Item._fields:
+            fixed[key] = value
+        else:
+            flex[key] = value
+    return beets.library.Item._awaken(db, fixed, flex)
+
+
+def dump_items(items):
+    """Return a picklable copy of a list of items: their fields, and which
+    of them are not stored yet.
+    """
+    return [(dict(item), list(item._dirty)) for item in items]
+
+
+def load_items(dumped, db):
+    """Rebuild the items saved by `dump_items`. Those already in the
+    library are attached to `db`.
+    """
+    items = []
+    for fields, dirty in dumped:
+        item = item_from_fields(fields,
+                                db if fields.get('id') is not None else None)
+        item._dirty = set(dirty)
+        items.append(item)
+    return items
+
+
+def dump_candidates(items, candidates):
+    """Return a picklable copy of a list of AlbumMatch or TrackMatch
+    candidates where the references to `items` are replaced by their
+    positions in the list.
+    """
+    positions = dict((id(item), i) for i, item in enumerate(items))
+    out = []
+    for match in candidates:
+        if isinstance(match, autotag.AlbumMatch):
+            out.append((
+                match.distance, match.info,
+                [(positions[id(item)], track_info)
+                 for item, track_info in match.mapping.items()],
+                [positions[id(item)] for item in match.extra_items],
+                match.extra_tracks,
+            ))
+        else:
+            out.append((match.distance, match.info))
+    return out
+
+
+def load_candidates(items, dumped):
+    """Rebuild candidates saved by `dump_candidates` against `items`.
+    """
+    candidates = []
+    for match in dumped:
+        if len(match) == 2:
+            candidates.append(autotag.TrackMatch(*match))
+        else:
+            distance, info, mapping, extra_items, extra_tracks = match
+            candidates.append(autotag.AlbumMatch(
+                distance, info,
+                dict((items[i], track_info) for i, track_info in mapping),
+                [items[i] for i in extra_items],
+                extra_tracks,
+            ))
+    return candidates
+
+
+class _Lookup(object):
+    """A lookup in progress, shared by the threads asking for it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class LookupCache(object):
+    """A persistent cache of metadata lookups stored in an SQLite
+    database. Entries expire after `ttl` seconds and the least recently
+    used ones are evicted when the cache grows past `max_size` bytes.
+    Identical lookups running at the same time are coalesced into one.
+    """
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = self.misses = self.coalesced = 0
+        self._lock = threading.Lock()
+        self._lookups = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS lookups ('
+                         'key TEXT PRIMARY KEY, value BLOB, '
+                         'created REAL, accessed REAL, size INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS lookups_accessed '
+                         'ON lookups (accessed)')
+        self._db.execute('DELETE FROM lookups WHERE created < ?',
+                         (time.time() - ttl,))
+        self._db.commit()
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM lookups').fetchone()[0]
+
+    def get(self, key):
+        """Return the cached value for `key`, or None.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, created, size FROM lookups WHERE key = ?',
+                (key,)).fetchone()
+            if row and row[1] < now - self.ttl:
+                self._db.execute('DELETE FROM lookups WHERE key = ?', (key,))
+                self._size -= row[2]
+                row = None
+            if row:
+                self.hits += 1
+                self._db.execute('UPDATE lookups SET accessed = ? '
+                                 'WHERE key = ?', (now, key))
+            else:
+                self.misses += 1
+            self._db.commit()
+        if row:
+            return pickle.loads(bytes(row[0]))
+
+    def put(self, key, value):
+        """Store a value and evict the least recently used entries if
+        the cache is over its size budget.
+        """
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute('SELECT size FROM lookups WHERE key = ?',
+                                   (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._db.execute('INSERT OR REPLACE INTO lookups '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (key, sqlite3.Binary(blob), now, now, len(blob)))
+            self._size += len(blob)
+            while self._size > self.max_size:
+                row = self._db.execute('SELECT key, size FROM lookups '
+                                       'ORDER BY accessed LIMIT 1').fetchone()
+                if row is None:
+                    break
+                self._db.execute('DELETE FROM lookups WHERE key = ?',
+                                 (row[0],))
+                self._size -= row[1]
+            self._db.commit()
+
+    def lookup(self, key, func):
+        """Return the cached value for `key`, calling `func` to compute
+        it on a miss. Threads asking for a key that is already being
+        computed wait for that result instead of computing it again.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            lookup = self._lookups.get(key)
+            leader = lookup is None
+            if leader:
+                lookup = self._lookups[key] = _Lookup()
+            else:
+                self.coalesced += 1
+        if not leader:
+            lookup.done.wait()
+            if not lookup.failed:
+                return lookup.value
+            # The leader failed: try on our own.
+            return func()
+
+        try:
+            lookup.value = func()
+        except Exception:
+            lookup.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._lookups[key]
+            lookup.done.set()
+        self.put(key, lookup.value)
+        return lookup.value
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute(
+                'SELECT COUNT(*) FROM lookups').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'entries': entries,
+                'size': self._size,
+            }
+
+
+def observe_lookup(start, candidates):
+    """Account for the latency of a lookup that was not served from the
+    cache, by data source of its best candidate.
+    """
+    source = candidates[0].info.data_source if candidates else None
+    app.config['metrics'].lookup_seconds.observe(time.time() - start,
+                                                 source or u'none')
+
+
+def tag_album(items, search_artist=None, search_album=None, search_ids=[]):
+    """Like `autotag.tag_album`, but served from the lookup cache when
+    one is configured.
+    """
+    def lookup():
+        start = time.time()
+        cur_artist, cur_album, candidates, rec = autotag.tag_album(
+            items, search_artist, search_album, search_ids
+        )
+        observe_lookup(start, candidates)
+        return cur_artist, cur_album, candidates, rec
+
+    cache = app.config.get('lookup_cache')
+    if cache is None:
+        return lookup()
+
+    def cached_lookup():
+        cur_artist, cur_album, candidates, rec = lookup()
+        return cur_artist, cur_album, dump_candidates(items, candidates), rec
+
+    key = u'album:{0}'.format(hashlib.sha1(repr((
+        search_artist, search_album, list(search_ids), items_digest(items)
+    )).encode('utf-8')).hexdigest())
+    cur_artist, cur_album, candidates, rec = cache.lookup(key, cached_lookup)
+    return cur_artist, cur_album, load_candidates(items, candidates), rec
+
+
+def tag_item(item, search_artist=None, search_title=None, search_ids=[]):
+    """Like `autotag.tag_item`, but served from the lookup cache when
+    one is configured.
+    """
+    def lookup():
+        start = time.time()
+        candidates, rec = autotag.tag_item(item, search_artist,
+                                           search_title, search_ids)
+        observe_lookup(start, candidates)
+        return candidates, rec
+
+    cache = app.config.get('lookup_cache')
+    if cache is None:
+        return lookup()
+
+    def cached_lookup():
+        candidates, rec = lookup()
+        return dump_candidates([item], candidates), rec
+
+    key = u'item:{0}'.format(hashlib.sha1(repr((
+        search_artist, search_title, list(search_ids), items_digest([item])
+    )).encode('utf-8')).hexdigest())
+    candidates, rec = cache.lookup(key, cached_lookup)
+    return load_candidates([item], candidates), rec
+
+
+@pipeline.mutator_stage
+def lookup_candidates(session, windowed, task):
+    """A coroutine for performing the initial lookup for an album or an
+    item, like `importer.lookup_candidates` but through the lookup
+    cache. With `windowed`, lookups take a slot of the session's
+    prefetch window. Tasks coming back with a decision were already
+    looked up.
+    """
+    if task.skip or getattr(task, 'pending', None) is not None:
+        return
+
+    plugins.send('import_task_start', session=session, task=task)
+    log.debug(u'Looking up: {0}', displayable_path(task.paths))
+
+    # Restrict the initial lookup to IDs specified by the user via the -m
+    # option. Currently all the IDs are passed onto the tasks directly.
+    task.search_ids = session.config['search_ids'].as_str_seq()
+
+    # Don't run further ahead of the reviewers than allowed.
+    session.wait_for_room(u'lookup')
+    if windowed:
+        session.prefetch.acquire(session)
+    try:
+        if task.is_album:
+            task.cur_artist, task.cur_album, task.candidates, task.rec = \
+                tag_album(task.items, search_ids=task.search_ids)
+        else:
+            task.candidates, task.rec = tag_item(task.item,
+                                                 search_ids=task.search_ids)
+    except Exception:
+        if windowed:
+            session.prefetch.abandon()
+        raise
+    if windowed:
+        session.prefetch.charge(task)
+
+    task.looked_up = time.time()
+
+
+# Checking a task for duplicates and adding it to the library happen
+# under this lock, so that no task of another session is added in
+# between.
+_import_lock = threading.Lock()
+
+
+@pipeline.stage
+def user_query(session, task):
+    """Like `importer.user_query`, but a task waiting for a decision
+    does not hold up the stage: it is parked and leaves the pipeline,
+    then comes back through the session's `TaskFeed` once decided and
+    picks up where it left off. Tasks split into singletons or albums go
+    back through the feed to be looked up. The time spent choosing,
+    resolving duplicates and applying the choice is accounted
+    separately.
+    """
+    try:
+        out = _query_task(session, task)
+    except TaskParked:
+        return pipeline.BUBBLE
+    if not isinstance(task, importer.SentinelImportTask):
+        session.feed.finished()
+    return out
+
+
+def _query_task(session, task):
+    if task.skip:
+        return task
+
+    pending = getattr(task, 'pending', None)
+    if pending is None or pending.kind != PendingTask.DUPLICATE:
+        # Ask the user for a choice.
+        with session.timed(u'choose'):
+            task.choose_match(session)
+        plugins.send('import_task_choice', session=session, task=task)
+
+        # As-tracks: transition to singleton workflow.
+        if task.choice_flag is importer.action.TRACKS:
+            tasks = []
+            for item in task.items:
+                item_task = importer.SingletonImportTask(task.toppath, item)
+                tasks += item_task.handle_created(session)
+            session.feed.add(session.split(task, tasks))
+            return pipeline.BUBBLE
+
+        # As albums: group items by albums and create task for each album.
+        if task.choice_flag is importer.action.ALBUMS:
+            tasks = album_tasks(session, task)
+            session.feed.add(session.split(task, tasks))
+            return pipeline.BUBBLE
+
+    with _import_lock:
+        with session.timed(u'duplicates'):
+            resolve_duplicates(session, task)
+        if not session.dry_run:
+            with session.timed(u'apply'):
+                importer.apply_choice(session, task)
+    if session.dry_run:
+        session.plan(task)
+        return
+    return task
+
+
+def resolve_duplicates(session, task):
+    """Like `importer.resolve_duplicates`, but a task coming back with a
+    decision about its duplicates takes it without looking for them
+    again. Dry runs record the duplicates found for their plan, and the
+    resolutions are counted in the metrics, whatever the configured
+    `duplicate_action`.
+    """
+    pending = getattr(task, 'pending', None)
+    if pending is not None and pending.kind == PendingTask.DUPLICATE:
+        session.resolve_duplicate(task, pending.duplicates)
+    else:
+        if task.choice_flag not in (importer.action.ASIS,
+                                    importer.action.APPLY,
+                                    importer.action.RETAG):
+            return
+        found_duplicates = task.find_duplicates(session.lib)
+        if not found_duplicates:
+            return
+        log.warn(u"This {0} is already in the library!",
+                 (u"album" if task.is_album else u"item"))
+        session.emit(u'duplicate-found', task,
+                     duplicates=len(found_duplicates))
+        if session.dry_run:
+            task.found_duplicates = found_duplicates
+
+        duplicate_action = config['import']['duplicate_action'].as_choice({
+            u'skip': u's',
+            u'keep': u'k',
+            u'remove': u'r',
+            u'ask': u'a',
+        })
+        if duplicate_action == u's':
+            # Skip new.
+            task.set_choice(importer.action.SKIP)
+        elif duplicate_action == u'r':
+            # Remove old.
+            task.should_remove_duplicates = True
+        elif duplicate_action == u'a':
+            session.resolve_duplicate(task, found_duplicates)
+    session.log_choice(task, True)
+
+    if task.choice_flag is importer.action.SKIP:
+        resolution = u'skip'
+    elif task.should_remove_duplicates:
+        resolution = u'remove'
+    else:
+        resolution = u'keep'
+    app.config['metrics'].duplicates.inc(resolution)
+
+
+def album_tasks(session, task):
+    """Split the items of a task into one album task per album artist
+    and album, like `importer.group_albums` does.
+    """
+    def group(item):
+        return (item.albumartist or item.artist, item.album)
+
+    tasks = []
+    for _, items in itertools.groupby(sorted(task.items, key=group), group):
+        items = list(items)
+        album = importer.ImportTask(task.toppath, [i.path for i in items],
+                                    items)
+        tasks += album.handle_created(session)
+    return tasks
+
+
+@pipeline.stage
+def group_albums(session, task):
+    """Like `importer.group_albums`, but the tasks coming back through
+    the feed are let through as they are, and the progress of the
+    directory is only saved once all its albums are done.
+    """
+    if task.skip or getattr(task, 'pending', None) is not None or \
+            getattr(task, 'split', None) is not None:
+        return task
+    tasks = session.split(task, album_tasks(session, task))
+    session.feed.expect(len(tasks) - 1)
+    return pipeline.multiple(tasks)
+
+
+class TaskSplit(object):
+    """An import task split into albums or singletons, with the number
+    of them that are not done yet.
+    """
+    __slots__ = ('task', 'left')
+
+    def __init__(self, task, left):
+        self.task = task
+        self.left = left
+
+
+# Candidate prefetching.
+
+# Rough memory cost of a candidate and of each track it lists.
+CANDIDATE_SIZE = 4096
+CANDIDATE_TRACK_SIZE = 2048
+
+
+def candidates_size(candidates):
+    """Estimate the memory held by a list of candidates, in bytes.
+    """
+    size = 0
+    for match in candidates:
+        size += CANDIDATE_SIZE
+        if isinstance(match, autotag.AlbumMatch):
+            size += CANDIDATE_TRACK_SIZE * len(match.info.tracks)
+        else:
+            size += CANDIDATE_TRACK_SIZE
+    return size
+
+
+class PrefetchWindow(object):
+    """Limits how far the lookup stage runs ahead of the reviewers.
+
+    A lookup takes a slot before it starts and gives it back once its
+    task is parked or a choice has been made for it. No more than
+    `depth` tasks hold a slot at a time, and no new lookup starts while
+    the candidates of the tasks holding one are estimated to take more
+    than `max_memory` bytes.
+    """
+    def __init__(self, depth, max_memory):
+        self.depth = depth
+        self.max_memory = max_memory
+        self.count = 0
+        self.memory = 0
+        self._sizes = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, session):
+        with self._cond:
+            while self.count >= self.depth or \
+                    (self.count and self.memory >= self.max_memory):
+                self._cond.wait(1.0)
+                session.check_abort()
+            self.count += 1
+
+    def charge(self, task):
+        """Account for the candidates found for a task.
+        """
+        size = candidates_size(task.candidates)
+        with self._cond:
+            self._sizes[id(task)] = size
+            self.memory += size
+
+    def abandon(self):
+        """Give back the slot of a lookup that failed.
+        """
+        with self._cond:
+            self.count -= 1
+            self._cond.notify_all()
+
+    def release(self, task):
+        with self._cond:
+            if id(task) not in self._sizes:
+                return
+            self.memory -= self._sizes.pop(id(task))
+            self.count -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'tasks': self.count, 'memory': self.memory,
+                    'depth': self.depth, 'max_memory': self.max_memory}
+
+
+# Tag reading.
+
+class TagReader(object):
+    """Reads the tags of media files on a pool of threads, with at most
+    `per_device` reads at a time on any one device, and keeps count of
+    the files read.
+    """
+    def __init__(self, workers, per_device):
+        self.workers = workers
+        self.per_device = per_device
+        self.files = 0
+        self.seconds = 0.0
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, device):
+        with self._lock:
+            if device not in self._devices:
+                self._devices[device] = \
+                    threading.BoundedSemaphore(self.per_device)
+            return self._devices[device]
+
+    def read(self, read_item, paths):
+        """Read the files at `paths` with `read_item` and return the
+        items, in order, leaving out the files that could not be read.
+        """
+        start = time.time()
+        semaphores = {}
+        for dirname in set(os.path.dirname(p) for p in paths):
+            try:
+                device = os.stat(syspath(dirname)).st_dev
+            except OSError:
+                device = None
+            semaphores[dirname] = self._semaphore(device)
+
+        def read_one(path):
+            with semaphores[os.path.dirname(path)]:
+                return read_item(path)
+
+        if self._pool is not None and len(paths) > 1:
+            items = self._pool.map(read_one, paths)
+        else:
+            items = [read_one(p) for p in paths]
+        with self._lock:
+            self.files += len(paths)
+            self.seconds += time.time() - start
+        return [item for item in items if item]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'per_device': self.per_device,
+                'files': self.files,
+                'seconds': self.seconds,
+                'files_per_second':
+                    self.files / self.seconds if self.seconds else None,
+            }
+
+
+class ItemCache(object):
+    """A persistent cache of the items read from media files, stored in
+    an SQLite database. An entry is only used while the file keeps the
+    modification time and size it had when it was read, and the least
+    recently used entries are evicted past `max_size` bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = self.misses = self.stale = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # A lost write only costs reading the file again.
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE IF NOT EXISTS items ('
+                         'key TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                         'value BLOB, accessed REAL, bytes INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS items_accessed '
+                         'ON items (accessed)')
+        self._db.commit()
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(bytes), 0) FROM items').fetchone()[0]
+
+    @staticmethod
+    def key(path):
+        return hashlib.sha1(path).hexdigest()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(syspath(path))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def get(self, path):
+        """Return a new `Item` for the file at `path` if it hasn't
+        changed since it was cached, or None.
+        """
+        stamp = self._stat(path)
+        key = self.key(path)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT mtime, size, value, bytes FROM items WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or stamp is None:
+                self.misses += 1
+                return None
+            if tuple(row[:2]) != stamp:
+                self.stale += 1
+                self._db.execute('DELETE FROM items WHERE key = ?', (key,))
+                self._size -= row[3]
+                self._db.commit()
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE items SET accessed = ? WHERE key = ?',
+                             (time.time(), key))
+            self._db.commit()
+        return item_from_fields(pickle.loads(bytes(row[2])))
+
+    def put(self, path, item):
+        """Store the fields of an item read from `path`, and evict the
+        least recently used entries if the cache is over its budget.
+        """
+        stamp = self._stat(path)
+        if stamp is None:
+            return
+        blob = pickle.dumps(dict(item), pickle.HIGHEST_PROTOCOL)
+        key = self.key(path)
+        with self._lock:
+            old = self._db.execute('SELECT bytes FROM items WHERE key = ?',
+                                   (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._db.execute('INSERT OR REPLACE INTO items '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, stamp[0], stamp[1], sqlite3.Binary(blob),
+                              time.time(), len(blob)))
+            self._size += len(blob)
+            while self._size > self.max_size:
+                row = self._db.execute('SELECT key, bytes FROM items '
+                                       'ORDER BY accessed LIMIT 1').fetchone()
+                if row is None:
+                    break
+                self._db.execute('DELETE FROM items WHERE key = ?',
+                                 (row[0],))
+                self._size -= row[1]
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute(
+                'SELECT COUNT(*) FROM items').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'entries': entries,
+                'size': self._size,
+            }
+
+
+# Inbox scanning.
+
+def _list_dir(path):
+    """Return `(name, is_dir, mtime, size)` tuples for the entries of a
+    directory, stat'ing only the files when `scandir` is available.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(syspath(path)):
+            try:
+                if entry.is_dir():
+                    entries.append((entry.name, True, 0, 0))
+                    continue
+                st = entry.stat()
+            except OSError:
+                # Broken link: let the importer report it.
+                entries.append((entry.name, False, 0, 0))
+            else:
+                entries.append((entry.name, False, st.st_mtime, st.st_size))
+    else:
+        for name in os.listdir(syspath(path)):
+            cur = os.path.join(path, name)
+            if os.path.isdir(syspath(cur)):
+                entries.append((name, True, 0, 0))
+                continue
+            try:
+                st = os.stat(syspath(cur))
+            except OSError:
+                entries.append((name, False, 0, 0))
+            else:
+                entries.append((name, False, st.st_mtime, st.st_size))
+    return entries
+
+
+def scan_walk(path, ignore=(), ignore_hidden=False):
+    """Like `beets.util.sorted_walk`, but yield `(path, dirs, files,
+    stamp)` tuples where `stamp` is the `(mtime, size)` summary of the
+    directory: the latest modification time of the directory and its
+    files, and the total size of the files.
+    """
+    path = bytestring_path(path)
+    try:
+        entries = _list_dir(path)
+        mtime = os.stat(syspath(path)).st_mtime
+    except OSError as exc:
+        log.warn(u'could not list directory {0}: {1}',
+                 displayable_path(path), exc.strerror)
+        return
+    dirs = []
+    files = []
+    size = 0
+    for base, is_dir, entry_mtime, entry_size in entries:
+        base = bytestring_path(base)
+        if any(fnmatch.fnmatch(base, pat) for pat in ignore):
+            continue
+        if ignore_hidden and hidden.is_hidden(os.path.join(path, base)):
+            continue
+        if is_dir:
+            dirs.append(base)
+        else:
+            files.append(base)
+            mtime = max(mtime, entry_mtime)
+            size += entry_size
+
+    dirs.sort(key=bytes.lower)
+    files.sort(key=bytes.lower)
+    yield path, dirs, files, (mtime, size)
+
+    for base in dirs:
+        for res in scan_walk(os.path.join(path, base), ignore,
+                             ignore_hidden):
+            yield res
+
+
+def _merge_stamps(a, b):
+    return max(a[0], b[0]), a[1] + b[1]
+
+
+def scan_albums(path):
+    """Like `importer.albums_in_dir`, including the collapsing of
+    multi-disc albums, but walk with `scan_walk` and yield `(dirs, paths,
+    stamp)` triples. The stamp of an album changes whenever one of its
+    files is added, removed or rewritten.
+    """
+    collapse_pat = collapse_paths = collapse_items = collapse_stamp = None
+    ignore = config['ignore'].as_str_seq()
+    ignore_hidden = config['ignore_hidden'].get(bool)
+
+    for root, dirs, files, stamp in scan_walk(path, ignore, ignore_hidden):
+        items = [os.path.join(root, f) for f in files]
+        # Keep collapsing the directories of a multi-disc album as long
+        # as they belong to it.
+        if collapse_paths:
+            if (not collapse_pat and collapse_paths[0] in ancestry(root)) or \
+                    (collapse_pat and
+                     collapse_pat.match(os.path.basename(root))):
+                collapse_paths.append(root)
+                collapse_items += items
+                collapse_stamp = _merge_stamps(collapse_stamp, stamp)
+                continue
+            else:
+                if collapse_items:
+                    yield collapse_paths, collapse_items, collapse_stamp
+                collapse_pat = collapse_paths = collapse_items = None
+
+        # Check whether this directory starts a multi-disc album.
+        start_collapsing = False
+        for marker in importer.MULTIDISC_MARKERS:
+            marker_pat = re.compile(importer.MULTIDISC_PAT_FMT % marker, re.I)
+            match = marker_pat.match(os.path.basename(root))
+
+            # Is this directory the root of a nested multi-disc album?
+            if dirs and not items:
+                start_collapsing = True
+                subdir_pat = None
+                for subdir in dirs:
+                    if not subdir_pat:
+                        match = marker_pat.match(subdir)
+                        if match:
+                            subdir_pat = re.compile(
+                                br'^%s\d' % re.escape(match.group(1)), re.I
+                            )
+                        else:
+                            start_collapsing = False
+                            break
+                    elif not subdir_pat.match(subdir):
+                        start_collapsing = False
+                        break
+                if start_collapsing:
+                    break
+
+            # Is this directory the first in a flattened multi-disc album?
+            elif match:
+                start_collapsing = True
+                collapse_pat = re.compile(
+                    br'^%s\d' % re.escape(match.group(1)), re.I
+                )
+                break
+
+        if start_collapsing:
+            collapse_paths = [root]
+            collapse_items = items
+            collapse_stamp = stamp
+            continue
+
+        if items:
+            yield [root], items, stamp
+
+    # Clear out any unfinished collapse.
+    if collapse_paths and collapse_items:
+        yield collapse_paths, collapse_items, collapse_stamp
+
+
+class ScanCache(object):
+    """Remembers the stamp of the album directories that went through an
+    import, in an SQLite database, so that later scans of the same inbox
+    can skip the ones that haven't changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.unchanged = self.changed = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS scanned ('
+                         'key TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                         'scanned REAL)')
+        self._db.commit()
+
+    @staticmethod
+    def key(dirs):
+        return hashlib.sha1(b'\0'.join(sorted(dirs))).hexdigest()
+
+    def is_unchanged(self, dirs, stamp):
+        """Tell whether the album in `dirs` was seen with the same stamp.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT mtime, size FROM scanned WHERE key = ?',
+                (self.key(dirs),)).fetchone()
+            unchanged = row is not None and tuple(row) == tuple(stamp)
+            if unchanged:
+                self.unchanged += 1
+            else:
+                self.changed += 1
+            return unchanged
+
+    def record(self, dirs, stamp):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO scanned '
+                             'VALUES (?, ?, ?, ?)',
+                             (self.key(dirs), stamp[0], stamp[1],
+                              time.time()))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute(
+                'SELECT COUNT(*) FROM scanned').fetchone()[0]
+            return {
+                'unchanged': self.unchanged,
+                'changed': self.changed,
+                'entries': entries,
+            }
+
+
+class WebImportTaskFactory(importer.ImportTaskFactory):
+    """A task factory that walks directories with `scan_albums` and
+    skips the albums the scan cache knows to be unchanged. Re-imports of
+    the library's own directory never skip any.
+    """
+    def __init__(self, toppath, session):
+        super(WebImportTaskFactory, self).__init__(toppath, session)
+        self.cache = app.config.get('scan_cache')
+        directory = session.lib.directory
+        if toppath == directory or directory in ancestry(toppath):
+            self.cache = None
+        self._stamp = None
+
+    def unchanged(self, dirs, stamp):
+        """Tell whether the scan cache knows the album in `dirs` to be
+        unchanged, and report it as skipped if so.
+        """
+        if self.cache is None or not self.cache.is_unchanged(dirs, stamp):
+            return False
+        log.debug(u'Skipping unchanged directory: {0}',
+                  displayable_path(dirs))
+        self.skipped += 1
+        self.session.skip_unchanged(dirs)
+        return True
+
+    def paths(self):
+        if not os.path.isdir(syspath(self.toppath)) or \
+                self.session.config['flat']:
+            for res in super(WebImportTaskFactory, self).paths():
+                self._stamp = None
+                yield res
+            return
+
+        for dirs, paths, stamp in scan_albums(self.toppath):
+            if self.unchanged(dirs, stamp):
+                continue
+            self._stamp = (dirs, stamp)
+            yield dirs, paths
+
+    def read_item(self, path):
+        """Return an `Item` read from the path, or from the item cache if
+        the file hasn't changed since it was last read.
+        """
+        cache = app.config.get('item_cache')
+        if cache is None:
+            return super(WebImportTaskFactory, self).read_item(path)
+        item = cache.get(path)
+        if item is None:
+            item = super(WebImportTaskFactory, self).read_item(path)
+            if item:
+                cache.put(path, item)
+        return item
+
+    def album(self, paths, dirs=None):
+        """Like `ImportTaskFactory.album`, but read the files on the
+        application's `TagReader`.
+        """
+        if not paths:
+            return None
+
+        if dirs is None:
+            dirs = list(set(os.path.dirname(p) for p in paths))
+
+        if self.session.already_imported(self.toppath, dirs):
+            log.debug(u'Skipping previously-imported path: {0}',
+                      displayable_path(dirs))
+            self.skipped += 1
+            return None
+
+        items = app.config['tag_reader'].read(self.read_item, paths)
+        if not items:
+            return None
+        task = importer.ImportTask(self.toppath, dirs, items)
+        task.scan_stamp = self._stamp
+        return task
+
+    def sentinel(self, paths=None):
+        task = super(WebImportTaskFactory, self).sentinel(paths)
+        if paths is not None:
+            # Singleton imports finish a directory with a sentinel.
+            task.scan_stamp = self._stamp
+        return task
+
+    def found(self, dirs, paths, stamp):
+        """Return the tasks for one album found outside of `paths`, by a
+        watcher.
+        """
+        if self.unchanged(dirs, stamp):
+            return []
+        self._stamp = (dirs, stamp)
+        if self.session.config['singletons']:
+            tasks = []
+            for path in paths:
+                tasks += self._create(self.singleton(path))
+            return tasks + [self.sentinel(dirs)]
+        return self._create(self.album(paths, dirs))
+
+
+def read_tasks(session):
+    """Like `importer.read_tasks`, but with a `WebImportTaskFactory`:
+    tasks are streamed into the pipeline as albums are found, and
+    unchanged albums are left out.
+    """
+    skipped = 0
+    for toppath in session.paths:
+        # Check whether we need to resume the import.
+        session.ask_resume(toppath)
+
+        # Generate tasks.
+        task_factory = WebImportTaskFactory(toppath, session)
+        for t in task_factory.tasks():
+            yield t
+            # Read no further while reviewers are behind.
+            session.wait_for_room(u'read')
+        skipped += task_factory.skipped
+
+        if not task_factory.imported:
+            log.warn(u'No files imported from {0}',
+                     displayable_path(toppath))
+
+    # Show skipped directories (due to incremental/resume/unchanged).
+    if skipped:
+        log.info(u'Skipped {0} paths.', skipped)
+
+
+# Watched folders.
+
+class InboxWatcher(object):
+    """Finds the albums that have settled in a set of watched
+    directories: an album is ready once its stamp has stayed the same
+    for `settle` seconds, and is handed out only once per stamp.
+    """
+    def __init__(self, settle):
+        self.settle = settle
+        self.polls = self.found = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def poll(self, toppaths, now=None):
+        """Scan the directories once and return `(toppath, dirs, paths,
+        stamp)` tuples for the albums that became ready.
+        """
+        if now is None:
+            now = time.time()
+        ready = []
+        present = set()
+        for toppath in toppaths:
+            for dirs, paths, stamp in scan_albums(toppath):
+                key = tuple(dirs)
+                present.add(key)
+                with self._lock:
+                    entry = self._seen.get(key)
+                    if entry is None or entry[0] != stamp:
+                        # New or still changing: wait for it to settle.
+                        self._seen[key] = [stamp, now, False]
+                        continue
+                    if entry[2] or now - entry[1] < self.settle:
+                        continue
+                    entry[2] = True
+                ready.append((toppath, dirs, paths, stamp))
+
+        with self._lock:
+            # Forget the albums that went away, e.g. moved by an import.
+            for key in set(self._seen) - present:
+                del self._seen[key]
+            self.polls += 1
+            self.found += len(ready)
+        return ready
+
+    def stats(self):
+        with self._lock:
+            return {
+                'polls': self.polls,
+                'found': self.found,
+                'settling': sum(1 for e in self._seen.values() if not e[2]),
+            }
+
+
+def watch_tasks(session):
+    """A generator yielding the tasks for the albums that settle in the
+    directories watched by the session's job, until the job is aborted
+    or the server shuts down.
+
+    Each batch of albums found in a directory is followed by the
+    sentinel that ends an import of it: once the batch is done, it drops
+    the progress saved for resuming the batch, which would otherwise
+    grow for as long as the job runs.
+    """
+    job = session.job
+    factories = OrderedDict((p, WebImportTaskFactory(p, session))
+                            for p in session.paths)
+    jobs = app.config['jobs']
+    while not jobs.closed:
+        batches = []
+        for toppath, dirs, paths, stamp in job.watcher.poll(list(factories)):
+            tasks = factories[toppath].found(dirs, paths, stamp)
+            if tasks and toppath not in batches:
+                batches.append(toppath)
+            for task in tasks:
+                yield task
+                session.wait_for_room(u'read')
+        for toppath in batches:
+            yield factories[toppath].sentinel()
+
+        deadline = time.time() + job.interval
+        while not jobs.closed and time.time() < deadline:
+            session.check_abort()
+            time.sleep(min(1.0, max(deadline - time.time(), 0)))
+
+
+# Task feed.
+
+class TaskFeed(object):
+    """The first stage of a session's pipeline: yields the tasks of
+    `source`, and the tasks sent back once decided or split.
+
+    A thread reads the source one task ahead, so that decided tasks go
+    back into the pipeline while the source blocks. `outstanding` counts
+    the tasks yielded that have not made it through the user query
+    stage yet, parked ones included. Sentinel tasks save the progress of
+    what was read before them and clean up extracted archives: they are
+    held back until no task is outstanding.
+
+    Without `returns`, the tasks of the source are yielded as they are.
+    """
+    def __init__(self, session, source, returns=True):
+        self.session = session
+        self.source = source
+        self.returns = returns
+        self.outstanding = 0
+        self._read = deque()
+        self._returned = deque()
+        self._held = deque()
+        self._error = None
+        self._exhausted = False
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def tasks(self):
+        if not self.returns:
+            for task in self.source:
+                yield task
+            return
+
+        reader = threading.Thread(target=self._pump)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                task = self._next()
+                if task is None:
+                    return
+                yield task
+        finally:
+            self.close()
+
+    def _pump(self):
+        try:
+            for task in self.source:
+                with self._cond:
+                    while self._read and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    self._read.append(task)
+                    self._cond.notify_all()
+        except Exception as exc:
+            with self._cond:
+                self._error = exc
+        finally:
+            with self._cond:
+                self._exhausted = True
+                self._cond.notify_all()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._returned:
+                    return self._returned.popleft()
+                if self._held and not self.outstanding:
+                    return self._held.popleft()
+                if self._read:
+                    task = self._read.popleft()
+                    self._cond.notify_all()
+                    if isinstance(task, importer.SentinelImportTask):
+                        self._held.append(task)
+                        continue
+                    self.outstanding += 1
+                    return task
+                if self._error is not None:
+                    raise self._error
+                if self._closed or \
+                        (self._exhausted and not self.outstanding):
+                    return None
+                self._cond.wait(1.0)
+                self.session.check_abort()
+
+    def add(self, tasks):
+        """Feed new tasks to the pipeline, like those a task was split
+        into.
+        """
+        with self._cond:
+            self.outstanding += len(tasks)
+            self._returned.extend(tasks)
+            self._cond.notify_all()
+
+    def requeue(self, task):
+        """Send a decided task back into the pipeline.
+        """
+        with self._cond:
+            self._returned.append(task)
+            self._cond.notify_all()
+
+    def expect(self, count):
+        """Account for `count` more outstanding tasks, emitted by a later
+        stage.
+        """
+        with self._cond:
+            self.outstanding += count
+            self._cond.notify_all()
+
+    def finished(self):
+        """Called once a task made it through the user query stage.
+        """
+        with self._cond:
+            self.outstanding -= 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+# File operations.
+
+# The Linux ioctl making a file share the data blocks of another, on
+# file systems that can clone files (Btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+# Errors meaning that a file system can't clone files at all.
+NO_REFLINK = frozenset([errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                        errno.EXDEV, errno.ENOSYS])
+
+# A file to put in place: `mode` is "move", "copy" or "link".
+FileOp = namedtuple('FileOp', ['source', 'dest', 'mode'])
+
+
+def reflink(source, dest):
+    """Make `dest` a copy-on-write clone of `source`. Raise an
+    `IOError` if the file system can't clone it.
+    """
+    with open(source, 'rb') as src:
+        try:
+            with open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (OSError, IOError):
+            try:
+                os.remove(dest)
+            except OSError:
+                pass
+            raise
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TransferStats(object):
+    """Counts the files put in place by file operations, and their
+    bytes, by method (rename, reflink, hardlink, copy, symlink), with
+    the time the operations took.
+    """
+    def __init__(self):
+        self.files = Counter()
+        self.bytes = Counter()
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, results, seconds):
+        with self._lock:
+            for method, size in results:
+                if method is not None:
+                    self.files[method] += 1
+                    self.bytes[method] += size
+            self.seconds += seconds
+
+    def by_method(self):
+        """Return `{method: (files, bytes)}`.
+        """
+        with self._lock:
+            return dict((method, (count, self.bytes[method]))
+                        for method, count in self.files.items())
+
+    def to_dict(self):
+        with self._lock:
+            size = sum(self.bytes.values())
+            return {
+                'files': sum(self.files.values()),
+                'bytes': size,
+                'seconds': self.seconds,
+                'bytes_per_second':
+                    size / self.seconds if self.seconds else None,
+                'methods': dict((method, {'files': count,
+                                          'bytes': self.bytes[method]})
+                                for method, count in self.files.items()),
+            }
+
+
+class FileOpsError(FilesystemError):
+    """Raised by `FileScheduler.run` when some file operations failed,
+    once all of them are over. `results` has the outcome of every
+    operation as `run` returns them, with None for the failed ones.
+    """
+    def __init__(self, error, results):
+        super(FileOpsError, self).__init__(error.reason, error.verb,
+                                           error.paths, error.tb)
+        self.results = results
+
+
+class FileScheduler(object):
+    """Moves, copies and links the files of import tasks on a pool of
+    threads, with at most `per_device` operations at a time on any one
+    device, and in the cheapest way available: a rename for moves
+    within a device, then a reflink or (if `hardlink` is set) a hard
+    link for copies, before copying the data.
+    """
+    def __init__(self, workers, per_device, reflink=True, hardlink=False,
+                 fsync=True):
+        self.workers = workers
+        self.per_device = per_device
+        self.reflink = reflink and fcntl is not None
+        self.hardlink = hardlink
+        self.fsync = fsync
+        self.totals = TransferStats()
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        self._devices = {}
+        self._no_reflink = set()
+        self._lock = threading.Lock()
+
+    def _semaphore(self, device):
+        with self._lock:
+            if device not in self._devices:
+                self._devices[device] = \
+                    threading.BoundedSemaphore(self.per_device)
+            return self._devices[device]
+
+    def run(self, ops, write=False, stats=None):
+        """Carry out a list of `FileOp` and return a `(method, size)`
+        pair for each of them, in order; the method is None when the
+        file was already in place. Copies are not hard-linked when
+        `write` is set, as writing their tags would change the sources.
+        The data and directories written are synced once all the
+        operations are done.
+
+        When some operations fail, the others still run to the end and
+        are synced before `FileOpsError` is raised.
+        """
+        start = time.time()
+        devices = {}
+        for dirname in set(os.path.dirname(syspath(p)) for op in ops
+                           for p in (op.source, op.dest)):
+            try:
+                devices[dirname] = os.stat(dirname).st_dev
+            except OSError:
+                devices[dirname] = None
+
+        def run_one(op):
+            source, dest = syspath(op.source), syspath(op.dest)
+            src_device = devices[os.path.dirname(source)]
+            dest_device = devices[os.path.dirname(dest)]
+            # Take the semaphores in the same order everywhere.
+            semaphores = [self._semaphore(d) for d in
+                          sorted(set([src_device, dest_device]), key=repr)]
+            for semaphore in semaphores:
+                semaphore.acquire()
+            try:
+                return self._place(op.mode, source, dest,
+                                   dest_device if src_device == dest_device
+                                   else None, write)
+            except FilesystemError as exc:
+                return exc
+            finally:
+                for semaphore in reversed(semaphores):
+                    semaphore.release()
+
+        if self._pool is not None and len(ops) > 1:
+            results = self._pool.map(run_one, ops)
+        else:
+            results = [run_one(op) for op in ops]
+        errors = [r for r in results if isinstance(r, FilesystemError)]
+        results = [None if isinstance(r, FilesystemError) else r
+                   for r in results]
+        done = [(op, r) for op, r in zip(ops, results) if r is not None]
+
+        if self.fsync and done:
+            try:
+                self._sync(*zip(*done))
+            except FilesystemError as exc:
+                errors.append(exc)
+        seconds = time.time() - start
+        self.totals.add([r for _, r in done], seconds)
+        if stats is not None:
+            stats.add([r for _, r in done], seconds)
+        if errors:
+            raise FileOpsError(errors[0], results)
+        return results
+
+    def _place(self, mode, source, dest, device, write):
+        """Put one file in place. `device` is the device of both paths,
+        or None if they are on different ones.
+        """
+        if samefile(source, dest):
+            return None, 0
+        if os.path.exists(dest):
+            raise FilesystemError(u'file exists', mode, (source, dest))
+        try:
+            size = os.path.getsize(source)
+            if mode == u'link':
+                os.symlink(source, dest)
+                return u'symlink', size
+            if mode == u'move' and device is not None:
+                try:
+                    os.rename(source, dest)
+                    return u'rename', size
+                except OSError:
+                    pass
+            method = self._copy(source, dest, device, write)
+            if mode == u'move':
+                os.remove(source)
+            return method, size
+        except (OSError, IOError) as exc:
+            raise FilesystemError(exc, mode, (source, dest),
+                                  traceback.format_exc())
+
+    def _copy(self, source, dest, device, write):
+        if device is not None and self.reflink and \
+                device not in self._no_reflink:
+            try:
+                reflink(source, dest)
+                return u'reflink'
+            except (OSError, IOError) as exc:
+                if exc.errno not in NO_REFLINK:
+                    raise
+                with self._lock:
+                    self._no_reflink.add(device)
+        if device is not None and self.hardlink and not write:
+            try:
+                os.link(source, dest)
+                return u'hardlink'
+            except OSError:
+                pass
+        shutil.copyfile(source, dest)
+        return u'copy'
+
+    def _sync(self, ops, results):
+        """Flush the data of the copied files, then the directories
+        whose entries changed, each once.
+        """
+        files = []
+        dirs = set()
+        for op, (method, _) in zip(ops, results):
+            if method is None:
+                continue
+            if method not in (u'rename', u'symlink'):
+                files.append(syspath(op.dest))
+            dirs.add(os.path.dirname(syspath(op.dest)))
+            if op.mode == u'move':
+                dirs.add(os.path.dirname(syspath(op.source)))
+        try:
+            if self._pool is not None and len(files) > 1:
+                self._pool.map(fsync_path, files)
+            else:
+                for path in files:
+                    fsync_path(path)
+        except (OSError, IOError) as exc:
+            raise FilesystemError(exc, u'write', files,
+                                  traceback.format_exc())
+        for path in dirs:
+            try:
+                fsync_path(path)
+            except OSError:
+                # Not every platform can sync a directory.
+                pass
+
+
+def place_files(session, task, move=False, copy=False, write=False,
+                link=False):
+    """Like `ImportTask.manipulate_files`, but hand the files of the
+    task to the file scheduler, which puts them in place in parallel.
+    """
+    items = task.imported_items()
+    # Save the original paths of all items for deletion and pruning
+    # in the next step (finalization).
+    task.old_paths = [item.path for item in items]
+    if move or copy or link:
+        mode = u'copy' if copy else u'link' if link else u'move'
+        pending = []
+        for item in items:
+            old_path = item.path
+            if (copy or link) and task.replaced_items[item] and \
+                    session.lib.directory in ancestry(old_path):
+                # Re-imports of files in the library are moved.
+                item.move()
+                task.old_paths.remove(old_path)
+            else:
+                dest = item.destination()
+                mkdirall(dest)
+                pending.append((item, dest))
+
+        albums = {}
+        while pending:
+            # Items sharing a destination get unique paths one round
+            # at a time, as the files of a round don't exist yet.
+            batch, claimed, deferred = [], set(), []
+            for item, dest in pending:
+                path = dest if samefile(item.path, dest) \
+                    else unique_path(dest)
+                if path in claimed:
+                    deferred.append((item, dest))
+                else:
+                    claimed.add(path)
+                    batch.append((item, path))
+            pending = deferred
+
+            if mode == u'move':
+                for item, dest in batch:
+                    plugins.send('before_item_moved', item=item,
+                                 source=item.path, destination=dest)
+            try:
+                results = app.config['file_ops'].run(
+                    [FileOp(item.path, dest, mode) for item, dest in batch],
+                    write, session.transfers)
+            except FileOpsError as exc:
+                failed, results = exc, exc.results
+            else:
+                failed = None
+            for (item, dest), result in zip(batch, results):
+                if result is None:
+                    continue
+                old_path = item.path
+                plugins.send('item_{0}'.format(
+                    {u'move': u'moved', u'copy': u'copied',
+                     u'link': u'linked'}[mode]),
+                    item=item, source=old_path, destination=dest)
+                item.path = dest
+                if item.album_id is not None:
+                    albums[item.album_id] = item
+                if not copy:
+                    prune_dirs(os.path.dirname(old_path),
+                               session.lib.directory)
+            if failed is not None:
+                # Keep the library in line with the files already put in
+                # place before failing the task.
+                with session.lib.transaction():
+                    for item in items:
+                        item.store()
+                raise failed
+
+        # Let the albums move their art along with the items.
+        for item in albums.values():
+            album = item.get_album()
+            if album:
+                album.move_art(copy)
+                album.store()
+
+    if write and (task.apply or task.choice_flag == importer.action.RETAG):
+        for item in items:
+            item.try_write()
+
+    with session.lib.transaction():
+        for item in task.imported_items():
+            item.store()
+
+    plugins.send('import_task_files', session=session, task=task)
+
+
+# Dry runs.
+
+# Plan entries a dry run buffers ahead of the client streaming it before
+# the pipeline waits, and keeps after streaming them for it to resume.
+PLAN_BUFFER = 1000
+
+PLAN_ACTIONS = {
+    importer.action.APPLY: u'apply',
+    importer.action.ASIS: u'asis',
+    importer.action.SKIP: u'skip',
+}
+
+
+@pipeline.stage
+def plan_asis(session, task):
+    """Like `importer.import_asis`, but only plan the import.
+    """
+    if task.skip:
+        return
+    task.set_choice(importer.action.ASIS)
+    session.plan(task)
+
+
+def plan_task(session, task):
+    """Work out what importing a decided task would do, without touching
+    its files or the library: the choice and candidate applied, where
+    each file would go and the duplicates found. The metadata of the
+    task's items is changed in memory only.
+    """
+    singleton = not task.is_album
+    if session.config['move']:
+        operation = u'move'
+    elif session.config['copy']:
+        operation = u'copy'
+    elif session.config['link']:
+        operation = u'link'
+    else:
+        operation = None
+
+    entry = {
+        'paths': [displayable_path(p) for p in task.paths or ()],
+        'action': PLAN_ACTIONS.get(task.choice_flag),
+        'review': getattr(task, 'review', []),
+        'candidate': candidate_summary(task.match, singleton)
+        if task.apply else None,
+        'operation': operation,
+        'items': [],
+        'duplicates': [],
+    }
+
+    if task.skip:
+        duplicate_action = u'skip'
+    elif task.should_remove_duplicates:
+        duplicate_action = u'remove'
+    else:
+        duplicate_action = u'keep'
+    for duplicate in getattr(task, 'found_duplicates', ()):
+        items = duplicate.items() if task.is_album else [duplicate]
+        entry['duplicates'].append({
+            'id': duplicate.id,
+            'action': duplicate_action,
+            'paths': [displayable_path(item.path) for item in items],
+        })
+    if task.skip:
+        return entry
+
+    if task.apply:
+        task.apply_metadata()
+    if task.is_album:
+        task.align_album_level_fields()
+    for item in sorted(task.imported_items(), key=lambda i: i.path):
+        destination = item.path
+        if operation is not None:
+            # `Item.destination` needs a library row: ask a copy of the
+            # item with a placeholder one, and a placeholder album for
+            # album items so that they don't look like singletons to
+            # path formats.
+            planned = beets.library.Item(session.lib, **dict(item))
+            planned.id = -1
+            if task.is_album:
+                planned.album_id = -1
+            destination = planned.destination()
+        entry['items'].append({
+            'source': displayable_path(item.path),
+            'destination': displayable_path(destination),
+        })
+    return entry
+
+
+@pipeline.mutator_stage
+def manipulate_files(session, task):
+    """Like `importer.manipulate_files`, with the files put in place by
+    the file scheduler, then record the stamp of the directories the
+    task came from in the scan cache.
+    """
+    if not task.skip:
+        if task.should_remove_duplicates:
+            task.remove_duplicates(session.lib)
+
+        place_files(
+            session, task,
+            move=session.config['move'],
+            copy=session.config['copy'],
+            write=session.config['write'],
+            link=session.config['link'],
+        )
+
+    # Progress, cleanup, and event.
+    task.finalize(session)
+
+    session.record_scan(task)
+    if not isinstance(task, importer.SentinelImportTask):
+        session.checkpoint(u'done', key=task_key(task))
+    session.task_done(task)
+
+
+class WebImportSession(importer.ImportSession):
+    """An import session whose decisions are made through the web
+    interface.
+    """
+    def __init__(self, lib, loghandler, paths, query, job=None):
+        super(WebImportSession, self).__init__(lib, loghandler, paths, query)
+        self.job = job
+        self.progress = job.progress if job is not None else None
+        self.dry_run = job is not None and job.dry_run
+        self.monitors = OrderedDict()
+        self.phases = OrderedDict((name, Timing()) for name in
+                                  (u'choose', u'duplicates', u'apply'))
+        self.decisions = app.config['decisions']
+        self.feed = None
+        self.parked = set()
+        self._parking = threading.Lock()
+        self._splits = threading.Lock()
+        self.rescan = set()
+        self.unchanged = 0
+        self.paused = defaultdict(float)
+        self.transfers = TransferStats()
+        prefetch_config = config['webimport']['prefetch']
+        self.prefetch = PrefetchWindow(
+            prefetch_config['depth'].get(int),
+            prefetch_config['max_memory'].get(int),
+        )
+        # Requests read the job's session concurrently: only publish it
+        # once it is set up.
+        if job is not None:
+            job.session = self
+
+    def skip_unchanged(self, dirs):
+        """Report an album left out because the scan cache knows it to
+        be unchanged.
+        """
+        self.unchanged += 1
+        app.config['events'].publish(
+            u'unchanged', job=self.job.id if self.job else None,
+            paths=[displayable_path(d) for d in dirs])
+
+    def check_abort(self):
+        """Raise `ImportAbort` if the job driving this session has been
+        cancelled.
+        """
+        if self.job is not None and self.job.aborted:
+            raise importer.ImportAbort()
+
+    def task_chosen(self, task):
+        """Called once a choice has been made for a looked-up task.
+        """
+        self.prefetch.release(task)
+        looked_up = getattr(task, 'looked_up', None)
+        if looked_up is not None:
+            app.config['metrics'].decision_seconds.observe(
+                time.time() - looked_up, getattr(task, 'decided_by', u'auto'))
+        if task.choice_flag == importer.action.SKIP:
+            self.emit(u'skipped', task)
+        elif task.choice_flag == importer.action.ASIS:
+            self.emit(u'asis', task)
+
+    def decided(self, pending):
+        """Called once a decision is posted for a parked task: send the
+        task back into the pipeline.
+        """
+        with self._parking:
+            self.feed.requeue(pending.task)
+
+    def split(self, task, tasks):
+        """Record that `task` is split into `tasks`, and return those
+        that are not done yet: when resuming a job, some may be.
+        """
+        split = TaskSplit(task, 0)
+        for child in tasks:
+            child.split = split
+        if self.progress is not None:
+            tasks = [t for t in tasks
+                     if task_key(t) not in self.progress.done]
+        split.left = len(tasks)
+        if not tasks and not self.dry_run:
+            self._split_done(task)
+        return tasks
+
+    def task_done(self, task):
+        """Called once the files of a task are in place. Once all the
+        tasks a task was split into are, the progress of the task itself
+        is saved.
+        """
+        split = getattr(task, 'split', None)
+        if split is None:
+            return
+        with self._splits:
+            split.left -= 1
+            done = not split.left
+        if done:
+            self._split_done(split.task)
+
+    def _split_done(self, task):
+        importer.SentinelImportTask(task.toppath, task.paths).finalize(self)
+        self.record_scan(task)
+        self.checkpoint(u'done', key=task_key(task))
+        self.task_done(task)
+
+    def record_scan(self, task):
+        """Record the stamp of the directories a done task came from in
+        the scan cache, leaving them out of the next scans until they
+        change. Directories with skipped items are scanned again, unless
+        incremental imports remember the skipped items.
+        """
+        cache = app.config.get('scan_cache')
+        if cache is None:
+            return
+        if not isinstance(task, importer.SentinelImportTask) and \
+                task.skip and (not self.config['incremental'] or
+                               self.config.get('incremental_skip_later')):
+            self.rescan.update(os.path.dirname(item.path)
+                               for item in task.items)
+        stamp = getattr(task, 'scan_stamp', None)
+        if stamp is not None and self.rescan.isdisjoint(stamp[0]):
+            cache.record(*stamp)
+
+    def wait_for_room(self, stage):
+        """Pause a pipeline stage while the decision store is full, and
+        account for the time it spent waiting.
+        """
+        waited = self.decisions.wait_for_room(self, stage)
+        if waited:
+            self.paused[stage] += waited
+            app.config['metrics'].paused_seconds.inc(stage, amount=waited)
+
+    def checkpoint(self, record_type, **data):
+        """Append a record about this session's job to the checkpoint
+        log, if there is one.
+        """
+        store = app.config.get('checkpoints')
+        if store is not None and self.job is not None and not self.dry_run:
+            store.record(record_type, self.job, **data)
+
+    def plan(self, task):
+        """Buffer the plan of a decided task for the dry run's stream,
+        waiting while the buffer is full.
+        """
+        if isinstance(task, importer.SentinelImportTask):
+            return
+        self.job.add(plan_task(self, task))
+
+    def already_imported(self, toppath, paths):
+        if self.progress is not None and \
+                progress_key(paths) in self.progress.done:
+            return True
+        return super(WebImportSession, self).already_imported(toppath, paths)
+
+    def emit(self, event_type, task, **data):
+        """Publish an event about `task` on the application's event bus.
+        """
+        data['job'] = self.job.id if self.job else None
+        data['paths'] = [displayable_path(p) for p in task.paths or ()]
+        app.config['events'].publish(event_type, **data)
+
+    def run(self):
+        """Run the import. Tasks waiting for a decision are parked out
+        of the pipeline, so that any number of them can wait at a time.
+        """
+        self.logger.info(u'import started {0}', time.asctime())
+        self.set_config(config['import'])
+
+        monitors = OrderedDict()
+        pl = pipeline.Pipeline([self._monitor(monitors, name, stage, i == 0)
+                                for i, (name, stage)
+                                in enumerate(self.stages())])
+        # Requests read the monitors concurrently: publish them whole.
+        self.monitors = monitors
+
+        # Run the pipeline.
+        plugins.send('import_begin', session=self)
+        try:
+            if config['threaded']:
+                pl.run_parallel(importer.QUEUE_SIZE)
+            else:
+                pl.run_sequential()
+        except importer.ImportAbort:
+            # User aborted operation. Silently stop.
+            pass
+        finally:
+            self.feed.close()
+            # Nothing takes back the tasks still parked.
+            for pending in list(self.parked):
+                self.decisions.discard(pending)
+                app.config['diffs'].forget(pending)
+
+    def stages(self):
+        """Build the list of pipeline stages for this session, as
+        `(name, stage)` pairs.
+        """
+        if self.job is not None and self.job.watch:
+            source = watch_tasks(self)
+        elif self.query is None:
+            source = read_tasks(self)
+        else:
+            source = importer.query_tasks(self)
+        # Decided tasks come back to the user query stage through the
+        # feed.
+        self.feed = TaskFeed(self, source, returns=bool(
+            self.config['autotag'] and not self.config['pretend']))
+        stages = [(u'read', self.feed.tasks())]
+
+        # In pretend mode, just log what would otherwise be imported.
+        if self.config['pretend']:
+            stages += [(u'log', importer.log_files(self))]
+            return stages
+
+        if self.config['group_albums'] and \
+                not self.config['singletons']:
+            # Split directory tasks into one task for each album.
+            stages += [(u'group', group_albums(self))]
+
+        if self.config['autotag']:
+            # Look up the next tasks in parallel while earlier ones wait
+            # for a decision.
+            lookups = config['webimport']['prefetch']['workers'].get(int)
+            stages += [
+                (u'lookup', [lookup_candidates(self, True)
+                             for _ in range(lookups)]),
+                (u'user_query', user_query(self)),
+            ]
+        elif self.dry_run:
+            stages += [(u'asis', plan_asis(self))]
+        else:
+            stages += [(u'asis', importer.import_asis(self))]
+
+        # Dry runs stop once tasks are planned: the following stages
+        # touch the library and the files.
+        if self.dry_run:
+            return stages
+
+        # Plugin stages.
+        for stage_func in plugins.import_stages():
+            name = getattr(stage_func, '__name__', u'plugin')
+            stages.append((u'plugin:{0}'.format(name),
+                           importer.plugin_stage(self, stage_func)))
+
+        stages += [(u'manipulate', manipulate_files(self))]
+        return stages
+
+    @contextmanager
+    def timed(self, phase):
+        """Account the time spent in the block to a phase of the user
+        query stage.
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            wall, cpu = self.phases[phase].add(start, clock())
+            metrics = app.config['metrics']
+            metrics.phase_seconds.inc(phase, u'wall', amount=wall)
+            if cpu is not None:
+                metrics.phase_seconds.inc(phase, u'cpu', amount=cpu)
+
+    def timings(self):
+        """Return the time spent in each stage and user query phase.
+        """
+        return {
+            'stages': OrderedDict((name, monitor.to_dict())
+                                  for name, monitor in self.monitors.items()),
+            'phases': OrderedDict((name, timing.to_dict())
+                                  for name, timing in self.phases.items()),
+        }
+
+    def _monitor(self, monitors, name, stage, source=False):
+        """Wrap the coroutines of a stage to report to its
+        `StageMonitor`, kept in `monitors` by stage name. A stage failing
+        closes the feed, which would otherwise wait for the tasks that
+        stage held.
+        """
+        monitor = monitors.setdefault(name, StageMonitor(name))
+        if isinstance(stage, list):
+            return [monitor.wrap(coro, self.feed.close, source)
+                    for coro in stage]
+        return monitor.wrap(stage, self.feed.close, source)
+
+    def _park(self, task, kind, **kwargs):
+        """Park a task in the decision store, and take it out of the
+        pipeline by raising `TaskParked`. Once decided, the task comes
+        back to the user query stage, and the call made for it again
+        returns the decision. Decisions recorded before a restart are
+        replayed instead.
+
+        Album and item tasks are parked with their items and
+        `candidates`, which are spilled while waiting if the store is set
+        up for it.
+        """
+        pending = getattr(task, 'pending', None)
+        if pending is not None:
+            return self._decided(task, pending)
+
+        key = task_key(task)
+        candidates = task.candidates if kind != PendingTask.DUPLICATE \
+            else ()
+        if self.dry_run:
+            # Nobody reviews a dry run: plan the best candidate, or the
+            # task as is, and keeping both duplicates, and flag the task.
+            task.review = getattr(task, 'review', []) + [kind]
+            if kind == PendingTask.DUPLICATE:
+                return Decision(u'k', {})
+            return Decision(1 if candidates else u'u', {})
+
+        decision = self._replay_decision(key, kind, candidates)
+        if decision is not None:
+            if kind != PendingTask.DUPLICATE:
+                task.decided_by = u'replayed'
+            return decision
+
+        if kind == PendingTask.ALBUM and candidates:
+            kwargs['has_duplicates'] = self._has_duplicates(candidates[0])
+        # The task is only sent back once it is done being parked.
+        with self._parking:
+            pending = self.decisions.park(self, task, kind,
+                                          candidates=candidates, **kwargs)
+            task.pending = pending
+            self.parked.add(pending)
+            if pending.spilled:
+                # Hold no reference to the items and candidates while
+                # waiting: they are read back from the store once decided.
+                task.candidates = []
+                task.items = []
+                if not task.is_album:
+                    task.item = None
+        # Parked tasks are bounded by the decision store, not by the
+        # prefetch window.
+        self.prefetch.release(task)
+        self.emit(u'task-parked', task, task_id=pending.id, kind=kind)
+        raise TaskParked()
+
+    def _decided(self, task, pending):
+        """Take the decision posted for a parked task back in the
+        pipeline.
+        """
+        task.pending = None
+        self.parked.discard(pending)
+        candidates = ()
+        try:
+            if pending.kind != PendingTask.DUPLICATE:
+                if pending.spilled:
+                    task.items, task.candidates, _ = pending.rehydrate()
+                    if not task.is_album:
+                        task.item = task.items[0]
+                candidates = task.candidates
+                task.decided_by = pending.decided_by
+        finally:
+            self.decisions.discard(pending)
+            app.config['diffs'].forget(pending)
+        decision = pending.decision
+        self.checkpoint(u'decision', key=task_key(task),
+                        kind=pending.kind, sel=decision.sel,
+                        args=decision.args,
+                        candidate=candidate_id(candidates, decision.sel))
+        return decision
+
+    def _replay_decision(self, key, kind, candidates):
+        """Return the next decision recorded for a task before a restart,
+        or None if there is none or the task no longer looks the same.
+        """
+        if self.progress is None:
+            return None
+        record = self.progress.take_decision(key)
+        if record is None:
+            return None
+        decision = Decision(record['sel'], record['args'])
+        if record['kind'] != kind or \
+                record['candidate'] != candidate_id(candidates, decision.sel):
+            self.progress.forget_decisions(key)
+            return None
+        log.debug(u'replaying decision for {0}', key)
+        return decision
+
+    def _has_duplicates(self, match):
+        """Tell whether the library already has the album of a candidate
+        match, or None if that can't be checked right now.
+        """
+        try:
+            with app.config['read_pool'].connection() as conn:
+                return bool(library_duplicates(conn, match.info.artist,
+                                               match.info.album))
+        except PoolTimeout:
+            return None
+
+    def _wait_for_choice(self, task, extra_choices):
+        """Return the choice for a task among `task.candidates`, either
+        immediately for a strong recommendation or from a decision
+        posted through the web.
+        """
+        singleton = not task.is_album
+        # Exact match => tag automatically if we're not in timid mode.
+        if task.candidates and task.rec == Recommendation.strong and \
+                not config['import']['timid']:
+            match = task.candidates[0]
+            self.emit(u'auto-applied', task,
+                      candidate=candidate_summary(match, singleton))
+            return match, None
+
+        # The candidates are only referenced from the task, so that they
+        # can be spilled while it is parked.
+        decision = self._park(
+            task, PendingTask.ITEM if singleton else PendingTask.ALBUM,
+            rec=task.rec, extra_choices=extra_choices,
+        )
+        return choose_candidate(task.candidates, singleton, decision,
+                                extra_choices), decision
+
+    def choose_match(self, task):
+        """Given an initial autotagging of items, wait for a choice of
+        metadata to be made through the web. Returns an AlbumMatch
+        object, ASIS, or SKIP.
+        """
+        self.check_abort()
+
+        # A task coming back with a decision goes straight to it.
+        if getattr(task, 'pending', None) is None:
+            # Announce what we're tagging.
+            self.emit(u'candidates-ready', task, items=len(task.items),
+                      artist=task.cur_artist, album=task.cur_album,
+                      rec=task.rec.name, candidates=len(task.candidates))
+
+            # Take immediate action if appropriate.
+            action = _summary_judgment(task.rec, task.candidates,
+                                       task.items)
+            if action == importer.action.APPLY:
+                match = task.candidates[0]
+                self.emit(u'auto-applied', task,
+                          candidate=candidate_summary(match, False))
+                return match
+            elif action is not None:
+                return action
+
+        # Loop until we have a choice. Manual searches replace the
+        # task's candidates.
+        while True:
+            # Gather extra choices from plugins.
+            extra_choices = self._get_plugin_choices(task)
+            extra_ops = {c.short: c.callback for c in extra_choices}
+
+            # Ask for a choice from the user.
+            choice, decision = self._wait_for_choice(task, extra_choices)
+
+            # Choose which tags to use.
+            if choice in (importer.action.SKIP, importer.action.ASIS,
+                          importer.action.TRACKS, importer.action.ALBUMS):
+                # Pass selection to main control flow.
+                return choice
+            elif choice is importer.action.MANUAL:
+                # Try again with manual search terms.
+                search_artist, search_album = manual_search(decision)
+                _, _, task.candidates, task.rec = tag_album(
+                    task.items, search_artist, search_album
+                )
+            elif choice is importer.action.MANUAL_ID:
+                # Try a manually-entered ID.
+                search_id = manual_id(decision)
+                if search_id:
+                    _, _, task.candidates, task.rec = tag_album(
+                        task.items, search_ids=search_id.split()
+                    )
+            elif choice in list(extra_ops.keys()):
+                # Allow extra ops to automatically set the post-choice.
+                post_choice = extra_ops[choice](self, task)
+                if isinstance(post_choice, importer.action):
+                    # MANUAL and MANUAL_ID have no effect, even if returned.
+                    return post_choice
+            else:
+                # We have a candidate! Finish tagging. Here, choice is an
+                # AlbumMatch object.
+                assert isinstance(choice, autotag.AlbumMatch)
+                return choice
+
+    def choose_item(self, task):
+        """Wait for a choice about tagging a single item. Returns either
+        an action constant or a TrackMatch object.
+        """
+        self.check_abort()
+
+        if getattr(task, 'pending', None) is None:
+            self.emit(u'candidates-ready', task, items=1,
+                      artist=task.item.artist, title=task.item.title,
+                      rec=task.rec.name, candidates=len(task.candidates))
+
+            # Take immediate action if appropriate.
+            action = _summary_judgment(task.rec, task.candidates,
+                                       [task.item])
+            if action == importer.action.APPLY:
+                match = task.candidates[0]
+                self.emit(u'auto-applied', task,
+                          candidate=candidate_summary(match, True))
+                return match
+            elif action is not None:
+                return action
+
+        while True:
+            extra_choices = self._get_plugin_choices(task)
+            extra_ops = {c.short: c.callback for c in extra_choices}
+
+            # Ask for a choice.
+            choice, decision = self._wait_for_choice(task, extra_choices)
+
+            if choice in (importer.action.SKIP, importer.action.ASIS):
+                return choice
+            elif choice == importer.action.TRACKS:
+                assert False  # TRACKS is only legal for albums.
+            elif choice == importer.action.MANUAL:
+                # Continue in the loop with a new set of candidates.
+                search_artist, search_title = manual_search(decision)
+                task.candidates, task.rec = tag_item(task.item, search_artist,
+                                                     search_title)
+            elif choice == importer.action.MANUAL_ID:
+                # Ask for a track ID.
+                search_id = manual_id(decision)
+                if search_id:
+                    task.candidates, task.rec = tag_item(
+                        task.item, search_ids=search_id.split())
+            elif choice in extra_ops.keys():
+                # Allow extra ops to automatically set the post-choice.
+                post_choice = extra_ops[choice](self, task)
+                if isinstance(post_choice, importer.action):
+                    # MANUAL and MANUAL_ID have no effect, even if returned.
+                    return post_choice
+            else:
+                # Chose a candidate.
+                assert isinstance(choice, autotag.TrackMatch)
+                return choice
+
+    def resolve_duplicate(self, task, found_duplicates):
+        """Decide what to do when a new album or item seems similar to one
+        that's already in the library.
+        """
+        self.check_abort()
+
+        if config['import']['quiet']:
+            # In quiet mode, don't prompt -- just skip.
+            log.info(u'Skipping.')
+            sel = u's'
+        else:
+            # Let the user make an informed decision from the details of
+            # the existing and new items.
+            sel = self._park(task, PendingTask.DUPLICATE,
+                             duplicates=found_duplicates).sel
+
+        if sel == u's':
+            # Skip new.
+            task.set_choice(importer.action.SKIP)
+        elif sel == u'k':
+            # Keep both. Do nothing; leave the choice intact.
+            pass
+        elif sel == u'r':
+            # Remove old.
+            task.should_remove_duplicates = True
+        else:
+            assert False
+
+    def should_resume(self, path):
+        # Nobody is at the terminal to ask: resume the interrupted
+        # imports of the jobs picked up from the checkpoint log only.
+        return self.progress is not None
+
+    def _get_plugin_choices(self, task):
+        """Get the extra choices appended to the plugins to the ui prompt.
+
+        The `before_choose_candidate` event is sent to the plugins, with
+        session and task as its parameters. Plugins are responsible for
+        checking the right conditions and returning a list of `PromptChoice`s,
+        which is flattened and checked for conflicts.
+
+        If two or more choices have the same short letter, a warning is
+        emitted and all but one choices are discarded, giving preference
+        to the default importer choices.
+
+        Returns a list of `PromptChoice`s.
+        """
+        # Send the before_choose_candidate event and flatten list.
+        extra_choices = list(chain(*plugins.send('before_choose_candidate',
+                                                 session=self, task=task)))
+        # Take into account default options, for duplicate checking.
+        all_choices = [PromptChoice(u'a', u'Apply', None),
+                       PromptChoice(u's', u'Skip', None),
+                       PromptChoice(u'u', u'Use as-is', None),
+                       PromptChoice(u't', u'as Tracks', None),
+                       PromptChoice(u'g', u'Group albums', None),
+                       PromptChoice(u'e', u'Enter search', None),
+                       PromptChoice(u'i', u'enter Id', None),
+                       PromptChoice(u'b', u'aBort', None)] + \
+                      extra_choices
+
+        short_letters = [c.short for c in all_choices]
+        if len(short_letters) != len(set(short_letters)):
+            # Duplicate short letter has been found.
+            duplicates = [i for i, count in Counter(short_letters).items()
+                          if count > 1]
+            for short in duplicates:
+                # Keep the first of the choices, removing the rest.
+                dup_choices = [c for c in all_choices if c.short == short]
+                for c in dup_choices[1:]:
+                    log.warn(u"Prompt choice '{0}' removed due to conflict "
+                             u"with '{1}' (short letter: '{2}')",
+                             c.long, dup_choices[0].long, c.short)
+                    extra_choices.remove(c)
+        return extra_choices
+
+def check_import_args(paths):
+    """Raise a `UserError` if the given paths or the import configuration
+    cannot be used for an import.
+    """
+    # Check the user-specified directories.
+    for path in paths:
+        if not os.path.exists(syspath(normpath(path))):
+            raise ui.UserError(u'no such file or directory: {0}'.format(
+                displayable_path(path)))
+
+    # Check parameter consistency.
+    if config['import']['quiet'] and config['import']['timid']:
+        raise ui.UserError(u"can't be both quiet and timid")
+
+
+def open_import_log():
+    """Return a handler for the configured import log, or None.
+    """
+    if config['import']['log'].get() is not None:
+        logpath = syspath(config['import']['log'].as_filename())
+        try:
+            return logging.FileHandler(logpath)
+        except IOError:
+            raise ui.UserError(u"could not open log file for writing: "
+                               u"{0}".format(displayable_path(logpath)))
+
+
+def import_files(lib, paths, query, job=None):
+    """Import the files in the given list of paths or matching the
+    query.
+    """
+    check_import_args(paths)
+
+    # Open the log.
+    loghandler = open_import_log()
+
+    # Never ask for input in quiet mode.
+    if config['import']['resume'].get() == 'ask' and \
+            config['import']['quiet']:
+        config['import']['resume'] = False
+
+    session = WebImportSession(lib, loghandler, paths, query, job)
+    session.run()
+
+    # Emit event.
+    plugins.send('import', lib=lib, paths=paths)
+
+
+def import_func(lib, opts, args):
+    config['import'].set_args(opts)
+
+    # Special case: --copy flag suppresses import_move (which would
+    # otherwise take precedence).
+    if opts.copy:
+        config['import']['move'] = False
+
+    if opts.library:
+        query = decargs(args)
         paths = []
     else:
         query = None
@@ -891,12 +4219,1205 @@ def import_func(lib, opts, args):
         if not paths:
             raise ui.UserError(u'no path specified')
 
-    import_files(lib, paths, query)
+    import_files(lib, paths, query)
+
+
+# Library read pool.
+
+class PoolTimeout(Exception):
+    """No read connection became available in time.
+    """
+
+
+class ReadPool(object):
+    """A pool of read-only SQLite connections to the library database.
+
+    Web requests read through these connections instead of the shared
+    `Library`, whose transactions all serialize on one lock, so browsing
+    the library does not wait behind the importer's writes. With WAL
+    journaling, readers and the import writer don't block each other on
+    the database file either.
+
+    WAL is opt-in, through `read_pool.wal`: the journal mode sticks to
+    the database file, for every beets process using the library after
+    this one, and WAL does not work on network file systems.
+    """
+    def __init__(self, path, size=4, timeout=5.0, wal=False):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.in_use = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        if wal:
+            # The journal mode is persistent: the library's own
+            # connections pick it up as well.
+            conn = sqlite3.connect(path, timeout=timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               check_same_thread=False)
+        conn.execute('PRAGMA query_only = ON')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            return self._connect()
+
+        start = time.time()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout()
+        with self._lock:
+            self.waits += 1
+            self.wait_time += time.time() - start
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a `with` block. Raise
+        `PoolTimeout` if none is free within the pool's timeout.
+        """
+        conn = self._acquire()
+        with self._lock:
+            self.acquisitions += 1
+            self.in_use += 1
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            with self._lock:
+                self.in_use -= 1
+            self._idle.put(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self.created,
+                'in_use': self.in_use,
+                'acquisitions': self.acquisitions,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+            }
+
+
+def library_albums(conn, query=None, limit=50, offset=0):
+    """List the albums of the library whose artist or title contains
+    `query`, sorted by artist and album.
+    """
+    sql = 'SELECT id, albumartist, album, year FROM albums'
+    subvals = []
+    if query:
+        sql += ' WHERE albumartist LIKE ? OR album LIKE ?'
+        subvals = [u'%{0}%'.format(query)] * 2
+    sql += ' ORDER BY albumartist, album LIMIT ? OFFSET ?'
+    rows = conn.execute(sql, subvals + [limit, offset]).fetchall()
+    return [dict(zip(row.keys(), row)) for row in rows]
+
+
+def library_duplicates(conn, artist, album):
+    """Return the IDs of the library albums with the given album artist
+    and title, the way `ImportTask.find_duplicates` matches them.
+    """
+    rows = conn.execute('SELECT id FROM albums WHERE albumartist = ? '
+                        'AND album = ?', (artist, album)).fetchall()
+    return [row[0] for row in rows]
+
+
+# Checkpoints.
+
+def progress_key(paths):
+    """Identify a task across restarts by the paths it was read from.
+    """
+    return u'\0'.join(sorted(displayable_path(p) for p in paths or ()))
+
+
+def dump_path(path):
+    """Encode a path for the checkpoint log, keeping every byte of it.
+    """
+    return base64.b64encode(bytestring_path(path)).decode('ascii')
+
+
+def load_path(dumped):
+    """Decode a path encoded by `dump_path`.
+    """
+    return base64.b64decode(dumped)
+
+
+def task_key(task):
+    """Identify a task across restarts: by the paths it was read from,
+    and for a task split from another, by the key of that task as well.
+    """
+    key = progress_key(task.paths)
+    split = getattr(task, 'split', None)
+    if split is not None:
+        key = task_key(split.task) + u'\0\0' + key
+    return key
+
+
+def candidate_id(candidates, sel):
+    """Return the metadata source ID of the candidate chosen by `sel`, if
+    it is a candidate number.
+    """
+    if not isinstance(sel, int) or not 0 < sel <= len(candidates):
+        return None
+    match = candidates[sel - 1]
+    if isinstance(match, hooks.AlbumMatch):
+        return match.info.album_id
+    return match.info.track_id
+
+
+class JobProgress(object):
+    """What the checkpoint log knows about an unfinished job: how it was
+    submitted, the decisions posted for its tasks and the tasks that are
+    done.
+    """
+    def __init__(self, record):
+        self.record = record
+        self.decisions = defaultdict(deque)
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def take_decision(self, key):
+        """Return the next recorded decision for a task, or None.
+        """
+        with self._lock:
+            recorded = self.decisions.get(key)
+            if recorded:
+                return recorded.popleft()
+
+    def forget_decisions(self, key):
+        with self._lock:
+            self.decisions.pop(key, None)
+
+    def records(self):
+        """Return the records that rebuild this state on replay.
+        """
+        job_id = self.record['job']
+        out = [self.record]
+        for decisions in self.decisions.values():
+            out.extend(decisions)
+        out.extend({'type': u'done', 'job': job_id, 'key': key}
+                   for key in self.done)
+        return out
+
+
+class CheckpointStore(object):
+    """An append-only JSON-lines log of import progress. Replaying it
+    on startup gives the `JobProgress` of every job that was unfinished
+    when the server stopped; the log is then compacted to just that.
+
+    Records are written as they are appended, but synced to disk in
+    groups: once `sync_records` are waiting or `sync_interval` seconds
+    after the last sync, whichever comes first. The start and end of
+    jobs are synced right away.
+    """
+    def __init__(self, path, sync_interval=1.0, sync_records=100):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.jobs = OrderedDict()
+        self.syncs = 0
+        self._unsynced = 0
+        self._synced = time.time()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A write torn by a crash.
+                        continue
+                    self._replay(record)
+        self._compact()
+        self._file = open(path, 'a')
+
+    def _replay(self, record):
+        job_id = record.get('job')
+        if record.get('type') == u'job':
+            self.jobs[job_id] = JobProgress(record)
+            return
+        progress = self.jobs.get(job_id)
+        if progress is None:
+            return
+        if record['type'] == u'end':
+            del self.jobs[job_id]
+        elif record['type'] == u'decision':
+            progress.decisions[record['key']].append(record)
+        elif record['type'] == u'done':
+            progress.done.add(record['key'])
+            progress.decisions.pop(record['key'], None)
+
+    def _compact(self):
+        tmp = self.path + b'.tmp'
+        with open(tmp, 'w') as f:
+            for progress in self.jobs.values():
+                for record in progress.records():
+                    f.write(json.dumps(record) + '\n')
+        os.rename(tmp, self.path)
+
+    def record(self, record_type, job, **data):
+        """Append a record about a job to the log.
+        """
+        data['type'] = record_type
+        data['job'] = job.id
+        data['time'] = time.time()
+        line = json.dumps(data) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            due = record_type in (u'job', u'end') or \
+                self._unsynced >= self.sync_records or \
+                time.time() - self._synced >= self.sync_interval
+        if due:
+            self.sync()
+
+    def sync(self):
+        """Sync the records written so far to disk. Appending goes on
+        while the sync runs.
+        """
+        with self._sync_lock:
+            with self._lock:
+                if not self._unsynced:
+                    return
+                self._unsynced = 0
+                self._synced = time.time()
+            os.fsync(self._file.fileno())
+            self.syncs += 1
+
+
+# Background import jobs.
+
+class ImportJob(object):
+    """An import of a list of paths, or of the albums matching a library
+    query, that runs in the background on a `JobManager` worker.
+    """
+    QUEUED = u'queued'
+    RUNNING = u'running'
+    FINISHED = u'finished'
+    FAILED = u'failed'
+    ABORTED = u'aborted'
+    watch = False
+    dry_run = False
+
+    def __init__(self, lib, paths, query):
+        self.id = uuid.uuid4().hex
+        self.lib = lib
+        self.paths = paths
+        self.query = query
+        self.status = self.QUEUED
+        self.error = None
+        self.session = None
+        self.progress = None
+        self.aborted = False
+        self.created = time.time()
+        self.started = self.finished = None
+
+    def abort(self):
+        """Ask the job to stop. A queued job never starts; a running one
+        raises `ImportAbort` the next time its session checks in.
+        """
+        self.aborted = True
+        if self.status == self.QUEUED:
+            self.status = self.ABORTED
+            self.finished = time.time()
+            self._checkpoint_end()
+
+    def run(self):
+        """Run the import session for this job in the calling thread.
+        """
+        self.status = self.RUNNING
+        self.started = time.time()
+        self._publish()
+        try:
+            import_files(self.lib, self.paths, self.query, self)
+        except Exception as exc:
+            log.error(u'import job {0} failed: {1}', self.id, exc)
+            self.status = self.FAILED
+            self.error = unicode(exc)
+        else:
+            self.status = self.ABORTED if self.aborted else self.FINISHED
+        self.finished = time.time()
+        self._checkpoint_end()
+        self._publish()
+
+    def _checkpoint_end(self):
+        """Record the end of the job in the checkpoint log, unless it was
+        only interrupted by a shutdown and should resume on restart.
+        """
+        store = app.config.get('checkpoints')
+        if store is None or self.dry_run:
+            return
+        if app.config['jobs'].closed and (
+                self.status == self.ABORTED or
+                (self.status == self.FINISHED and self.watch)):
+            return
+        store.record(u'end', self, status=self.status)
+
+    def _publish(self):
+        app.config['events'].publish(u'job-status', job=self.id,
+                                     status=self.status, error=self.error)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'paths': [displayable_path(p) for p in self.paths],
+            'query': self.query,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'prefetch': self.session.prefetch.stats() if self.session
+            else None,
+            'watch': self.watch,
+            'dry_run': self.dry_run,
+            'resumed': self.progress is not None,
+            'timings': self.session.timings() if self.session else None,
+            'paused': dict(self.session.paused) if self.session else None,
+            'unchanged': self.session.unchanged if self.session else None,
+            'files': self.session.transfers.to_dict() if self.session
+            else None,
+        }
+
+
+class WatchJob(ImportJob):
+    """A long-running import of the albums that appear in a set of
+    directories. They all go through the same session as they settle,
+    until the job is aborted or the server shuts down.
+    """
+    watch = True
+
+    def __init__(self, lib, paths, interval, settle):
+        super(WatchJob, self).__init__(lib, paths, None)
+        self.interval = interval
+        self.watcher = InboxWatcher(settle)
+
+    def to_dict(self):
+        out = super(WatchJob, self).to_dict()
+        out['watcher'] = self.watcher.stats()
+        return out
+
+
+class DryRunJob(ImportJob):
+    """An import that only plans what it would do. The plan of every
+    task is streamed to one client at a time; dry runs are not
+    checkpointed.
+
+    The dry run waits while `PLAN_BUFFER` entries are planned but not
+    streamed yet, and is cancelled when nobody has streamed its plan for
+    `idle_timeout` seconds. The last `PLAN_BUFFER` entries streamed stay
+    buffered, so that a client that got disconnected can resume from the
+    number of entries it received. The plan is dropped `ttl` seconds
+    after the dry run ends.
+    """
+    dry_run = True
+
+    def __init__(self, lib, paths, query, idle_timeout=300, ttl=3600):
+        super(DryRunJob, self).__init__(lib, paths, query)
+        self.idle_timeout = idle_timeout
+        self.ttl = ttl
+        self.planned = 0
+        self.sent = 0
+        self.streaming = False
+        self.expired = False
+        self.last_read = time.time()
+        # The buffered entries, from the `_first`th of the plan on.
+        self._entries = deque()
+        self._first = 0
+        self._cond = threading.Condition()
+
+    def run(self):
+        super(DryRunJob, self).run()
+        with self._cond:
+            self._cond.notify_all()
+        timer = threading.Timer(self.ttl, self.expire)
+        timer.daemon = True
+        timer.start()
+
+    def abort(self):
+        super(DryRunJob, self).abort()
+        with self._cond:
+            self._cond.notify_all()
+
+    def expire(self):
+        """Drop the plan of the dry run.
+        """
+        with self._cond:
+            self.expired = True
+            self._entries.clear()
+            self._first = self.planned
+            self._cond.notify_all()
+
+    def add(self, entry):
+        """Buffer the plan of a task, waiting while `PLAN_BUFFER` entries
+        are not streamed yet. Raise `ImportAbort` if the job is aborted
+        in the meantime, or if nobody streams the plan.
+        """
+        with self._cond:
+            while self.planned - self.sent >= PLAN_BUFFER:
+                if not self.streaming and \
+                        time.time() - self.last_read > self.idle_timeout:
+                    log.warn(u'nobody streams dry run {0}, aborting it',
+                             self.id)
+                    self.aborted = True
+                if self.aborted:
+                    raise importer.ImportAbort()
+                self._cond.wait(1.0)
+            self._entries.append(entry)
+            self.planned += 1
+            while self._first < self.sent - PLAN_BUFFER:
+                self._entries.popleft()
+                self._first += 1
+            self._cond.notify_all()
+
+    def buffered(self, offset):
+        """Whether the plan is still buffered from its `offset`th entry
+        on.
+        """
+        with self._cond:
+            return not self.expired and self._first <= offset
+
+    def read(self, offset, timeout):
+        """Return the entries of the plan from the `offset`th on, waiting
+        up to `timeout` seconds for one while the job runs. Return None
+        if they are no longer buffered.
+        """
+        with self._cond:
+            if offset >= self.planned and \
+                    self.status in (self.QUEUED, self.RUNNING):
+                self._cond.wait(timeout)
+            if self.expired or offset < self._first:
+                return None
+            entries = list(itertools.islice(self._entries,
+                                            offset - self._first, None))
+            self.sent = max(self.sent, offset + len(entries))
+            self.last_read = time.time()
+            self._cond.notify_all()
+            return entries
+
+    def open_stream(self):
+        """Reserve the plan stream for a client. Return False if another
+        one is already streaming it.
+        """
+        with self._cond:
+            if self.streaming:
+                return False
+            self.streaming = True
+            return True
+
+    def close_stream(self):
+        """Release the plan stream. The dry run is aborted if nobody opens
+        it again within `idle_timeout` seconds.
+        """
+        with self._cond:
+            self.streaming = False
+            self.last_read = time.time()
+            self._cond.notify_all()
+
+    def to_dict(self):
+        out = super(DryRunJob, self).to_dict()
+        out['planned'] = self.planned
+        out['streamed'] = self.sent
+        out['expired'] = self.expired
+        return out
+
+
+class JobManager(object):
+    """Queues import jobs and runs them on a fixed number of worker
+    threads, so that several imports can progress at the same time
+    without tying up request threads.
+    """
+    def __init__(self, workers=2):
+        self.jobs = OrderedDict()
+        self.closed = False
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='webimport-job-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, lib, paths, query):
+        """Validate and enqueue an import. Raise a `UserError` if the
+        import cannot be run.
+        """
+        if self.closed:
+            raise ui.UserError(u'the server is shutting down')
+        check_import_args(paths)
+        return self._enqueue(ImportJob(lib, paths, query))
+
+    def plan(self, lib, paths, query):
+        """Validate and enqueue a dry run of an import.
+        """
+        if self.closed:
+            raise ui.UserError(u'the server is shutting down')
+        check_import_args(paths)
+        dry_run_config = config['webimport']['dry_run']
+        return self._enqueue(DryRunJob(
+            lib, paths, query, dry_run_config['idle_timeout'].as_number(),
+            dry_run_config['ttl'].as_number()))
+
+    def watch(self, lib, paths):
+        """Validate and enqueue a job watching directories for new
+        albums. It keeps a worker busy for as long as it runs.
+        """
+        if self.closed:
+            raise ui.UserError(u'the server is shutting down')
+        check_import_args(paths)
+        for path in paths:
+            if not os.path.isdir(syspath(normpath(path))):
+                raise ui.UserError(u'not a directory: {0}'.format(
+                    displayable_path(path)))
+        return self._enqueue(self._watch_job(lib, paths))
+
+    def _watch_job(self, lib, paths):
+        watch_config = config['webimport']['watch']
+        return WatchJob(lib, paths, watch_config['interval'].as_number(),
+                        watch_config['settle'].as_number())
+
+    def resume(self, lib):
+        """Queue again the jobs that the checkpoint log knows to be
+        unfinished, and return them.
+        """
+        store = app.config.get('checkpoints')
+        if store is None:
+            return []
+        jobs = []
+        for progress in store.jobs.values():
+            record = progress.record
+            paths = [load_path(p) for p in record['paths']]
+            if record['watch']:
+                job = self._watch_job(lib, paths)
+            else:
+                job = ImportJob(lib, paths, record['query'])
+            job.id = record['job']
+            job.progress = progress
+            log.info(u'resuming import job {0}: {1} tasks done',
+                     job.id, len(progress.done))
+            jobs.append(self._enqueue(job))
+        return jobs
+
+    def _enqueue(self, job):
+        store = app.config.get('checkpoints')
+        if store is not None and job.progress is None and not job.dry_run:
+            store.record(u'job', job, query=job.query, watch=job.watch,
+                         paths=[dump_path(p) for p in job.paths])
+        with self._lock:
+            self.jobs[job.id] = job
+        self._queue.put(job)
+        log.info(u'queued import job {0}', job.id)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def all(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if not job.aborted:
+                job.run()
+                log.info(u'import job {0} {1}', job.id, job.status)
+
+    def shutdown(self, timeout=None):
+        """Stop the workers once the queued jobs have been handled.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def drain(self, timeout):
+        """Stop accepting jobs and give the queued and running ones up
+        to `timeout` seconds to finish. Whatever is left is aborted.
+        """
+        self.closed = True
+        unfinished = (ImportJob.QUEUED, ImportJob.RUNNING)
+        deadline = time.time() + timeout
+        while time.time() < deadline and \
+                any(job.status in unfinished for job in self.all()):
+            time.sleep(0.5)
+
+        for job in self.all():
+            if job.status in unfinished:
+                log.warn(u'aborting unfinished import job {0}', job.id)
+                job.abort()
+        # Aborted sessions stop at their next prompt or lookup.
+        self.shutdown(10)
+        store = app.config.get('checkpoints')
+        if store is not None:
+            store.sync()
+
+
+# Metrics.
+
+# Histogram buckets, in seconds.
+LOOKUP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DECISION_BUCKETS = (0.1, 1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+
+def _escape_label(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"') \
+        .replace(u'\n', u'\\n')
+
+
+def _series(name, labels, values, extra=()):
+    pairs = list(zip(labels, values)) + list(extra)
+    if not pairs:
+        return name
+    return u'{0}{{{1}}}'.format(name, u','.join(
+        u'{0}="{1}"'.format(k, _escape_label(v)) for k, v in pairs))
+
+
+class Metric(object):
+    """A metric in the Prometheus text format, with one series per
+    combination of label values.
+    """
+    kind = u'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Return `(series, value)` pairs for every sample.
+        """
+        with self._lock:
+            return [(_series(self.name, self.labels, values), value)
+                    for values, value in sorted(self._series.items())]
+
+    def expose(self):
+        lines = [u'# HELP {0} {1}'.format(self.name, self.help),
+                 u'# TYPE {0} {1}'.format(self.name, self.kind)]
+        lines += [u'{0} {1}'.format(series, float(value))
+                  for series, value in self.samples()]
+        return lines
+
+
+class MetricCounter(Metric):
+    kind = u'counter'
+
+    def inc(self, *values, **kwargs):
+        with self._lock:
+            self._series[values] = \
+                self._series.get(values, 0) + kwargs.get('amount', 1)
+
+
+class MetricHistogram(Metric):
+    kind = u'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LOOKUP_BUCKETS):
+        super(MetricHistogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for values, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    out.append((_series(self.name + u'_bucket', self.labels,
+                                        values, [(u'le', bound)]), bucket))
+                out.append((_series(self.name + u'_bucket', self.labels,
+                                    values, [(u'le', u'+Inf')]), count))
+                out.append((_series(self.name + u'_sum', self.labels,
+                                    values), total))
+                out.append((_series(self.name + u'_count', self.labels,
+                                    values), count))
+        return out
+
+
+class CollectedMetric(Metric):
+    """A metric whose samples are computed when it is scraped, by a
+    function returning a `{label values: value}` dict.
+    """
+    def __init__(self, name, help, labels, collect, kind=u'gauge'):
+        super(CollectedMetric, self).__init__(name, help, labels)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        return [(_series(self.name, self.labels, values), value)
+                for values, value in sorted(self.collect().items())]
+
+
+# The clock of <time.h> measuring the CPU time of the calling thread,
+# read through ctypes where `time.thread_time` is missing (Python < 3.7).
+CLOCK_THREAD_CPUTIME_ID = 3
+
+
+def _load_thread_clock():
+    """Return libc's `clock_gettime` and the structure it fills, or None
+    if it can't be used.
+    """
+    if ctypes is None or not sys.platform.startswith('linux'):
+        # The clock IDs differ between systems.
+        return None
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            func = ctypes.CDLL(path).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        return func, Timespec
+    return None
+
+
+_thread_clock = _load_thread_clock()
+
+
+def thread_cpu_time():
+    """Return the CPU time used by the calling thread, or None where it
+    can't be measured.
+    """
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    if _thread_clock is not None:
+        func, Timespec = _thread_clock
+        ts = Timespec()
+        if func(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) == 0:
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    if hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+
+def clock():
+    return time.time(), thread_cpu_time()
+
+
+class Timing(object):
+    """The wall-clock and CPU time spent in a part of the pipeline,
+    accumulated over its runs.
+    """
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = None
+        self._lock = threading.Lock()
+
+    def add(self, start, end):
+        """Account for a run between two `clock()` readings and return
+        its wall-clock and CPU times.
+        """
+        wall = end[0] - start[0]
+        cpu = end[1] - start[1] if start[1] is not None else None
+        with self._lock:
+            self.count += 1
+            self.wall += wall
+            if cpu is not None:
+                self.cpu = (self.cpu or 0.0) + cpu
+        return wall, cpu
+
+    def to_dict(self):
+        with self._lock:
+            return {'count': self.count, 'wall': self.wall, 'cpu': self.cpu}
+
+
+class StageMonitor(object):
+    """Counts the tasks going in and out of the coroutines of one
+    pipeline stage, and the time they spend in it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.received = self.emitted = self.busy = 0
+        self.timing = Timing()
+        self._lock = threading.Lock()
+
+    def wrap(self, coro, failed=None, source=False):
+        return MonitoredCoroutine(self, coro, failed, source)
+
+    def start(self):
+        with self._lock:
+            self.received += 1
+            self.busy += 1
+
+    def finish(self, out, start, started=True):
+        if out is None or out is pipeline.BUBBLE:
+            count = 0
+        elif isinstance(out, pipeline.MultiMessage):
+            count = len(out.messages)
+        else:
+            count = 1
+        with self._lock:
+            if started:
+                self.busy -= 1
+            self.emitted += count
+        metrics = app.config['metrics']
+        metrics.tasks.inc(self.name, amount=count)
+        wall, cpu = self.timing.add(start, clock())
+        metrics.stage_seconds.inc(self.name, u'wall', amount=wall)
+        if cpu is not None:
+            metrics.stage_seconds.inc(self.name, u'cpu', amount=cpu)
+
+    def to_dict(self):
+        out = self.timing.to_dict()
+        with self._lock:
+            out.update(received=self.received, emitted=self.emitted,
+                       busy=self.busy)
+        return out
+
+
+class MonitoredCoroutine(object):
+    """Stands in for a stage coroutine in a pipeline and reports to a
+    `StageMonitor`. `failed` is called when the coroutine raises.
+
+    The first stage of a pipeline, its `source`, is a generator handling
+    a task on every `next()`. The other stages only get one, to prime
+    them, which is not a run.
+    """
+    def __init__(self, monitor, coro, failed=None, source=False):
+        self.monitor = monitor
+        self.coro = coro
+        self.failed = failed
+        self.source = source
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.source:
+            return next(self.coro)
+        start = clock()
+        out = next(self.coro)
+        self.monitor.finish(out, start, started=False)
+        return out
+    __next__ = next
+
+    def send(self, msg):
+        self.monitor.start()
+        start = clock()
+        out = None
+        try:
+            out = self.coro.send(msg)
+        except Exception:
+            if self.failed is not None:
+                self.failed()
+            raise
+        finally:
+            self.monitor.finish(out, start)
+        return out
+
+
+def _running_sessions():
+    return [job.session for job in app.config['jobs'].all()
+            if job.status == ImportJob.RUNNING and job.session is not None]
+
+
+def _stage_depths():
+    depths = defaultdict(int)
+    for session in _running_sessions():
+        monitors = list(session.monitors.values())
+        for prev, monitor in zip(monitors, monitors[1:]):
+            depths[(monitor.name,)] += prev.emitted - monitor.received
+    return depths
+
+
+def _stage_busy():
+    busy = defaultdict(int)
+    for session in _running_sessions():
+        for monitor in session.monitors.values():
+            busy[(monitor.name,)] += monitor.busy
+    return busy
+
+
+def _parked_tasks():
+    parked = defaultdict(int)
+    for pending in app.config['decisions'].all():
+        parked[(pending.kind,)] += 1
+    return parked
+
+
+def _stages_waiting():
+    waiting = app.config['decisions'].stats()['waiting']
+    return dict(((stage,), count) for stage, count in waiting.items())
+
+
+def _parked_capacity():
+    return {(): app.config['decisions'].capacity}
+
+
+def _jobs_by_status():
+    jobs = defaultdict(int)
+    for job in app.config['jobs'].all():
+        jobs[(job.status,)] += 1
+    return jobs
+
+
+def _lookup_cache_stats():
+    cache = app.config.get('lookup_cache')
+    if cache is None:
+        return {}
+    stats = cache.stats()
+    return {(u'hit',): stats['hits'], (u'miss',): stats['misses'],
+            (u'coalesced',): stats['coalesced']}
+
+
+def _files_read():
+    return {(): app.config['tag_reader'].stats()['files']}
+
+
+def _files_placed():
+    return dict(((method,), files) for method, (files, _) in
+                app.config['file_ops'].totals.by_method().items())
+
+
+def _bytes_placed():
+    return dict(((method,), size) for method, (_, size) in
+                app.config['file_ops'].totals.by_method().items())
+
+
+def _job_bytes_per_second():
+    rates = {}
+    for session in _running_sessions():
+        rate = session.transfers.to_dict()['bytes_per_second']
+        if rate is not None:
+            rates[(session.job.id,)] = rate
+    return rates
+
+
+class ImportMetrics(object):
+    """The metrics of the import pipeline served at /metrics.
+    """
+    def __init__(self):
+        self.tasks = MetricCounter(
+            u'webimport_stage_tasks_total',
+            u'Tasks handled by each pipeline stage.', [u'stage'])
+        self.lookup_seconds = MetricHistogram(
+            u'webimport_lookup_seconds',
+            u'Autotag lookup latency by data source of the best candidate, '
+            u'lookups served from the cache left out.',
+            [u'data_source'], LOOKUP_BUCKETS)
+        self.decision_seconds = MetricHistogram(
+            u'webimport_decision_seconds',
+            u'Time from lookup to the choice of a candidate.',
+            [u'mode'], DECISION_BUCKETS)
+        self.duplicates = MetricCounter(
+            u'webimport_duplicates_total',
+            u'Duplicate resolutions by action.', [u'action'])
+        self.stage_seconds = MetricCounter(
+            u'webimport_stage_seconds_total',
+            u'Wall-clock and CPU time spent in each pipeline stage.',
+            [u'stage', u'clock'])
+        self.phase_seconds = MetricCounter(
+            u'webimport_phase_seconds_total',
+            u'Wall-clock and CPU time spent choosing, resolving '
+            u'duplicates and applying in the user query stage.',
+            [u'phase', u'clock'])
+        self.paused_seconds = MetricCounter(
+            u'webimport_paused_seconds_total',
+            u'Time stages spent waiting for room in the decision store.',
+            [u'stage'])
+        self.metrics = [
+            self.tasks,
+            CollectedMetric(u'webimport_stage_queue_depth',
+                            u'Tasks waiting in front of each stage.',
+                            [u'stage'], _stage_depths),
+            CollectedMetric(u'webimport_stage_busy',
+                            u'Tasks being handled by each stage.',
+                            [u'stage'], _stage_busy),
+            self.lookup_seconds,
+            self.decision_seconds,
+            self.duplicates,
+            self.stage_seconds,
+            self.phase_seconds,
+            CollectedMetric(u'webimport_parked_tasks',
+                            u'Tasks waiting for a decision.',
+                            [u'kind'], _parked_tasks),
+            CollectedMetric(u'webimport_parked_capacity',
+                            u'Most tasks waiting for a decision before '
+                            u'the pipelines pause (0: unbounded).',
+                            [], _parked_capacity),
+            CollectedMetric(u'webimport_stages_paused',
+                            u'Pipeline stages waiting for room in the '
+                            u'decision store.',
+                            [u'stage'], _stages_waiting),
+            self.paused_seconds,
+            CollectedMetric(u'webimport_jobs', u'Import jobs by status.',
+                            [u'status'], _jobs_by_status),
+            CollectedMetric(u'webimport_lookup_cache_total',
+                            u'Lookup cache requests by result.',
+                            [u'result'], _lookup_cache_stats, u'counter'),
+            CollectedMetric(u'webimport_files_read_total',
+                            u'Media files whose tags were read.',
+                            [], _files_read, u'counter'),
+            CollectedMetric(u'webimport_files_placed_total',
+                            u'Files put in the library, by method.',
+                            [u'method'], _files_placed, u'counter'),
+            CollectedMetric(u'webimport_file_bytes_total',
+                            u'Bytes put in the library, by method.',
+                            [u'method'], _bytes_placed, u'counter'),
+            CollectedMetric(u'webimport_job_file_bytes_per_second',
+                            u'Rate at which running jobs put files in '
+                            u'the library.',
+                            [u'job'], _job_bytes_per_second),
+        ]
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.expose()
+        return u'\n'.join(lines) + u'\n'
+
+
+# Profiling.
+
+# Longest profile that can be requested, in seconds.
+MAX_PROFILE_SECONDS = 300
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all the other threads of the process at a
+    fixed interval. This is a wall-clock profile: threads waiting for a
+    lock, a queue or a reviewer show up where they wait.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self.elapsed = 0.0
+        self.count = 0
+
+    def run(self, seconds):
+        own = threading.current_thread().ident
+        start = time.time()
+        deadline = start + seconds
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                    frame = frame.f_back
+                self.samples[tuple(reversed(stack))] += 1
+            self.count += 1
+            time.sleep(self.interval)
+        self.elapsed = time.time() - start
+
+    def pstats(self):
+        """Return the samples as the marshalled dict `pstats.Stats`
+        loads, with sample counts standing in for call counts.
+        """
+        tick = self.elapsed / self.count if self.count else 0.0
+        stats = {}
+        for stack, n in self.samples.items():
+            t = n * tick
+            seen = set()
+            for i, func in enumerate(stack):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = i == len(stack) - 1
+                if leaf:
+                    entry[2] += t
+                if func not in seen:
+                    seen.add(func)
+                    entry[0] += n
+                    entry[1] += n
+                    entry[3] += t
+                if i:
+                    caller = entry[4].setdefault(stack[i - 1],
+                                                 [0, 0, 0.0, 0.0])
+                    caller[0] += n
+                    caller[1] += n
+                    caller[3] += t
+                    if leaf:
+                        caller[2] += t
+        return marshal.dumps(dict(
+            (func, (cc, nc, tt, ct, dict((c, tuple(v))
+                                         for c, v in callers.items())))
+            for func, (cc, nc, tt, ct, callers) in stats.items()
+        ))
+
+    def folded(self):
+        """Return the samples as folded stacks, one per line, for
+        flame graph tools.
+        """
+        lines = []
+        for stack, n in sorted(self.samples.items()):
+            lines.append(u'{0} {1}'.format(u';'.join(
+                u'{0}:{1}'.format(os.path.basename(f), name)
+                for f, _, name in stack), n))
+        return u'\n'.join(lines) + u'\n'
+
+
+_profile_lock = threading.Lock()
+
+
+# Web application.
+
+def _error(status, message):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
 
 
 @app.before_request
 def before_request():
     g.lib = app.config['lib']
+    g.read_pool = app.config['read_pool']
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(exc):
+    return _error(503, u'the library is busy')
 
 
 @app.route('/')
@@ -904,5 +5425,528 @@ def hello_world():
     return 'Hello World!'
 
 
+@app.route('/library/albums', methods=['GET'])
+def list_albums():
+    """List library albums, optionally filtered by a substring `q` of
+    their artist or title.
+    """
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    offset = request.args.get('offset', 0, type=int)
+    with g.read_pool.connection() as conn:
+        albums = library_albums(conn, request.args.get('q'), limit, offset)
+    return jsonify(albums=albums)
+
+
+@app.route('/library/duplicates', methods=['GET'])
+def list_duplicates():
+    artist = request.args.get('artist', u'')
+    album = request.args.get('album', u'')
+    with g.read_pool.connection() as conn:
+        albums = library_duplicates(conn, artist, album)
+    return jsonify(albums=albums)
+
+
+@app.route('/library/pool', methods=['GET'])
+def read_pool_stats():
+    return jsonify(g.read_pool.stats())
+
+
+@app.route('/imports', methods=['GET'])
+def list_imports():
+    return jsonify(imports=[job.to_dict()
+                            for job in app.config['jobs'].all()])
+
+
+@app.route('/imports', methods=['POST'])
+def create_import():
+    """Queue an import. The body is a JSON object with either a list of
+    `paths` or, when `library` is true, a `query` against the library.
+    With `watch`, the paths are watched for new albums instead. With
+    `dry_run`, the import is only planned: its plan is streamed from
+    `/imports/<id>/plan`.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _error(400, u'expected a JSON object')
+    if data.get('library'):
+        query = data.get('query') or []
+        if isinstance(query, basestring):
+            query = query.split()
+        paths = []
+    else:
+        query = None
+        paths = data.get('paths') or []
+        if not isinstance(paths, list) or \
+                not all(isinstance(p, basestring) for p in paths):
+            return _error(400, u'paths must be a list of strings')
+        if not paths:
+            return _error(400, u'no path specified')
+
+    if app.config['jobs'].closed:
+        return _error(503, u'the server is shutting down')
+    try:
+        if data.get('dry_run'):
+            job = app.config['jobs'].plan(g.lib, paths, query)
+        elif data.get('watch') and query is None:
+            job = app.config['jobs'].watch(g.lib, paths)
+        else:
+            job = app.config['jobs'].submit(g.lib, paths, query)
+    except ui.UserError as exc:
+        return _error(400, unicode(exc))
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = '/imports/{0}'.format(job.id)
+    return response
+
+
+@app.route('/imports/<job_id>', methods=['GET'])
+def get_import(job_id):
+    job = app.config['jobs'].get(job_id)
+    if job is None:
+        return _error(404, u'no such import')
+    return jsonify(job.to_dict())
+
+
+@app.route('/imports/<job_id>/plan', methods=['GET'])
+def stream_plan(job_id):
+    """Stream the plan of a dry run as newline-delimited JSON, one task
+    per line, as it is worked out. Only one client can stream it at a
+    time; a client that got disconnected resumes by passing the number of
+    lines it received as `offset`.
+    """
+    job = app.config['jobs'].get(job_id)
+    if job is None or not job.dry_run:
+        return _error(404, u'no such dry run')
+    offset = request.args.get('offset', 0, type=int)
+    if not 0 <= offset <= job.planned:
+        return _error(400, u'offset out of the plan')
+    if not job.buffered(offset):
+        return _error(410, u'the plan is no longer buffered')
+    if not job.open_stream():
+        return _error(409, u'the plan is already being streamed')
+
+    def generate(offset):
+        try:
+            while True:
+                entries = job.read(offset, 1.0)
+                if entries is None:
+                    return
+                if not entries:
+                    if job.status in (job.QUEUED, job.RUNNING):
+                        continue
+                    # The job is over: send what it planned last.
+                    entries = job.read(offset, 0)
+                    if not entries:
+                        return
+                for entry in entries:
+                    offset += 1
+                    yield json.dumps(entry, sort_keys=True) + '\n'
+        finally:
+            job.close_stream()
+
+    return Response(generate(offset), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/imports/<job_id>', methods=['DELETE'])
+def abort_import(job_id):
+    job = app.config['jobs'].get(job_id)
+    if job is None:
+        return _error(404, u'no such import')
+    job.abort()
+    return jsonify(job.to_dict())
+
+
+@app.route('/events')
+def stream_events():
+    """Stream import events as Server-Sent Events. Clients resume after
+    the last event they saw through the `Last-Event-ID` header or a
+    `cursor` parameter.
+    """
+    bus = app.config['events']
+    cursor = request.headers.get('Last-Event-ID') or \
+        request.args.get('cursor', u'0')
+    try:
+        cursor = bus.parse_cursor(cursor)
+    except ValueError:
+        return _error(400, u'invalid cursor')
+
+    def generate(cursor):
+        while True:
+            events = bus.wait(cursor, 15.0)
+            if events is None:
+                # The server is shutting down.
+                return
+            if not events:
+                # Keep idle connections open through proxies.
+                yield ':\n\n'
+            for event in events:
+                cursor = event.id
+                data = dict(event.data, time=event.time)
+                yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(
+                    bus.event_id(event), event.type, json.dumps(data)
+                )
+
+    return Response(generate(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/scan')
+def scan_stats():
+    cache = app.config.get('scan_cache')
+    items = app.config.get('item_cache')
+    return jsonify(cache=cache.stats() if cache is not None else None,
+                   items=items.stats() if items is not None else None,
+                   tags=app.config['tag_reader'].stats())
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(app.config['metrics'].expose(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/profile')
+def profile():
+    """Sample the stacks of the server's threads for `seconds` and
+    return them as a `pstats` file, or as folded stacks with
+    `format=folded`.
+    """
+    seconds = request.args.get('seconds', 10, type=float)
+    interval = request.args.get('interval', 0.005, type=float)
+    fmt = request.args.get('format', u'pstats')
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return _error(400, u'seconds must be between 0 and {0}'.format(
+            MAX_PROFILE_SECONDS))
+    if fmt not in (u'pstats', u'folded'):
+        return _error(400, u'unknown format: {0}'.format(fmt))
+    if not _profile_lock.acquire(False):
+        return _error(409, u'a profile is already running')
+    try:
+        profiler = SamplingProfiler(max(interval, 0.001))
+        profiler.run(seconds)
+    finally:
+        _profile_lock.release()
+
+    name = time.strftime('webimport-%Y%m%d-%H%M%S')
+    if fmt == u'pstats':
+        response = Response(profiler.pstats(),
+                            mimetype='application/octet-stream')
+        name += '.prof'
+    else:
+        response = Response(profiler.folded(), mimetype='text/plain')
+        name += '.folded'
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={0}'.format(name)
+    return response
+
+
+@app.route('/cache')
+def cache_stats():
+    cache = app.config['lookup_cache']
+    if cache is None:
+        return _error(404, u'lookup cache disabled')
+    return jsonify(cache.stats())
+
+
+# Maximum number of tasks listed per page.
+TASK_PAGE_SIZE = 500
+
+
+def _list_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return set(v for v in value.split(u',') if v)
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(
+        json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError(u'bad cursor')
+    if not isinstance(key, list):
+        raise ValueError(u'bad cursor')
+    return tuple(key)
+
+
+def _task_filters():
+    """Parse the task filters and sort order of the query string into
+    arguments for `TaskIndex.query`. Raise `ValueError` if they are
+    invalid.
+    """
+    args = request.args
+    sort = args.get('sort', u'age')
+    if sort not in (u'age', u'distance'):
+        raise ValueError(u'unknown sort: {0}'.format(sort))
+    order = args.get('order', u'asc')
+    if order not in (u'asc', u'desc'):
+        raise ValueError(u'unknown order: {0}'.format(order))
+    has_duplicates = args.get('has_duplicates')
+    if has_duplicates is not None:
+        if has_duplicates not in (u'true', u'false'):
+            raise ValueError(u'has_duplicates must be true or false')
+        has_duplicates = has_duplicates == u'true'
+    data_source = _list_arg('data_source')
+    if data_source is not None:
+        data_source = set(_lower(v) for v in data_source)
+    return {
+        'kind': _list_arg('kind'),
+        'rec': _list_arg('rec'),
+        'data_source': data_source,
+        'has_duplicates': has_duplicates,
+        'path': args.get('path'),
+        'min_distance': args.get('min_distance', type=float),
+        'max_distance': args.get('max_distance', type=float),
+        'sort': sort,
+        'descending': order == u'desc',
+    }
+
+
+@app.route('/tasks', methods=['GET'])
+def list_tasks():
+    """List the parked tasks, filtered by `kind`, `rec`, `data_source`
+    (comma-separated lists), `has_duplicates`, `path` prefix and
+    `min_distance`/`max_distance`, sorted by `age` or `distance` and
+    paginated with the `next` cursor.
+    """
+    args = request.args
+    try:
+        filters = _task_filters()
+        limit = min(args.get('limit', 50, type=int), TASK_PAGE_SIZE)
+        after = args.get('cursor')
+        if after:
+            after = _decode_cursor(after)
+    except ValueError as exc:
+        return _error(400, unicode(exc))
+
+    pendings, last = app.config['decisions'].query(
+        after=after or None, limit=max(limit, 1), **filters
+    )
+    return jsonify(tasks=[pending.summary() for pending in pendings],
+                   next=_encode_cursor(last) if last else None)
+
+
+@app.route('/tasks/claim', methods=['POST'])
+def claim_tasks():
+    """Lease a batch of parked tasks to a reviewer. The body is a JSON
+    object with the `reviewer` name, the `count` of tasks wanted and
+    the lease `ttl` in seconds; the query string takes the filters and
+    sort order of `/tasks`. Claiming again renews the leases still
+    held, so reviewers can poll this to keep their batch.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _error(400, u'expected a JSON object')
+    reviewer = data.get('reviewer')
+    if not isinstance(reviewer, basestring) or not reviewer:
+        return _error(400, u'missing reviewer')
+    count = data.get('count', 10)
+    if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+        return _error(400, u'count must be a positive integer')
+    ttl = data.get('ttl')
+    if ttl is not None and (isinstance(ttl, bool) or
+                            not isinstance(ttl, (int, float)) or ttl <= 0):
+        return _error(400, u'ttl must be a positive number')
+    try:
+        filters = _task_filters()
+    except ValueError as exc:
+        return _error(400, unicode(exc))
+
+    claimed = app.config['decisions'].claim(
+        reviewer, min(count, TASK_PAGE_SIZE), ttl, **filters
+    )
+    app.config['events'].publish(u'tasks-claimed', reviewer=reviewer,
+                                 tasks=[pending.id for pending in claimed])
+    return jsonify(tasks=[pending.summary() for pending in claimed])
+
+
+@app.route('/tasks/release', methods=['POST'])
+def release_tasks():
+    """Give back the leases of a reviewer: on the `tasks` listed in the
+    JSON body, or on all of them.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _error(400, u'expected a JSON object')
+    reviewer = data.get('reviewer')
+    if not isinstance(reviewer, basestring) or not reviewer:
+        return _error(400, u'missing reviewer')
+    task_ids = data.get('tasks')
+    if task_ids is not None and (
+            not isinstance(task_ids, list) or
+            not all(isinstance(t, basestring) for t in task_ids)):
+        return _error(400, u'expected a list of tasks')
+    released = app.config['decisions'].release(reviewer, task_ids)
+    app.config['events'].publish(u'tasks-released', reviewer=reviewer,
+                                 tasks=task_ids)
+    return jsonify(released=released)
+
+
+@app.route('/tasks/queue', methods=['GET'])
+def task_queue_stats():
+    return jsonify(app.config['decisions'].stats())
+
+
+@app.route('/tasks/decisions', methods=['POST'])
+def post_decisions():
+    """Answer many parked tasks at once. The body is a JSON object whose
+    `decisions` list holds decisions as for `/tasks/<id>/decision`, each
+    with the `task` it is for. Every decision is reported on its own; a
+    `reviewer` given next to the list applies to all of them.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('decisions'), list):
+        return _error(400, u'expected a list of decisions')
+    decisions = data['decisions']
+
+    batch = []
+    results = [None] * len(decisions)
+    for i, decision in enumerate(decisions):
+        if not isinstance(decision, dict) or 'task' not in decision:
+            results[i] = {'task': None, 'status': u'error',
+                          'error': u'missing task'}
+        elif not isinstance(decision['task'], basestring):
+            results[i] = {'task': None, 'status': u'error',
+                          'error': u'task must be a string'}
+        else:
+            if 'reviewer' in data:
+                decision.setdefault('reviewer', data['reviewer'])
+            batch.append((i, decision))
+
+    resolved = app.config['decisions'].resolve_many(
+        [(d['task'], d) for _, d in batch]
+    )
+    for (i, decision), result in zip(batch, resolved):
+        if isinstance(result, DecisionError):
+            results[i] = {'task': decision['task'],
+                          'status': u'conflict'
+                          if isinstance(result, DecisionConflict)
+                          else u'error',
+                          'error': unicode(result)}
+        else:
+            results[i] = {'task': decision['task'], 'status': u'resolved'}
+    return jsonify(results=results)
+
+
+@app.route('/tasks/auto', methods=['POST'])
+def auto_decide_tasks():
+    """Run the auto-decision rules over every pending task and resolve
+    the ones they decide.
+    """
+    return jsonify(resolved=_apply_policy(app.config['policy']))
+
+
+@app.route('/rules', methods=['GET'])
+def get_rules():
+    return jsonify(rules=app.config['policy'].to_list())
+
+
+@app.route('/rules', methods=['PUT'])
+def put_rules():
+    """Replace the auto-decision rules with the JSON list in the body,
+    then apply them to the pending tasks.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return _error(400, u'expected a list of rules')
+    try:
+        policy = Policy(data)
+    except ui.UserError as exc:
+        return _error(400, unicode(exc))
+    app.config['policy'] = policy
+    return jsonify(rules=policy.to_list(), resolved=_apply_policy(policy))
+
+
+def _apply_policy(policy):
+    """Resolve the pending tasks decided by `policy`. Return the
+    number of tasks resolved.
+    """
+    store = app.config['decisions']
+    decisions = []
+    for pending, action in policy.decide_all(store.all()):
+        if action == importer.action.APPLY:
+            data = {'action': u'apply', 'candidate': 0}
+        elif action == importer.action.ASIS:
+            data = {'action': u'asis'}
+        else:
+            data = {'action': u'skip'}
+        decisions.append((pending.id, data))
+    # Tasks decided by someone else in the meantime, or leased to a
+    # reviewer, come back as errors.
+    results = store.resolve_many(decisions, decided_by=u'rule')
+    return sum(1 for r in results if not isinstance(r, DecisionError))
+
+
+@app.route('/tasks/<task_id>', methods=['GET'])
+def get_task(task_id):
+    pending = app.config['decisions'].get(task_id)
+    if pending is None:
+        return _error(404, u'no such task')
+    return jsonify(pending.to_dict())
+
+
+@app.route('/tasks/<task_id>/candidates/<int:index>', methods=['GET'])
+def get_candidate(task_id, index):
+    """Describe one candidate of a parked task. Album tracks come one
+    medium at a time, selected with the `medium` parameter.
+    """
+    pending = app.config['decisions'].get(task_id)
+    if pending is None or pending.kind == PendingTask.DUPLICATE:
+        return _error(404, u'no such task')
+    medium = request.args.get('medium', None, type=int)
+    try:
+        return jsonify(pending.candidate_detail(index, medium))
+    except IndexError:
+        return _error(404, u'no such candidate')
+    except KeyError:
+        return _error(404, u'no such medium')
+
+
+@app.route('/tasks/<task_id>/candidates/<int:index>/diff', methods=['GET'])
+def get_candidate_diff(task_id, index):
+    """Describe the tag changes a candidate would make, as diff spans
+    suitable for rendering. Album tracks come one medium at a time.
+    """
+    pending = app.config['decisions'].get(task_id)
+    if pending is None or pending.kind == PendingTask.DUPLICATE:
+        return _error(404, u'no such task')
+    medium = request.args.get('medium', None, type=int)
+    try:
+        return jsonify(app.config['diffs'].get(pending, index, medium))
+    except IndexError:
+        return _error(404, u'no such candidate')
+    except KeyError:
+        return _error(404, u'no such medium')
+
+
+@app.route('/tasks/<task_id>/decision', methods=['POST'])
+def post_decision(task_id):
+    """Answer a parked task. The body is a JSON object with an `action`
+    and, depending on it, a `candidate` index, search `artist` and
+    `name`, or an `id`. Tasks leased to a reviewer only take decisions
+    naming it as `reviewer`.
+    """
+    if app.config['decisions'].get(task_id) is None:
+        return _error(404, u'no such task')
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _error(400, u'expected a JSON object')
+    try:
+        app.config['decisions'].resolve(task_id, data)
+    except DecisionConflict as exc:
+        return _error(409, unicode(exc))
+    except DecisionError as exc:
+        return _error(400, unicode(exc))
+    return jsonify(id=task_id, status=u'resolved')
+
+
 if __name__ == '__main__':
     beets.main(None)